@@ -1,25 +1,35 @@
 from dataclasses import dataclass, field
 from typing import Tuple
 
-from yaml import load
-try:
-    from yaml import CLoader as Loader
-except ImportError:
-    from yaml import Loader
-
 @dataclass(frozen=True)
 class SamplingData:
     """
     Dataclass for storing sampling data information.
 
     Attributes:
-        filename (str): The name of the file.
+        filename (str): The name of the file, or a tuple of batch files (oldest first) that are merged by uid_col.
         dataset_column (str): The name of the dataset column. Use 'random' for random sampling.
         features (Tuple[str, ...]): Tuple of feature names.
         title (str): The title of the sampling data.
-        datasets (dict): Dictionary of dataset names and their respective fractions.
-        numeric_cols (dict): Dictionary of numeric column names and their respective bins.
+        datasets (dict): Dictionary of dataset names and their respective fractions. A dataset can be split
+            further by giving a dictionary with its 'fraction' and nested 'datasets' instead of a fraction.
+        numeric_cols (dict): Dictionary of numeric column names and their respective bins. The bins may also be
+            {'quantiles': k} or {'min_count': n} to compute them from the data.
         uid_col (str): The name of the unique identifier column.
+        group_col (str): The name of the column grouping rows of the same subject, e.g. the uid_col. When set, one
+            representative row per group is stratified and every row of the group is assigned to the same dataset.
+        group_reduction (dict): Dictionary of feature names and the reduction ('first', 'last', 'min', 'max',
+            'median', 'mode', ...) used to build the representative row of each group. Defaults to 'first'.
+        dtype_backend (str): The dtype backend used to read the file: None (NumPy dtypes), 'numpy_nullable' or
+            'pyarrow' to keep every column Arrow-backed.
+        memory_budget (str): A memory budget such as '4GB'. When set, the command line chooses between in-memory
+            and chunked execution to fit it.
+        duplicate_policy (str): How a uid found in several rows of the batch files is resolved: 'first', 'latest'
+            or 'error'. See merge_batches.
+        partition_output (str): When set, the command line writes one file per dataset instead of a single output
+            file: 'files' next to the output file or 'directory' for a directory per dataset.
+        allocation (str): How the rows of every stratum are apportioned: 'stratum' rounds every stratum on its own,
+            'global' also keeps the total of every dataset as close as possible to its fraction. See allocate_strata.
     """
     filename: str
     dataset_column: str
@@ -28,6 +38,33 @@ class SamplingData:
     datasets: dict = field(default_factory=dict)
     numeric_cols: dict = field(default_factory=dict)
     uid_col: str = None
+    group_col: str = None
+    group_reduction: dict = field(default_factory=dict)
+    dtype_backend: str = None
+    memory_budget: str = None
+    partition_output: str = None
+    duplicate_policy: str = 'first'
+    allocation: str = 'stratum'
+
+    @classmethod
+    def from_dict(cls, value: dict) -> 'SamplingData':
+        """Create a SamplingData instance from one entry of a configuration file (or an equivalent dictionary)."""
+        return cls(
+            filename=value['filename'] if isinstance(value['filename'], str) else tuple(value['filename']),
+            dataset_column=value['dataset_column'],
+            features=tuple(value['features']),
+            title=value['title'],
+            datasets=value['datasets'] if 'datasets' in value else {},
+            numeric_cols=value['numeric_cols'] if 'numeric_cols' in value else {},
+            uid_col=value['uid_col'] if 'uid_col' in value else None,
+            group_col=value['group_col'] if 'group_col' in value else None,
+            group_reduction=value['group_reduction'] if 'group_reduction' in value else {},
+            dtype_backend=value['dtype_backend'] if 'dtype_backend' in value else None,
+            memory_budget=value['memory_budget'] if 'memory_budget' in value else None,
+            partition_output=value['partition_output'] if 'partition_output' in value else None,
+            duplicate_policy=value['duplicate_policy'] if 'duplicate_policy' in value else 'first',
+            allocation=value['allocation'] if 'allocation' in value else 'stratum',
+        )
 
 
 @dataclass
@@ -36,7 +73,7 @@ class CONFIG:
     Dataclass for storing the configuration data.
 
     Attributes:
-        filename (str): The name of the file.
+        filename (str): The name of the YAML configuration file.
         sampling_dict (dict): Dictionary of sampling data.
     """
     filename: str = 'CONFIG.yaml'
@@ -47,19 +84,20 @@ class CONFIG:
 
     def _load_data(self):
         """Load the YAML data from the current filename."""
+        # PyYAML is only needed to read configuration files, so the sampling engine can be imported without it
+        try:
+            from yaml import load
+        except ImportError as e:
+            raise ImportError("Reading YAML configuration files needs PyYAML: pip install PyYAML") from e
+        try:
+            from yaml import CLoader as Loader
+        except ImportError:
+            from yaml import Loader
         with open(self.filename, 'r', encoding='utf-8') as stream:
             sampling_data_yaml = load(stream, Loader=Loader)  # type: ignore
         self.sampling_dict = {}
         for key, value in sampling_data_yaml.items():
-            sampling_data_instance = SamplingData(
-                filename=value['filename'],
-                dataset_column=value['dataset_column'],
-                features=tuple(value['features']),
-                title=value['title'],
-                datasets=value['datasets'] if 'datasets' in value else {},
-                numeric_cols=value['numeric_cols'] if 'numeric_cols' in value else {},
-                uid_col=value['uid_col'] if 'uid_col' in value else None,
-            )
+            sampling_data_instance = SamplingData.from_dict(value)
             # Add to dictionary with the title as the value from the YAML file
             self.sampling_dict[key] = sampling_data_instance
 
@@ -0,0 +1,256 @@
+import dataclasses
+import json
+import sqlite3
+import threading
+from datetime import datetime
+from itertools import chain, islice, repeat
+
+import pandas as pd
+
+from sampling_plan import SamplingPlan, compile_sampling_plan, level_column
+
+
+class AssignmentStore:
+    """
+    Local SQLite store of the dataset assignments of sampling runs, indexed on uid.
+
+    Every run is recorded with its metadata (configuration, seed and input fingerprint), and its assignments are
+    bulk inserted in a single transaction. The store answers point and batch uid lookups and "all uids of a
+    dataset in a run" queries, and can provide the frozen assignments of a run for later runs.
+
+    Attributes:
+        path (str): The path of the SQLite database file.
+        batch_size (int): The number of rows inserted per executemany call.
+    """
+
+    def __init__(self, path: str = 'assignments.sqlite', *, batch_size: int = 50_000):
+        self.path = path
+        self.batch_size = batch_size
+        self._lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self._create_tables()
+
+    def _create_tables(self):
+        """Create the tables and indexes if they do not exist yet, and upgrade a store without assignment levels."""
+        with self._lock, self.connection:
+            columns = [row[1] for row in self.connection.execute("PRAGMA table_info(assignments)")]
+            if columns and 'level' not in columns:
+                # Stores written before nested splits were recorded only hold the first level
+                self.connection.executescript("""
+                    ALTER TABLE assignments RENAME TO assignments_first_level;
+                    DROP INDEX IF EXISTS idx_assignments_uid;
+                    DROP INDEX IF EXISTS idx_assignments_run_dataset;
+                """)
+            self.connection.executescript("""
+                CREATE TABLE IF NOT EXISTS runs (
+                    run_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    created TEXT NOT NULL,
+                    title TEXT,
+                    config TEXT NOT NULL,
+                    seed INTEGER,
+                    fingerprint TEXT,
+                    uid_col TEXT,
+                    dataset_column TEXT,
+                    num_rows INTEGER
+                );
+                CREATE TABLE IF NOT EXISTS assignments (
+                    run_id INTEGER NOT NULL REFERENCES runs(run_id),
+                    level INTEGER NOT NULL DEFAULT 1,
+                    uid TEXT NOT NULL,
+                    dataset TEXT NOT NULL,
+                    PRIMARY KEY (run_id, level, uid)
+                );
+                CREATE INDEX IF NOT EXISTS idx_assignments_uid ON assignments(uid);
+                CREATE INDEX IF NOT EXISTS idx_assignments_run_dataset ON assignments(run_id, level, dataset);
+            """)
+            if columns and 'level' not in columns:
+                self.connection.executescript("""
+                    INSERT INTO assignments (run_id, level, uid, dataset)
+                        SELECT run_id, 1, uid, dataset FROM assignments_first_level;
+                    DROP TABLE assignments_first_level;
+                """)
+
+    def close(self):
+        """Close the database connection."""
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def record_run(self, result: pd.DataFrame, sampling_data, *, seed=None, fingerprint: str = None) -> int:
+        """
+        Record the assignments of a sampling run.
+
+        Parameters:
+        - result (pandas.DataFrame): The result of stratified_sampling, with the uid and dataset columns. The
+          datasets of every level of a nested split are recorded, see SamplingPlan.level_columns.
+        - sampling_data (SamplingData or SamplingPlan): The sampling configuration of the run. The bins that a plan
+          computed from the data are recorded with it, see data_bins.
+        - seed (int): The random seed of the run.
+        - fingerprint (str): The fingerprint of the input data, see input_fingerprint in sampling_execution.
+
+        Returns:
+        - int: The id of the new run.
+        """
+        plan = compile_sampling_plan(sampling_data)
+        data_bins = {}
+        if isinstance(sampling_data, SamplingPlan):
+            sampling_data = plan.sampling_data
+            for binning in plan.numeric:
+                # Only the bins computed from the data; the configured ones are already part of the configuration
+                bins = (sampling_data.numeric_cols[binning.column] or {}).get('bins')
+                if isinstance(bins, dict) and binning.edges:
+                    data_bins[binning.column] = {'bins': list(binning.edges),
+                                                 'labels': list(binning.labels[:len(binning.edges) - 1])}
+        config = {**dataclasses.asdict(sampling_data), 'data_bins': data_bins}
+        uid_col = sampling_data.uid_col
+        dataset_column = sampling_data.dataset_column
+        if not uid_col:
+            raise ValueError("A uid column is needed to record assignments")
+
+        uids = result[uid_col].astype(str)
+        if uids.duplicated().any():
+            print("WARNING: duplicate uids in the result; the last assignment of each uid is recorded")
+        # One row per uid and level; rows whose dataset is not split further have no deeper level
+        rows = chain.from_iterable(
+            zip(repeat(depth), uids[result[column].notna()], result[column].dropna().astype(str))
+            for depth, column in enumerate(plan.level_columns, start=1) if column in result)
+
+        with self._lock, self.connection:
+            cursor = self.connection.execute(
+                "INSERT INTO runs (created, title, config, seed, fingerprint, uid_col, dataset_column, num_rows) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (datetime.now().isoformat(timespec='seconds'), sampling_data.title,
+                 json.dumps(config, default=str), seed, fingerprint, uid_col,
+                 dataset_column, len(result)))
+            run_id = cursor.lastrowid
+            while batch := [(run_id, level, uid, dataset) for level, uid, dataset in islice(rows, self.batch_size)]:
+                self.connection.executemany(
+                    "INSERT OR REPLACE INTO assignments (run_id, level, uid, dataset) VALUES (?, ?, ?, ?)", batch)
+
+        return run_id
+
+    def latest_run_id(self) -> int:
+        """Return the id of the most recent run, or None if the store is empty."""
+        with self._lock:
+            return self.connection.execute("SELECT MAX(run_id) FROM runs").fetchone()[0]
+
+    def runs(self) -> pd.DataFrame:
+        """Return the metadata of every recorded run."""
+        with self._lock:
+            return pd.read_sql_query("SELECT * FROM runs ORDER BY run_id", self.connection)
+
+    def lookup(self, uid, run_id: int = None):
+        """
+        Look up the (first-level) dataset of a single uid.
+
+        Parameters:
+        - uid (str): The uid to look up.
+        - run_id (int): The run to look in. Defaults to the latest run containing the uid.
+
+        Returns:
+        - str: The dataset of the uid, or None if it was never assigned.
+        """
+        query = "SELECT dataset FROM assignments WHERE uid = ? AND level = 1"
+        params = [str(uid)]
+        if run_id is not None:
+            query += " AND run_id = ?"
+            params.append(run_id)
+        with self._lock:
+            row = self.connection.execute(query + " ORDER BY run_id DESC LIMIT 1", params).fetchone()
+        return row[0] if row else None
+
+    def lookup_many(self, uids, run_id: int = None) -> pd.Series:
+        """
+        Look up the (first-level) datasets of many uids with a single indexed join.
+
+        Parameters:
+        - uids (iterable): The uids to look up.
+        - run_id (int): The run to look in. Defaults to the latest run containing each uid.
+
+        Returns:
+        - pandas.Series: The dataset of every uid that was found, indexed by uid.
+        """
+        with self._lock, self.connection:
+            self.connection.execute("CREATE TEMP TABLE IF NOT EXISTS lookup_uids (uid TEXT PRIMARY KEY)")
+            self.connection.execute("DELETE FROM lookup_uids")
+            self.connection.executemany("INSERT OR IGNORE INTO lookup_uids (uid) VALUES (?)",
+                                        ((str(uid),) for uid in uids))
+            if run_id is None:
+                rows = self.connection.execute(
+                    "SELECT a.uid, a.dataset FROM lookup_uids l JOIN assignments a ON a.uid = l.uid "
+                    "WHERE a.level = 1 AND a.run_id = (SELECT MAX(b.run_id) FROM assignments b WHERE b.uid = a.uid)"
+                ).fetchall()
+            else:
+                rows = self.connection.execute(
+                    "SELECT a.uid, a.dataset FROM lookup_uids l JOIN assignments a ON a.uid = l.uid "
+                    "WHERE a.level = 1 AND a.run_id = ?", (run_id,)).fetchall()
+            self.connection.execute("DELETE FROM lookup_uids")
+
+        return pd.Series(dict(rows), name='dataset', dtype=object)
+
+    def uids_in_dataset(self, dataset: str, run_id: int = None, *, level: int = 1) -> list:
+        """
+        Return all uids assigned to a dataset in a run.
+
+        Parameters:
+        - dataset (str): The dataset name.
+        - run_id (int): The run to look in. Defaults to the latest run.
+        - level (int): The level of the dataset in a nested split, 1 for the dataset column.
+
+        Returns:
+        - list: The uids of the dataset.
+        """
+        run_id = self.latest_run_id() if run_id is None else run_id
+        with self._lock:
+            rows = self.connection.execute("SELECT uid FROM assignments WHERE run_id = ? AND level = ? AND dataset = ?",
+                                           (run_id, level, dataset)).fetchall()
+        return [row[0] for row in rows]
+
+    def data_bins(self, run_id: int = None) -> dict:
+        """
+        Return the bins that a run computed from the data, to bin a later run the same way (see apply_data_bins).
+
+        Parameters:
+        - run_id (int): The run. Defaults to the latest run.
+
+        Returns:
+        - dict: The {'bins': edges, 'labels': labels} of every column binned by quantiles of the data.
+        """
+        run_id = self.latest_run_id() if run_id is None else run_id
+        if run_id is None:
+            raise ValueError(f"There are no runs in {self.path}")
+        with self._lock:
+            row = self.connection.execute("SELECT config FROM runs WHERE run_id = ?", (run_id,)).fetchone()
+        if row is None:
+            raise ValueError(f"There is no run {run_id} in {self.path}")
+        return json.loads(row[0]).get('data_bins', {})
+
+    def frozen_assignments(self, run_id: int = None) -> pd.DataFrame:
+        """
+        Return the assignments of a run at every level, to be kept by a later run (see nested_assignment).
+
+        Parameters:
+        - run_id (int): The run. Defaults to the latest run.
+
+        Returns:
+        - pandas.DataFrame: The datasets of every uid of the run, indexed by uid, with one column per level named
+          like the dataset columns of the run. A uid whose dataset is not split further is missing in the deeper
+          columns.
+        """
+        run_id = self.latest_run_id() if run_id is None else run_id
+        if run_id is None:
+            raise ValueError(f"There are no runs in {self.path}")
+        with self._lock:
+            dataset_column = self.connection.execute("SELECT dataset_column FROM runs WHERE run_id = ?",
+                                                     (run_id,)).fetchone()
+            frozen = pd.read_sql_query("SELECT level, uid, dataset FROM assignments WHERE run_id = ?",
+                                       self.connection, params=(run_id,))
+        if dataset_column is None:
+            raise ValueError(f"There is no run {run_id} in {self.path}")
+        frozen = frozen.pivot(index='uid', columns='level', values='dataset')
+        frozen.columns = [level_column(dataset_column[0], depth) for depth in frozen.columns]
+        return frozen
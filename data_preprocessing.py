@@ -1,3 +1,8 @@
+import hashlib
+import os
+from dataclasses import dataclass
+from typing import Callable, Tuple, Union
+
 import numpy as np
 import pandas as pd
 
@@ -15,14 +20,191 @@ def open_and_clean_data(sampling_data, df=None):
     """
     if df is None or sampling_data.filename != df.source_file.iloc[0]:
         try:
-            df = pd.read_csv(sampling_data.filename, sep='\t')
-            df = midrc_clean(df, sampling_data)
+            df = read_data_file(sampling_data.filename, '.tsv', dtype_backend=sampling_data.dtype_backend)
+            df = midrc_clean(df, sampling_data, inplace=True)
             df['source_file'] = sampling_data.filename
         except FileNotFoundError as e:
             print(f"Error reading file: {sampling_data.filename}. {e}")
             return None
     return df
 
+def data_fingerprint(df: pd.DataFrame) -> str:
+    """
+    Compute a fingerprint of the contents of a DataFrame.
+
+    Parameters:
+    - df (pandas.DataFrame): The DataFrame to be fingerprinted.
+
+    Returns:
+    - str: The hex SHA-256 digest of the column names and the row hashes of the data.
+    """
+    hasher = hashlib.sha256()
+    hasher.update('\x1f'.join(str(col) for col in df.columns).encode('utf-8'))
+    hasher.update(pd.util.hash_pandas_object(df, index=False).to_numpy().tobytes())
+    return hasher.hexdigest()
+
+# The dtype backend used when none is given: None (NumPy dtypes), 'numpy_nullable' or 'pyarrow'
+DEFAULT_DTYPE_BACKEND = os.environ.get('SAMPLING_DTYPE_BACKEND') or None
+
+
+def read_data_file(source, file_ext: str = None, *, dtype_backend: str = None, **read_options) -> pd.DataFrame:
+    """
+    Read a CSV, TSV or Excel data file.
+
+    With dtype_backend='pyarrow', every column is Arrow-backed (CSV and TSV files are also parsed by the pyarrow
+    engine), so text columns are stored in Arrow string buffers instead of one Python object per value.
+
+    Parameters:
+    - source (str or file-like): The path of the file, or an open binary file.
+    - file_ext (str): The file extension, e.g. '.tsv'. Defaults to the extension of source.
+    - dtype_backend (str): None, 'numpy_nullable' or 'pyarrow'. Defaults to DEFAULT_DTYPE_BACKEND, which is set
+      by the SAMPLING_DTYPE_BACKEND environment variable.
+    - read_options: Other options of the pandas reader, e.g. usecols, nrows or chunksize.
+
+    Returns:
+    - pandas.DataFrame: The data.
+
+    Raises:
+    - ValueError: If the file format or the dtype backend is not supported.
+    """
+    dtype_backend = dtype_backend or DEFAULT_DTYPE_BACKEND
+    if dtype_backend not in (None, 'numpy_nullable', 'pyarrow'):
+        raise ValueError(f"Unsupported dtype backend: {dtype_backend}")
+    options = dict(read_options) if dtype_backend is None else {'dtype_backend': dtype_backend, **read_options}
+    # The pyarrow CSV engine does not support reading in chunks or a limited number of rows
+    use_arrow_engine = dtype_backend == 'pyarrow' and not {'nrows', 'chunksize'} & set(read_options)
+    csv_options = {'engine': 'pyarrow', **options} if use_arrow_engine else options
+
+    # Map file extensions to corresponding pandas read functions
+    read_functions = {
+        '.xlsx': lambda file: pd.read_excel(file, **options),
+        '.xls': lambda file: pd.read_excel(file, **options),
+        '.csv': lambda file: pd.read_csv(file, **csv_options),
+        '.tsv': lambda file: pd.read_csv(file, sep='\t', **csv_options),
+    }
+
+    if file_ext is None:
+        file_ext = os.path.splitext(str(source))[1]
+    file_ext = file_ext.lower()
+    if file_ext not in read_functions:
+        raise ValueError(f"Unsupported file format: {source}")
+    return read_functions[file_ext](source)
+
+
+# How merge_batches resolves a uid found in several rows: keep the first row, keep the row of the latest batch, or fail
+DUPLICATE_POLICIES = ('first', 'latest', 'error')
+
+
+def merge_batches(batches, uid_col: str = None, *, policy: str = 'first', source_col: str = None,
+                  dtype_backend: str = None) -> pd.DataFrame:
+    """
+    Merge batch files (or DataFrames) into one DataFrame, resolving uids found in several rows.
+
+    The batches are concatenated once and the duplicate uids are found with a single hash pass over all the rows,
+    so the cost grows linearly with the total number of rows rather than with the number of pairs of batches.
+    Duplicates within a batch are resolved the same way as duplicates across batches.
+
+    Parameters:
+    - batches (list): The batch files or DataFrames, oldest first.
+    - uid_col (str): The unique identifier column. None concatenates the batches without checking for duplicates.
+    - policy (str): 'first' keeps the first row of every uid, 'latest' keeps its row from the latest batch and
+      'error' raises a ValueError if any uid is found more than once.
+    - source_col (str): When set, a column with the file name of the batch of every row (or "batch <i>").
+    - dtype_backend (str): The dtype backend used to read the files, see read_data_file.
+
+    Returns:
+    - pandas.DataFrame: The merged rows, in batch order, with a new RangeIndex.
+
+    Raises:
+    - ValueError: If the policy is unknown, or if it is 'error' and a uid is duplicated.
+    """
+    if policy not in DUPLICATE_POLICIES:
+        raise ValueError(f"Unknown duplicate policy {policy!r}, expected one of {DUPLICATE_POLICIES}")
+    names = [batch if isinstance(batch, str) else f"batch {i}" for i, batch in enumerate(batches)]
+    frames = [read_data_file(batch, dtype_backend=dtype_backend) if isinstance(batch, str) else batch
+              for batch in batches]
+    batch_of_row = np.repeat(np.arange(len(frames)), [len(frame) for frame in frames])
+    merged = pd.concat(frames, ignore_index=True)
+    if source_col is not None:
+        categories = pd.Index(names).unique()
+        merged[source_col] = pd.Categorical.from_codes(categories.get_indexer(names)[batch_of_row], categories)
+    if uid_col is None:
+        return merged
+
+    # Mark every row whose uid was already seen (keep='last' marks the earlier rows instead)
+    dupes = merged[uid_col].duplicated(keep='last' if policy == 'latest' else 'first').to_numpy()
+    if not dupes.any():
+        return merged
+
+    if policy == 'error':
+        duplicated_uids = merged.loc[dupes, uid_col].unique()
+        examples = ', '.join(str(uid) for uid in duplicated_uids[:10])
+        raise ValueError(f"{len(duplicated_uids)} uids are found in more than one row of the batches, e.g. {examples}")
+
+    dropped = np.bincount(batch_of_row[dupes], minlength=len(frames))
+    print(f"WARNING: {dupes.sum()} rows with a duplicate {uid_col} were dropped, keeping the {policy} row of each")
+    for name, count in zip(names, dropped):
+        if count:
+            print(f"    {count} rows from {name}")
+    return merged.loc[~dupes].reset_index(drop=True)
+
+
+def read_sampling_input(sampling_data, *, dtype_backend: str = None) -> pd.DataFrame:
+    """
+    Read the data of a sampling configuration: its file, or its batch files merged by uid.
+
+    Parameters:
+    - sampling_data (SamplingData): The sampling configuration. Its filename is a file or a tuple of batch files.
+    - dtype_backend (str): The dtype backend, overriding the dtype_backend of the configuration.
+
+    Returns:
+    - pandas.DataFrame: The data.
+    """
+    dtype_backend = dtype_backend or sampling_data.dtype_backend
+    if isinstance(sampling_data.filename, str):
+        return read_data_file(sampling_data.filename, dtype_backend=dtype_backend)
+    return merge_batches(sampling_data.filename, sampling_data.uid_col, policy=sampling_data.duplicate_policy,
+                         dtype_backend=dtype_backend)
+
+
+def write_data_file(df: pd.DataFrame, filename: str):
+    """
+    Write a DataFrame to a CSV or TSV file, chosen by the extension of filename (TSV unless it ends in .csv).
+
+    Arrow-backed and nullable columns are written directly, without converting the DataFrame first.
+
+    Parameters:
+    - df (pandas.DataFrame): The DataFrame to be written.
+    - filename (str): The output filename.
+    """
+    sep = ',' if filename.lower().endswith('.csv') else '\t'
+    df.to_csv(filename, sep=sep, encoding='utf-8', index=False)
+
+
+def generate_bin_labels(bins):
+    """
+    Generate the default labels for a list of bins.
+
+    Parameters:
+    - bins: list of bins to be used for the binning
+
+    Returns:
+    - list: one label per bin, e.g. '0-9' for integer bins and '>=80' for the last integer bin
+    """
+    labels = []
+    for i in range(len(bins) - 1):
+        if isinstance(bins[i], int) and isinstance(bins[i + 1], int):
+            if i < len(bins) - 2:
+                # Adjust the upper limit for integer values
+                labels.append(f"{bins[i]}-{bins[i + 1] - 1}")
+            else:
+                # Last bin with '>=' format
+                labels.append(f">={bins[i]}")
+        else:
+            # Use raw values for non-integer bins
+            labels.append(f"{bins[i]}-{bins[i + 1]}")
+    return labels
+
 def bin_dataframe_column(df_to_bin, column_name, cut_column_name='CUT', bins=None, labels=None, *, right=False):
     """
     Cuts the age column into bins and adds a column with the bin labels.
@@ -44,18 +226,7 @@ def bin_dataframe_column(df_to_bin, column_name, cut_column_name='CUT', bins=Non
             # print("Generated bins:", bins)  # Uncomment to see the generated bins
 
         if labels is None:
-            labels = []
-            for i in range(len(bins) - 1):
-                if isinstance(bins[i], int) and isinstance(bins[i + 1], int):
-                    if i < len(bins) - 2:
-                        # Adjust the upper limit for integer values
-                        labels.append(f"{bins[i]}-{bins[i + 1] - 1}")
-                    else:
-                        # Last bin with '>=' format
-                        labels.append(f">={bins[i]}")
-                else:
-                    # Use raw values for non-integer bins
-                    labels.append(f"{bins[i]}-{bins[i + 1]}")
+            labels = generate_bin_labels(bins)
             # print("Generated labels:", labels)  # Uncomment to see the generated labels
 
         df_out = df_to_bin.assign(**{
@@ -88,6 +259,56 @@ def bin_dataframe_column(df_to_bin, column_name, cut_column_name='CUT', bins=Non
 
         return df_out
 
+OUTLIER_LABELS = ('Outlier_Low', 'Outlier_High', 'Outlier')
+
+def _code_dtype(num_codes):
+    """Return the smallest signed integer dtype that can hold num_codes distinct codes."""
+    for dtype in (np.int8, np.int16, np.int32):
+        if num_codes <= np.iinfo(dtype).max:
+            return dtype
+    return np.int64
+
+def bin_column(column, edges, *, right=False):
+    """
+    Bin a numeric column into integer codes with a single np.searchsorted over its bin edges.
+
+    Values outside the bins get the codes of the 'Outlier_Low', 'Outlier_High' and 'Outlier' categories, which
+    follow the len(edges) - 1 bin codes in that order.
+
+    Parameters:
+    - column (pandas.Series): The column to be binned
+    - edges (sequence): The bin edges, in increasing order
+    - right (bool): whether to use right-inclusive intervals
+
+    Returns:
+    - numpy.ndarray: The integer code of every value
+    """
+    edges = np.asarray(edges, dtype=float)
+    values = pd.to_numeric(column, errors='coerce').to_numpy(dtype=float, na_value=np.nan)
+
+    num_bins = len(edges) - 1
+    low_code, high_code, outlier_code = num_bins, num_bins + 1, num_bins + 2
+
+    # Index of the bin each value falls in; -1 is below the first edge and num_bins is past the last one
+    bin_index = np.searchsorted(edges, values, side='left' if right else 'right') - 1
+    column_codes = np.select(
+        [np.isnan(values), values < edges[0], bin_index >= num_bins, bin_index < 0],
+        [outlier_code, low_code, high_code, outlier_code],
+        default=bin_index,
+    ).astype(_code_dtype(outlier_code))
+
+    # Report outliers using a single count over the codes
+    outlier_counts = np.bincount(column_codes, minlength=outlier_code + 1)[num_bins:]
+    if outlier_counts.any():
+        print(f"WARNING: There are values outside the bins specified for the '{column.name}' column.")
+        descriptions = ('below the minimum bin value', 'above the maximum bin value', 'outside the specified bins')
+        for label, count, description in zip(OUTLIER_LABELS, outlier_counts, descriptions):
+            if count > 0:
+                print(f"         {count} values are {description}.\n"
+                      f"         These will be placed in a new '{label}' category.")
+
+    return column_codes
+
 def convert_empty_strings(df, cols, numeric_cols, new_text="Not Reported"):
     """
     Replace empty strings in the non-numeric columns with a new text.
@@ -120,41 +341,189 @@ def fix_midrc_age(midrc_df):
     Returns:
     - pandas.DataFrame: A DataFrame with the age column fixed.
     """
-    col_name = 'age_at_index'
+    if 'age_at_index' in midrc_df.columns:
+        midrc_df['age_at_index'] = fix_midrc_age_column(midrc_df['age_at_index'], midrc_df)
+
+    return midrc_df
+
+
+@dataclass(frozen=True)
+class CleaningStep:
+    """
+    Dataclass for a column-wise cleaning step used by midrc_clean.
+
+    Attributes:
+        name (str): The name of the step.
+        func (Callable): Called as func(column, df, sampling_data) and returns the cleaned column.
+        columns (Tuple[str, ...] or Callable): The columns the step touches, or a function of the sampling data
+            that returns them. Only columns that are configured features are ever touched.
+        reads (Tuple[str, ...]): Other columns the step reads from df without modifying them.
+    """
+    name: str
+    func: Callable
+    columns: Union[Tuple[str, ...], Callable] = ()
+    reads: Tuple[str, ...] = ()
+
+    def resolve_columns(self, sampling_data) -> Tuple[str, ...]:
+        """Return the configured feature columns this step touches."""
+        columns = self.columns(sampling_data) if callable(self.columns) else self.columns
+        return tuple(col for col in columns if col in sampling_data.features)
+
+
+# Steps run by midrc_clean, in registration order
+MIDRC_CLEANING_STEPS = []
+
+
+def register_cleaning_step(name, columns, *, reads=(), steps=None):
+    """
+    Decorator that registers a column cleaning function as a CleaningStep.
+
+    Parameters:
+    - name (str): The name of the step.
+    - columns (tuple or callable): The columns the step touches, or a function of the sampling data returning them.
+    - reads (tuple): Other columns the step reads without modifying them.
+    - steps (list): The list to register the step in. Defaults to MIDRC_CLEANING_STEPS.
+
+    Returns:
+    - Callable: The decorator, which returns the function unchanged.
+    """
+    def decorator(func):
+        (MIDRC_CLEANING_STEPS if steps is None else steps).append(
+            CleaningStep(name=name, func=func, columns=columns, reads=tuple(reads)))
+        return func
+
+    return decorator
+
+
+def categorical_features(sampling_data) -> Tuple[str, ...]:
+    """Return the features of the sampling data that are not numeric columns."""
+    return tuple(col for col in sampling_data.features if col not in sampling_data.numeric_cols)
+
+
+@register_cleaning_step('empty_strings', categorical_features)
+def replace_empty_strings(column, df=None, sampling_data=None, new_text="Not Reported"):
+    """
+    Replace empty strings in a non-numeric column with a new text.
+
+    Parameters:
+    - column (pandas.Series): The column to be converted.
+    - df (pandas.DataFrame): The DataFrame the column belongs to (unused).
+    - sampling_data (SamplingData): The sampling configuration (unused).
+    - new_text (str): The text to replace empty strings with.
+
+    Returns:
+    - pandas.Series: The column with the empty strings replaced.
+    """
+    return column.replace('', new_text)
+
+
+@register_cleaning_step('midrc_age', ('age_at_index',), reads=('age_at_index_gt89',))
+def fix_midrc_age_column(column, df, sampling_data=None):
+    """
+    Fix the 'age_at_index' column of the MIDRC dataset in a single vectorized pass.
+
+    Missing ages are set to 90 when 'age_at_index_gt89' is 'Yes' and to 9999 (unknown) otherwise, and recorded
+    ages above 89 are capped at 90.
+
+    Parameters:
+    - column (pandas.Series): The 'age_at_index' column.
+    - df (pandas.DataFrame): The DataFrame the column belongs to, used to read 'age_at_index_gt89'.
+    - sampling_data (SamplingData): The sampling configuration (unused).
+
+    Returns:
+    - pandas.Series: The fixed age column.
+    """
     col_name_gt89 = 'age_at_index_gt89'
+    max_age_recorded = 89
+    age_to_set_gt = max_age_recorded + 1
+    unknown_age = 9999
 
-    if col_name in midrc_df.columns:
-        max_age_recorded = 89
-        age_to_set_gt = max_age_recorded + 1
-        # Check if 'age_at_index_gt89' exists and process accordingly
-        if col_name_gt89 in midrc_df.columns:
-            # Find rows where 'age_at_index' is NaN
-            is_na = midrc_df[col_name].isna()
+    conditions = []
+    choices = []
+    # Check if 'age_at_index_gt89' exists and process accordingly
+    if col_name_gt89 in df.columns:
+        is_na = column.isna().to_numpy()
+        is_gt89 = (df[col_name_gt89] == "Yes").to_numpy(dtype=bool, na_value=False)
+        conditions += [is_na & is_gt89, is_na & ~is_gt89]
+        choices += [age_to_set_gt, unknown_age]
 
-            # Set 'age_at_index' to 89 where 'age_at_index_gt89' is 'Yes'
-            midrc_df.loc[is_na & (midrc_df[col_name_gt89] == "Yes"), col_name] = age_to_set_gt
+    # Set the maximum age to 90 if it is greater than 89 but not unknown
+    conditions.append(((column > max_age_recorded) & (column < unknown_age)).to_numpy(dtype=bool, na_value=False))
+    choices.append(age_to_set_gt)
 
-            # Set 'age_at_index' to 9999 where 'age_at_index_gt89' is not 'Yes'
-            midrc_df.loc[is_na & (midrc_df[col_name_gt89] != "Yes"), col_name] = 9999
+    if pd.api.types.is_extension_array_dtype(column.dtype):
+        # Nullable and Arrow-backed columns: select on floats and convert back, keeping missing values missing
+        fixed = np.select(conditions, choices, default=column.to_numpy(dtype=float, na_value=np.nan))
+        return pd.Series(pd.array(fixed, dtype=column.dtype), index=column.index, name=column.name)
 
-        # Set the maximum age to 89 if it is greater than 89 but not unknown
-        midrc_df.loc[(midrc_df[col_name] > max_age_recorded) & (midrc_df[col_name] < 9999), col_name] = age_to_set_gt
+    fixed = np.select(conditions, choices, default=column.to_numpy())
+    return pd.Series(fixed, index=column.index, name=column.name)
+
+
+def column_cleaning_steps(df: pd.DataFrame, sampling_data, steps) -> dict:
+    """
+    Group cleaning steps by the columns of df they touch, keeping the step order.
+
+    Parameters:
+    - df (pandas.DataFrame): The DataFrame to be cleaned.
+    - sampling_data (SamplingData): The sampling configuration.
+    - steps (list): The CleaningStep objects to run, in order.
+
+    Returns:
+    - dict: The list of steps of every column that is touched.
+    """
+    column_steps = {}
+    for step in steps:
+        for col_name in step.resolve_columns(sampling_data):
+            if col_name in df.columns:
+                column_steps.setdefault(col_name, []).append(step)
+    return column_steps
 
-    return midrc_df
 
-def midrc_clean(midrc_df: pd.DataFrame, sampling_data) -> pd.DataFrame:
+def clean_columns(df: pd.DataFrame, sampling_data, steps, *, inplace: bool = False) -> pd.DataFrame:
+    """
+    Run cleaning steps fused into a single pass per column.
+
+    All steps touching the same column are applied back to back on that column, and each cleaned column is
+    written back exactly once. Steps always read other columns from the input values.
+
+    Parameters:
+    - df (pandas.DataFrame): The DataFrame to be cleaned.
+    - sampling_data (SamplingData): The sampling configuration.
+    - steps (list): The CleaningStep objects to run, in order.
+    - inplace (bool): Whether to write the cleaned columns into df. Otherwise, a shallow copy is returned and
+      only the cleaned columns are new.
+
+    Returns:
+    - pandas.DataFrame: The cleaned DataFrame.
+    """
+    column_steps = column_cleaning_steps(df, sampling_data, steps)
+
+    cleaned_columns = {}
+    for col_name, col_steps in column_steps.items():
+        column = df[col_name]
+        for step in col_steps:
+            column = step.func(column, df, sampling_data)
+        cleaned_columns[col_name] = column
+
+    df_out = df if inplace else df.copy(deep=False)
+    for col_name, column in cleaned_columns.items():
+        df_out[col_name] = column
+
+    return df_out
+
+
+def midrc_clean(midrc_df: pd.DataFrame, sampling_data, *, steps=None, inplace: bool = False) -> pd.DataFrame:
     """
     Clean up the MIDRC dataset.
 
     Parameters:
     - midrc_df (pandas.DataFrame): The DataFrame containing data from the MIDRC dataset.
     - sampling_data (SamplingData): The sampling configuration.
+    - steps (list): The CleaningStep objects to run. Defaults to MIDRC_CLEANING_STEPS.
+    - inplace (bool): Whether to modify midrc_df directly instead of returning a shallow copy.
 
     Returns:
     - pandas.DataFrame: A DataFrame with the MIDRC dataset cleaned up.
     """
-    midrc_df = convert_empty_strings(midrc_df, sampling_data.features, list(sampling_data.numeric_cols.keys()))
-    midrc_df = fix_midrc_age(midrc_df)
-
-    return midrc_df
-
+    return clean_columns(midrc_df, sampling_data, MIDRC_CLEANING_STEPS if steps is None else steps, inplace=inplace)
@@ -0,0 +1,85 @@
+from typing import Iterator, Tuple
+
+import numpy as np
+import pandas as pd
+
+from sampling_plan import compile_sampling_plan
+from stratified_sampling import innermost_datasets
+
+
+class FoldIndices:
+    """
+    Train, validation and test row positions of every fold of a sampling result.
+
+    The innermost dataset of every row (e.g. 'Fold 3', or 'Test') is numbered once from the categorical dataset
+    columns; every fold is then a vectorized comparison of those codes, so no DataFrame is copied or filtered. The
+    datasets whose name (at any level) is in test are held out of every fold, and every other innermost dataset is
+    one fold. Positions are integer row positions (for iloc and NumPy arrays), in row order.
+
+    This also works as a scikit-learn cross-validation splitter: split() yields (train, validation) positions and
+    get_n_splits() returns the number of folds, so it can be passed as cv= to cross_validate or GridSearchCV with
+    the rows of the result. The test positions are kept for the final evaluation.
+
+    Attributes:
+        fold_names (tuple): The name of the innermost dataset of every fold.
+        codes (numpy.ndarray): The number of the innermost dataset of every row.
+        test_indices (numpy.ndarray): The positions of the held out rows.
+    """
+
+    def __init__(self, result: pd.DataFrame, sampling_data, *, test=('Test',)):
+        plan = compile_sampling_plan(sampling_data)
+        test = {test} if isinstance(test, str) else set(test)
+        self.codes, paths = innermost_datasets(result[list(plan.level_columns)], plan)
+        is_test = np.array([bool(test.intersection(path)) for path in paths], dtype=bool)
+        self._fold_codes = [code for code, path in enumerate(paths) if not is_test[code]]
+        self.fold_names = tuple(paths[code][-1] for code in self._fold_codes)
+        self._test_mask = is_test[self.codes]
+        self.test_indices = np.flatnonzero(self._test_mask)
+
+    def __len__(self):
+        return len(self._fold_codes)
+
+    def masks(self) -> Iterator[Tuple[np.ndarray, np.ndarray, np.ndarray]]:
+        """
+        Yield the boolean (train, validation, test) masks of every fold.
+
+        The test mask is the same array for every fold and must not be modified.
+        """
+        for code in self._fold_codes:
+            val_mask = self.codes == code
+            yield ~(val_mask | self._test_mask), val_mask, self._test_mask
+
+    def __iter__(self) -> Iterator[Tuple[np.ndarray, np.ndarray, np.ndarray]]:
+        """
+        Yield the integer (train, validation, test) positions of every fold.
+
+        The test positions are the same array for every fold and must not be modified.
+        """
+        for train_mask, val_mask, _ in self.masks():
+            yield np.flatnonzero(train_mask), np.flatnonzero(val_mask), self.test_indices
+
+    def split(self, X=None, y=None, groups=None) -> Iterator[Tuple[np.ndarray, np.ndarray]]:
+        """Yield the (train, validation) positions of every fold, like a scikit-learn splitter."""
+        for train_idx, val_idx, _ in self:
+            yield train_idx, val_idx
+
+    def get_n_splits(self, X=None, y=None, groups=None) -> int:
+        """Return the number of folds, like a scikit-learn splitter."""
+        return len(self)
+
+
+def fold_indices(result: pd.DataFrame, sampling_data, *, test=('Test',), as_mask: bool = False):
+    """
+    Yield the (train, validation, test) rows of every fold of a sampling result, e.g. the '5 folds and test' split.
+
+    Parameters:
+    - result (pandas.DataFrame): The result of stratified_sampling, or its dataset columns.
+    - sampling_data (SamplingData or SamplingPlan): The sampling configuration of the result.
+    - test (str or tuple): The held out datasets. Every other innermost dataset is a fold.
+    - as_mask (bool): Whether to yield boolean masks instead of integer positions.
+
+    Returns:
+    - iterator: (train, validation, test) arrays per fold, see FoldIndices.
+    """
+    folds = FoldIndices(result, sampling_data, test=test)
+    return folds.masks() if as_mask else iter(folds)
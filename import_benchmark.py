@@ -0,0 +1,83 @@
+import argparse
+import json
+import subprocess
+import sys
+
+# The modules a headless worker imports
+CORE_MODULES = ('CONFIG', 'data_preprocessing', 'sampling_plan', 'quantile_sketch', 'stratified_sampling',
+                'sampling_pipeline', 'sampling_execution', 'result_cache', 'assignment_store')
+
+# Optional dependencies that importing the core must not pull in
+FORBIDDEN_MODULES = ('yaml', 'PySide6', 'nicegui', 'pyarrow', 'scipy', 'matplotlib', 'argparse', 'http.server')
+
+# Run in a fresh interpreter: time NumPy and pandas, which the engine cannot do without, then the module itself
+_PROBE = """
+import json, sys, time
+start = time.perf_counter()
+import numpy, pandas
+middle = time.perf_counter()
+import {module}
+end = time.perf_counter()
+print(json.dumps({{'dependencies': middle - start, 'module': end - middle, 'modules': sorted(sys.modules)}}))
+"""
+
+
+def measure_import(module: str, *, repeats: int = 5) -> dict:
+    """
+    Measure the cold import time of a module in fresh interpreters.
+
+    Parameters:
+    - module (str): The module name.
+    - repeats (int): The number of fresh interpreters; the fastest run is kept.
+
+    Returns:
+    - dict: The 'dependencies' and 'module' import times in seconds, and the 'modules' the import loaded.
+    """
+    runs = []
+    for _ in range(repeats):
+        output = subprocess.run([sys.executable, '-c', _PROBE.format(module=module)], capture_output=True,
+                                text=True, check=True).stdout
+        runs.append(json.loads(output.strip().splitlines()[-1]))
+    return min(runs, key=lambda run: run['dependencies'] + run['module'])
+
+
+def run_benchmark(modules=CORE_MODULES, *, repeats: int = 5, max_overhead_ms: float = 50.0) -> bool:
+    """
+    Check that the core modules import quickly and without the optional dependencies.
+
+    The time to import NumPy and pandas depends on the machine, so only the time spent on top of them is held to
+    max_overhead_ms.
+
+    Parameters:
+    - modules (tuple): The modules to import.
+    - repeats (int): The number of fresh interpreters per module.
+    - max_overhead_ms (float): The import time allowed on top of NumPy and pandas, in milliseconds.
+
+    Returns:
+    - bool: Whether every module passed.
+    """
+    passed = True
+    for module in modules:
+        run = measure_import(module, repeats=repeats)
+        overhead_ms = 1000 * run['module']
+        loaded = sorted(name for name in FORBIDDEN_MODULES if name in run['modules'])
+        problems = []
+        if overhead_ms > max_overhead_ms:
+            problems.append(f"slower than {max_overhead_ms:.0f} ms")
+        if loaded:
+            problems.append(f"imports {', '.join(loaded)}")
+        print(f"{module}: {overhead_ms:.1f} ms on top of {1000 * run['dependencies']:.0f} ms for NumPy and pandas"
+              + (f" ({'; '.join(problems)})" if problems else ""))
+        passed = passed and not problems
+    return passed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Check the cold import time of the headless sampling modules.')
+    parser.add_argument('modules', nargs='*', default=list(CORE_MODULES), help='The modules to import.')
+    parser.add_argument('--repeats', type=int, default=5, help='The number of fresh interpreters per module.')
+    parser.add_argument('--max-overhead-ms', type=float, default=50.0,
+                        help='The import time allowed on top of NumPy and pandas, in milliseconds.')
+    args = parser.parse_args()
+
+    sys.exit(0 if run_benchmark(args.modules, repeats=args.repeats, max_overhead_ms=args.max_overhead_ms) else 1)
@@ -0,0 +1,264 @@
+# Frozen reference copy of the original stratified sampling engine, kept unchanged so new engines can be checked
+# against it (see regression_harness.py). Do not optimize or modernize this module.
+
+import pandas as pd
+import numpy as np
+import math
+import copy
+import itertools
+
+from CONFIG import SamplingData
+
+
+def group_counts(df_in, col_name):
+    """
+    Calculate the value counts and normalize to get percentages for a given column.
+
+    Parameters:
+    - df (pandas.DataFrame): The DataFrame containing the column to be counted.
+    - col_name (str): The name of the column to be counted.
+
+    Returns:
+    - pandas.DataFrame: A DataFrame containing the counts of the column.
+    """
+    # Calculate the value counts and normalize to get percentages
+    counts = df_in[col_name].value_counts()
+
+    # Create the output DataFrame
+    df_out = pd.DataFrame({
+        col_name: counts.index,
+        'GroupCount': counts.values,
+    })
+
+    # Sort the DataFrame by the original column values
+    df_out = df_out.sort_values(by=col_name).reset_index(drop=True)
+
+    return df_out
+
+def check_for_duplicates(df_in: pd.DataFrame, uid_col: str) -> bool:
+    """
+    Check for duplicates in the 'uid_col' column.
+
+    Parameters:
+    - df_in (pandas.DataFrame): The DataFrame containing the column to be checked.
+    - uid_col (str): The name of the column to be checked.
+
+    Returns:
+    - bool: True if there are duplicates, False otherwise.
+    """
+    # Check for duplicates in the 'uid_col' column
+    dupes = df_in[uid_col].duplicated(keep=False)  # Mark all duplicates, including first occurrences
+
+    # If there are duplicates
+    if dupes.any():
+        # Count the number of duplicates
+        num_dupes = dupes.sum()
+        print(f"WARNING: {num_dupes} duplicate cases in batch \n")
+
+        # Get the duplicate rows
+        datadup = df_in[dupes]
+        print(f"Duplicate rows: {datadup.shape[0]}")
+
+        # Get the unique values in the 'uid_col' column
+        uid_list = datadup[uid_col].unique()
+
+        # Create a dictionary to store the counts of each unique value
+        counts = dict(zip(uid_list, datadup[uid_col].value_counts().to_list()))
+
+        # Print the counts
+        for uid, count in counts.items():
+            print(f"{uid}: {count}")
+
+    return dupes.any()
+
+
+def stratified_sampling(data_in: pd.DataFrame, sampling_data: SamplingData, view_stats=False) -> pd.DataFrame:
+    """
+    Perform stratified sampling on a DataFrame.
+
+    Parameters:
+    - data (pandas.DataFrame): The DataFrame to be sampled.
+    - sampling_data (SamplingData): The sampling configuration.
+    - view_stats (bool): Whether to view the statistics of the sampling.
+
+    Returns:
+    - pandas.DataFrame: The sampled DataFrame.
+    """
+    numeric_cols = sampling_data.numeric_cols
+    """ 
+    # I don't think this is necessary anymore
+    if len(sampling_data.numeric_cols) == 0:
+        numeric_cols = {'age_at_index':
+                            {'bins': None,
+                             'labels': None}}
+    """
+
+    uid_col = sampling_data.uid_col
+    cols = sampling_data.features
+
+    data_in[uid_col] = data_in[uid_col].astype(str)
+
+    # Check for duplicates - If warning presents, go to merge batch
+    check_for_duplicates(data_in, uid_col)
+
+    # Convert numeric columns to numeric type and non-numeric columns to string type
+    for col_name in cols:
+        if col_name in numeric_cols:
+            data_in[col_name] = pd.to_numeric(data_in[col_name], errors='coerce')
+        else:
+            data_in[col_name] = data_in[col_name].astype(str)
+
+    # Copy the original data to a new dataframe
+    final_table = copy.copy(data_in)
+
+    # Separate numeric groups into categories based on bin cutoff values
+    cut_suffix = "_CUT" if len(numeric_cols) > 0 else ""
+    for col_name, bin_info in numeric_cols.items():
+        data_in = bin_dataframe_column(data_in,
+                                       column_name=col_name,
+                                       cut_column_name=col_name + cut_suffix,
+                                       bins=bin_info['bins'],
+                                       labels=bin_info['labels'])
+        # We can use this to check the distribution of the binned column
+        # print(data[col_name + cut_suffix].value_counts(dropna=False))
+
+    ## Stratified sampling process
+
+    # Gather stats using a dictionary comprehension
+    stats_dict = {
+        (f"{col_name}{cut_suffix}" if col_name in numeric_cols else col_name): group_counts(data_in,
+         f"{col_name}{cut_suffix}" if col_name in numeric_cols else col_name)
+        for col_name in cols
+    }
+
+    if view_stats:
+        for val in stats_dict.values():
+            print(val)
+            print('\n')
+
+    # Generate all possible combinations of variables in the dataset
+    possible_combos = list(itertools.product(*(stats_dict[stat].iloc[:, 0].to_list() for stat in stats_dict)))
+
+    # print(f'There are a total of {len(possible_combos)} combinations of variables in this dataset.')
+    # print('Beginning stratified sampling.')
+
+    for var_selections in possible_combos:
+        # Filter the data based on the current combination of variable selections
+        temp_df = data_in
+        for j, col_name in enumerate(cols):
+            filter_col = col_name + cut_suffix if col_name in numeric_cols else col_name
+            temp_df = temp_df.loc[temp_df[filter_col] == var_selections[j]]
+
+        if not temp_df.empty:
+            total_fraction = sum(sampling_data.datasets.values())
+            dataset_split_dict = {}
+            for dataset, fraction in sampling_data.datasets.items():
+                item_split = fraction * len(temp_df) / total_fraction
+                dataset_split_dict[dataset] = {'num_items': math.floor(item_split),
+                                               'remainder': item_split - math.floor(item_split),
+                                               }
+
+            # Shuffle the DataFrame
+            temp_df_shuffled = temp_df.sample(frac=1).reset_index(drop=True)
+            start_index = 0
+            for dataset, split_dict in dataset_split_dict.items():
+                split_index = start_index + split_dict['num_items']
+                dataset_ids = temp_df_shuffled.iloc[start_index:split_index][uid_col]
+
+                # Vectorized assignment to final_table based on dataset_ids
+                final_table.loc[final_table[uid_col].isin(dataset_ids), sampling_data.dataset_column] = dataset
+                start_index = split_index
+
+            # Handle the remainder of the dataset if any items are left
+            while start_index < len(temp_df_shuffled):
+                total_remainder = sum([v['remainder'] for v in dataset_split_dict.values()])
+                single_choice = np.random.choice(
+                                     list(dataset_split_dict.keys()),
+                                     p=[v['remainder']/total_remainder for v in dataset_split_dict.values()]
+                                     )
+                final_table.loc[final_table[uid_col] == temp_df_shuffled.iloc[start_index][uid_col], sampling_data.dataset_column] = single_choice
+                dataset_split_dict.pop(single_choice)
+                start_index += 1
+
+
+    # print('Sampling complete. Saving Results...')
+    # print(FinalTable[sampling_data.dataset_column].value_counts(dropna=False))
+
+    # Check for unassigned cases
+    idx = final_table.index[final_table[sampling_data.dataset_column] == ""].tolist()
+    if len(idx) > 0:
+        first_dataset = list(sampling_data.datasets.keys())[0]
+        print("Warning: " + str(len(idx)) + " cases did not fall in sequestration criteria \n")
+        print("Assigning to " + first_dataset + " dataset \n")
+        final_table.loc[idx, sampling_data.dataset_column] = first_dataset
+
+        print('Total number of cases in this category after assignment: ',
+              str(len(final_table[final_table[sampling_data.dataset_column] == first_dataset])))
+
+    return final_table
+
+
+def bin_dataframe_column(df_to_bin, column_name, cut_column_name='CUT', bins=None, labels=None, *, right=False):
+    """
+    Cuts the age column into bins and adds a column with the bin labels.
+
+    Parameters:
+    - df_to_bin: pandas DataFrame containing the data
+    - column_name: name of the column to be binned
+    - cut_column_name: name of the column to be added with the bin labels
+    - bins: list of bins to be used for the binning
+    - labels: list of labels for the bins
+    - right: whether to use right-inclusive intervals
+
+    Returns:
+    - df: pandas DataFrame with the binned column and the labels
+    """
+    if column_name in df_to_bin.columns:
+        if bins is None:
+            bins = np.arange(0, 100, 10)  # Default bins
+            # print("Generated bins:", bins)  # Uncomment to see the generated bins
+
+        if labels is None:
+            labels = []
+            for i in range(len(bins) - 1):
+                if isinstance(bins[i], int) and isinstance(bins[i + 1], int):
+                    if i < len(bins) - 2:
+                        # Adjust the upper limit for integer values
+                        labels.append(f"{bins[i]}-{bins[i + 1] - 1}")
+                    else:
+                        # Last bin with '>=' format
+                        labels.append(f">={bins[i]}")
+                else:
+                    # Use raw values for non-integer bins
+                    labels.append(f"{bins[i]}-{bins[i + 1]}")
+            # print("Generated labels:", labels)  # Uncomment to see the generated labels
+
+        df_out = df_to_bin.assign(**{
+            cut_column_name: pd.cut(
+                df_to_bin[column_name],
+                bins=bins,
+                labels=labels,
+                right=right  # Use right=False for left-inclusive intervals
+            ).astype('string')
+        })
+
+        # Check for outliers and assign them to a new category
+        if df_out[cut_column_name].isna().any():
+            new_text = "Outlier"
+            low_text = new_text + "_Low"
+            high_text = new_text + "_High"
+            print(f"WARNING: There are values outside the bins specified for the '{column_name}' column.")
+            df_out.loc[df_out[cut_column_name].isna() & (df_out[column_name] < bins[0]), cut_column_name] = low_text
+            df_out.loc[df_out[cut_column_name].isna() & (df_out[column_name] >= bins[-1]), cut_column_name] = high_text
+            df_out.loc[df_out[cut_column_name].isna(), cut_column_name] = new_text
+            if (df_out[cut_column_name] == low_text).sum() > 0:
+                print(f"         {(df_out[cut_column_name] == low_text).sum()} values are below the minimum bin value.\n" 
+                      f"         These will be placed in a new '{low_text}' category.")
+            if (df_out[cut_column_name] == high_text).sum() > 0:
+                print(f"         {(df_out[cut_column_name] == high_text).sum()} values are above the maximum bin value.\n" 
+                      f"         These will be placed in a new '{high_text}' category.")
+            if (df_out[cut_column_name] == new_text).sum() > 0:
+                print(f"         {(df_out[cut_column_name] == new_text).sum()} values are outside the specified bins.\n" 
+                      f"         These will be placed in a new '{new_text}' category.")
+
+        return df_out
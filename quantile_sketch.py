@@ -0,0 +1,250 @@
+from dataclasses import replace
+
+import numpy as np
+import pandas as pd
+
+from sampling_plan import compile_sampling_plan
+
+# The number of values added to a sketch at once; larger inputs are added in blocks of this size
+_BLOCK_SIZE = 1 << 20
+
+
+class QuantileSketch:
+    """
+    Mergeable streaming sketch of the approximate quantiles of a numeric column (a KLL sketch).
+
+    Values are kept in a hierarchy of compactors: level h holds sorted values that each stand for 2**h values of
+    the input. When the sketch is full, the lowest full level is sorted and every other value, starting at a random
+    offset, is promoted to the next level, so the memory stays O(k log(n / k)) for n values while the rank error of a
+    quantile stays within about 2 / k of n. Two sketches of different parts of the data (chunks of a file, or batch
+    files) are merged level by level into a sketch of all of it, so no column is ever sorted as a whole.
+
+    The offsets are drawn from a generator seeded with seed, so the same values in the same order always give the
+    same quantiles.
+
+    Attributes:
+        k (int): The accuracy parameter, the capacity of the top level.
+        count (int): The number of values added, missing values excluded.
+        min (float): The smallest value added.
+        max (float): The largest value added.
+        integral (bool): Whether every value added is a whole number.
+    """
+
+    def __init__(self, k: int = 200, *, seed: int = 0):
+        if k < 8:
+            raise ValueError(f"The accuracy parameter k must be at least 8, got {k}")
+        self.k = k
+        self.count = 0
+        self.min = np.inf
+        self.max = -np.inf
+        self.integral = True
+        self._levels = [np.empty(0)]
+        self._rng = np.random.default_rng(seed)
+
+    def __len__(self):
+        return self.count
+
+    def _capacity(self, level: int) -> int:
+        """The capacity of a level: k at the top, shrinking by 2/3 per level below it."""
+        depth = len(self._levels) - 1 - level
+        return max(2, int(np.ceil(self.k * (2 / 3) ** depth)))
+
+    def update(self, values) -> 'QuantileSketch':
+        """
+        Add values to the sketch. Values that are not numeric are ignored, like missing values.
+
+        Parameters:
+        - values (array-like or pandas.Series): The values.
+
+        Returns:
+        - QuantileSketch: The sketch itself.
+        """
+        values = pd.to_numeric(pd.Series(values, copy=False), errors='coerce').to_numpy(dtype=float, na_value=np.nan)
+        for start in range(0, len(values), _BLOCK_SIZE):
+            block = values[start:start + _BLOCK_SIZE]
+            block = block[~np.isnan(block)]
+            if not len(block):
+                continue
+            self.count += len(block)
+            self.min = min(self.min, float(block.min()))
+            self.max = max(self.max, float(block.max()))
+            self.integral = self.integral and bool((block == np.floor(block)).all())
+            self._levels[0] = np.concatenate([self._levels[0], block])
+            self._compress()
+        return self
+
+    def merge(self, other: 'QuantileSketch') -> 'QuantileSketch':
+        """
+        Merge another sketch into this one, as if its values had been added to this sketch.
+
+        Parameters:
+        - other (QuantileSketch): A sketch with the same k.
+
+        Returns:
+        - QuantileSketch: This sketch.
+        """
+        if other.k != self.k:
+            raise ValueError(f"Cannot merge sketches with different accuracy parameters ({self.k} and {other.k})")
+        while len(self._levels) < len(other._levels):
+            self._levels.append(np.empty(0))
+        for level, items in enumerate(other._levels):
+            self._levels[level] = np.concatenate([self._levels[level], items])
+        self.count += other.count
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        self.integral = self.integral and other.integral
+        self._compress()
+        return self
+
+    def _compress(self):
+        """Compact the lowest full levels until the sketch fits its capacity."""
+        while sum(len(items) for items in self._levels) > sum(map(self._capacity, range(len(self._levels)))):
+            level = next(level for level, items in enumerate(self._levels) if len(items) >= self._capacity(level))
+            if level == len(self._levels) - 1:
+                self._levels.append(np.empty(0))
+            items = np.sort(self._levels[level])
+            # An odd value out stays at this level, so the total weight is kept exactly
+            kept = items[len(items) - len(items) % 2:]
+            promoted = items[int(self._rng.integers(2)):len(items) - len(items) % 2:2]
+            self._levels[level] = kept
+            self._levels[level + 1] = np.concatenate([self._levels[level + 1], promoted])
+
+    def quantiles(self, fractions) -> np.ndarray:
+        """
+        Estimate the quantiles of the values added.
+
+        Parameters:
+        - fractions (array-like): The fractions, between 0 and 1.
+
+        Returns:
+        - numpy.ndarray: The value at every fraction; the minimum at 0 and the maximum at 1.
+        """
+        fractions = np.asarray(fractions, dtype=float)
+        if not self.count:
+            raise ValueError("Cannot compute quantiles of an empty sketch")
+        items = np.concatenate(self._levels)
+        weights = np.concatenate([np.full(len(items), 2 ** level, dtype=np.int64)
+                                  for level, items in enumerate(self._levels)])
+        order = np.argsort(items, kind='stable')
+        items, ranks = items[order], np.cumsum(weights[order])
+        positions = np.searchsorted(ranks, fractions * ranks[-1], side='right')
+        result = items[np.minimum(positions, len(items) - 1)]
+        result = np.where(fractions <= 0, self.min, np.where(fractions >= 1, self.max, result))
+        return result
+
+
+def sketch_columns(data, columns, *, k: int = 200) -> dict:
+    """
+    Sketch the quantiles of numeric columns of a DataFrame, or of a stream of DataFrames (chunks or batches).
+
+    Parameters:
+    - data (pandas.DataFrame or iterable): The data, or an iterable of DataFrames with the columns.
+    - columns (iterable): The columns to sketch.
+    - k (int): The accuracy parameter of the sketches.
+
+    Returns:
+    - dict: The QuantileSketch of every column.
+    """
+    sketches = {column: QuantileSketch(k) for column in columns}
+    for chunk in ([data] if isinstance(data, pd.DataFrame) else data):
+        for column, sketch in sketches.items():
+            sketch.update(chunk[column])
+    return sketches
+
+
+def quantile_edges(sketch: QuantileSketch, spec: dict) -> list:
+    """
+    Compute bin edges from a sketch for a {'quantiles': k} or {'min_count': n} bins specification.
+
+    With quantiles, the values are cut at the k-quantiles; with min_count, into as many quantile bins as can hold
+    about n values each. Tied quantiles are merged, so there may be fewer bins than asked for. The first edge is the
+    minimum and the last is just above the maximum, so no value is an outlier. Edges of whole-number columns are
+    whole numbers.
+
+    Parameters:
+    - sketch (QuantileSketch): The sketch of the column.
+    - spec (dict): The bins specification.
+
+    Returns:
+    - list: The bin edges, in increasing order.
+    """
+    if 'quantiles' in spec:
+        num_bins = int(spec['quantiles'])
+    else:
+        num_bins = max(1, sketch.count // int(spec['min_count']))
+    inner = sketch.quantiles(np.arange(1, num_bins) / num_bins)
+    if sketch.integral:
+        edges = sorted({int(sketch.min), *(int(edge) for edge in inner)} | {int(sketch.max) + 1})
+    else:
+        edges = sorted({sketch.min, *(float(edge) for edge in inner)} | {float(np.nextafter(sketch.max, np.inf))})
+    return edges
+
+
+def quantile_labels(edges) -> list:
+    """Return the labels of quantile bins: like generate_bin_labels for whole numbers, rounded otherwise."""
+    if all(isinstance(edge, int) for edge in edges):
+        return [f"{low}-{high - 1}" if high - 1 > low else f"{low}" for low, high in zip(edges[:-2], edges[1:-1])] \
+            + [f">={edges[-2]}"]
+    return [f"{low:.4g}-{high:.4g}" for low, high in zip(edges[:-2], edges[1:-1])] + [f">={edges[-2]:.4g}"]
+
+
+def resolve_data_bins(sampling_data, data):
+    """
+    Compute the bins of the numeric features configured as {'quantiles': k} or {'min_count': n} from the data.
+
+    The data is only scanned through quantile sketches, so it may be an iterable of chunks of a file, or batch
+    files, as well as a DataFrame. The data must be cleaned, as the binned values are.
+
+    Parameters:
+    - sampling_data (SamplingData or SamplingPlan): The sampling configuration.
+    - data (pandas.DataFrame, iterable or dict): The cleaned data, an iterable of cleaned DataFrames, or the
+      QuantileSketch of every column (see sketch_columns), e.g. merged from the sketches of several files.
+
+    Returns:
+    - SamplingPlan: The plan with the bin edges and labels of every numeric feature. A plan without bins computed
+      from the data is returned unchanged.
+    """
+    plan = compile_sampling_plan(sampling_data)
+    unresolved = [binning for binning in plan.numeric if binning.data_bins]
+    if not unresolved:
+        return plan
+
+    sketches = data if isinstance(data, dict) else sketch_columns(data, [binning.column for binning in unresolved])
+    resolved = {}
+    for binning in unresolved:
+        spec = dict(binning.data_bins)
+        sketch = sketches[binning.column]
+        if not sketch.count:
+            raise ValueError(f"Cannot compute the bins of '{binning.column}': it has no numeric values")
+        edges = quantile_edges(sketch, spec)
+        labels = quantile_labels(edges)
+        print(f"Bins of '{binning.column}' from {spec}: {edges}")
+        resolved[binning.column] = replace(binning, edges=tuple(float(edge) for edge in edges),
+                                           labels=tuple(labels) + binning.labels, data_bins=())
+    return replace(plan, numeric=tuple(resolved.get(binning.column, binning) for binning in plan.numeric))
+
+
+def apply_data_bins(sampling_data, data_bins: dict):
+    """
+    Bin the numeric features configured as {'quantiles': k} or {'min_count': n} with the bins of an earlier run.
+
+    New batches of an incremental run are then binned like the cases whose assignments they extend, instead of by
+    the quantiles of the new data.
+
+    Parameters:
+    - sampling_data (SamplingData or SamplingPlan): The sampling configuration.
+    - data_bins (dict): The {'bins': edges, 'labels': labels} of every column, see AssignmentStore.data_bins.
+
+    Returns:
+    - SamplingPlan: The plan with the earlier bins of the columns found in data_bins; the other columns are unchanged.
+    """
+    plan = compile_sampling_plan(sampling_data)
+    numeric = []
+    for binning in plan.numeric:
+        if binning.data_bins and binning.column in data_bins:
+            edges = tuple(float(edge) for edge in data_bins[binning.column]['bins'])
+            print(f"Bins of '{binning.column}' from the earlier run: {list(edges)}")
+            binning = replace(binning, edges=edges, data_bins=(),
+                              labels=tuple(data_bins[binning.column]['labels']) + binning.labels)
+        numeric.append(binning)
+    return replace(plan, numeric=tuple(numeric))
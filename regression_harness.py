@@ -0,0 +1,330 @@
+import argparse
+import contextlib
+import dataclasses
+import io
+import math
+import sys
+
+import numpy as np
+import pandas as pd
+
+import legacy_sampling
+from CONFIG import SamplingData
+from sampling_pipeline import SamplingPipeline
+from sampling_plan import compile_sampling_plan
+from stratified_sampling import nested_assignment, stratified_assignment
+from swap_optimizer import swap_optimize
+
+
+def reference_engine(df: pd.DataFrame, sampling_data: SamplingData, seed: int) -> pd.Series:
+    """Run the frozen original engine, which draws from the global NumPy random state."""
+    np.random.seed(seed)
+    with contextlib.redirect_stdout(io.StringIO()):
+        result = legacy_sampling.stratified_sampling(df.copy(), sampling_data)
+    return result[sampling_data.dataset_column]
+
+
+# Candidate engines, called as engine(df, sampling_data, seed) and returning the dataset of every row of df
+CANDIDATES = {
+    'stratified_assignment': lambda df, sampling_data, seed: stratified_assignment(df, sampling_data, rng=seed),
+    'pipeline': lambda df, sampling_data, seed: SamplingPipeline(df, steps=[]).run(
+        sampling_data, rng=seed)[sampling_data.dataset_column],
+    'global_allocation': lambda df, sampling_data, seed: stratified_assignment(
+        df, dataclasses.replace(sampling_data, allocation='global'), rng=seed),
+}
+
+
+def synthetic_case(rng: np.random.Generator, *, unique_combinations: bool = False, no_features: bool = False):
+    """
+    Generate a random table and sampling configuration.
+
+    The table has a uid, one to three skewed categorical features and an 'age' feature with missing values and
+    outliers. With unique_combinations, the table is small and has a single feature with a distinct value in every
+    row, so every row is its own stratum (the original engine is too slow for many unique combinations). With
+    no_features, no feature is configured, so all rows are a single stratum.
+
+    Parameters:
+    - rng (numpy.random.Generator): The random generator.
+    - unique_combinations (bool): Whether every row should have a unique combination of features.
+    - no_features (bool): Whether the configuration has no stratification features.
+
+    Returns:
+    - tuple: (df, sampling_data)
+    """
+    num_rows = int(rng.integers(12, 30)) if unique_combinations else int(rng.integers(40, 400))
+    df = pd.DataFrame({'uid': [f"case_{i}" for i in range(num_rows)]})
+    features = []
+    for i in range(int(rng.integers(1, 4))):
+        num_levels = int(rng.integers(2, 5))
+        probabilities = rng.dirichlet(np.ones(num_levels))
+        df[f"cat_{i}"] = rng.choice([f"level_{j}" for j in range(num_levels)], size=num_rows, p=probabilities)
+        features.append(f"cat_{i}")
+
+    ages = rng.integers(-5, 110, size=num_rows).astype(float)
+    ages[rng.random(num_rows) < 0.05] = np.nan
+    df['age'] = ages
+    features.append('age')
+    if unique_combinations:
+        df['cat_0'] = [f"level_{i}" for i in range(num_rows)]
+        features = ['cat_0']
+    if no_features:
+        features = []
+
+    num_datasets = int(rng.integers(2, 5))
+    datasets = {f"Set {j}": float(fraction) for j, fraction in enumerate(rng.integers(1, 10, size=num_datasets))}
+    numeric_cols = {'age': {'bins': [0, 18, 50, 65, 90], 'labels': None}}
+    sampling_data = SamplingData(filename='', dataset_column='dataset', features=tuple(features), title='synthetic',
+                                 datasets=datasets, numeric_cols=numeric_cols, uid_col='uid')
+    return df, sampling_data
+
+
+def reference_strata(df: pd.DataFrame, sampling_data: SamplingData) -> np.ndarray:
+    """Number the strata of every row with the binning of the original engine, independently of any candidate."""
+    if not sampling_data.features:
+        return np.zeros(len(df), dtype=np.int64)
+    keys = {}
+    for col_name in sampling_data.features:
+        if col_name in sampling_data.numeric_cols:
+            bin_info = sampling_data.numeric_cols[col_name]
+            with contextlib.redirect_stdout(io.StringIO()):
+                binned = legacy_sampling.bin_dataframe_column(pd.DataFrame({col_name: df[col_name]}), col_name,
+                                                              bins=bin_info['bins'], labels=bin_info['labels'])
+            keys[col_name] = binned['CUT'].astype(str).to_numpy()
+        else:
+            keys[col_name] = df[col_name].astype(str).to_numpy()
+    return pd.DataFrame(keys).groupby(list(keys), sort=False).ngroup().to_numpy()
+
+
+def check_invariants(df: pd.DataFrame, sampling_data: SamplingData, assignment: pd.Series, strata: np.ndarray):
+    """
+    Check the exact invariants of a stratified assignment.
+
+    - Every row is assigned exactly once, to a configured dataset. The original engine puts any row left without a
+      dataset (e.g. a unique combination that no split reached) in the first dataset, so no row may be missing.
+    - Every stratum gives every dataset the floor of its share, or one more, and the extra rows add up to the
+      stratum size.
+
+    Parameters:
+    - df (pandas.DataFrame): The sampled table.
+    - sampling_data (SamplingData): The sampling configuration.
+    - assignment (pandas.Series): The dataset of every row.
+    - strata (numpy.ndarray): The stratum of every row, see reference_strata.
+
+    Returns:
+    - tuple: (failures, extras) where failures is a list of messages and extras counts the rows every
+      (stratum, dataset) received above the floor of its share
+    """
+    names = list(sampling_data.datasets)
+    weights = np.array(list(sampling_data.datasets.values()), dtype=float)
+    weights /= weights.sum()
+    failures = []
+
+    if len(assignment) != len(df) or not assignment.index.equals(df.index):
+        failures.append("the assignment is not indexed like the input")
+        return failures, None
+    codes = pd.Categorical(assignment, categories=names).codes
+    if (codes < 0).any():
+        failures.append(f"{(codes < 0).sum()} rows are unassigned or assigned to unknown datasets")
+        return failures, None
+
+    num_strata = int(strata.max()) + 1
+    counts = np.zeros((num_strata, len(names)), dtype=np.int64)
+    np.add.at(counts, (strata, codes), 1)
+    shares = counts.sum(axis=1)[:, None] * weights[None, :]
+    extras = counts - np.floor(shares + 1e-9).astype(np.int64)
+    if (extras < 0).any() or (extras > 1).any():
+        bad = np.flatnonzero(((extras < 0) | (extras > 1)).any(axis=1))
+        failures.append(f"{len(bad)} strata have dataset counts outside floor(share) and floor(share) + 1")
+    return failures, extras
+
+
+def chi2_sf(statistic: float, dof: int) -> float:
+    """Approximate the upper tail probability of a chi-square distribution (Wilson-Hilferty)."""
+    if dof <= 0:
+        return 1.0
+    z = ((statistic / dof) ** (1 / 3) - (1 - 2 / (9 * dof))) / math.sqrt(2 / (9 * dof))
+    return 0.5 * math.erfc(z / math.sqrt(2))
+
+
+def homogeneity_statistic(reference: np.ndarray, candidate: np.ndarray):
+    """
+    Chi-square test that the extra rows of every stratum go to the datasets with the same frequencies.
+
+    Parameters:
+    - reference (numpy.ndarray): The extra rows per (stratum, dataset) of the reference, summed over seeds.
+    - candidate (numpy.ndarray): The same for the candidate.
+
+    Returns:
+    - tuple: (statistic, dof) summed over the strata
+    """
+    statistic, dof = 0.0, 0
+    for ref_row, cand_row in zip(reference, candidate):
+        table = np.array([ref_row, cand_row], dtype=float)
+        table = table[:, table.sum(axis=0) > 0]
+        if table.shape[1] < 2 or (table.sum(axis=1) == 0).any():
+            continue
+        expected = table.sum(axis=1, keepdims=True) * table.sum(axis=0, keepdims=True) / table.sum()
+        statistic += float(((table - expected) ** 2 / expected).sum())
+        dof += table.shape[1] - 1
+    return statistic, dof
+
+
+def run_harness(candidates: dict, *, num_cases: int = 6, num_seeds: int = 50, seed: int = 0,
+                alpha: float = 1e-3) -> bool:
+    """
+    Compare candidate engines to the frozen original engine on random synthetic tables.
+
+    Every engine must pass the exact invariants on every case and seed, and the datasets receiving the remainder
+    rows of every stratum must not differ significantly from the reference over all seeds.
+
+    Parameters:
+    - candidates (dict): The candidate engines by name, see CANDIDATES.
+    - num_cases (int): The number of synthetic tables. The last one has only unique combinations, and one more
+      table without any feature is added.
+    - num_seeds (int): The number of seeds every engine runs with on every table.
+    - seed (int): The seed of the synthetic tables.
+    - alpha (float): The significance level of the statistical comparison.
+
+    Returns:
+    - bool: Whether every candidate passed.
+    """
+    rng = np.random.default_rng(seed)
+    cases = [synthetic_case(rng, unique_combinations=(i == num_cases - 1)) for i in range(num_cases)]
+    cases.append(synthetic_case(rng, no_features=True))
+    engines = {'reference': reference_engine, **candidates}
+    failures = {name: [] for name in engines}
+    statistics = {name: [0.0, 0] for name in candidates}
+
+    for case_index, (df, sampling_data) in enumerate(cases):
+        strata = reference_strata(df, sampling_data)
+        tallies = {}
+        for name, engine in engines.items():
+            tally = 0
+            for run_seed in range(num_seeds):
+                with contextlib.redirect_stdout(io.StringIO()):
+                    assignment = engine(df, sampling_data, run_seed)
+                case_failures, extras = check_invariants(df, sampling_data, assignment, strata)
+                failures[name] += [f"case {case_index}, seed {run_seed}: {failure}" for failure in case_failures]
+                if extras is not None:
+                    tally = tally + extras
+            tallies[name] = tally
+        print(f"Case {case_index}: {len(df)} rows, {strata.max() + 1} strata, "
+              f"{len(sampling_data.datasets)} datasets {list(sampling_data.datasets.values())}")
+
+        for name in candidates:
+            if isinstance(tallies[name], np.ndarray) and isinstance(tallies['reference'], np.ndarray):
+                statistic, dof = homogeneity_statistic(tallies['reference'], tallies[name])
+                statistics[name][0] += statistic
+                statistics[name][1] += dof
+
+    passed = True
+    for name in engines:
+        status = 'ok' if not failures[name] else f"{len(failures[name])} invariant failures"
+        line = f"{name}: invariants {status}"
+        if name in statistics:
+            statistic, dof = statistics[name]
+            p_value = chi2_sf(statistic, dof)
+            line += f", remainder allocation chi2 = {statistic:.1f} on {dof} dof, p = {p_value:.3g}"
+            if p_value < alpha:
+                line += " (differs from reference)"
+                passed = False
+        print(line)
+        for failure in failures[name][:10]:
+            print(f"    {failure}")
+        passed = passed and not failures[name]
+
+    return passed
+
+
+def check_nested_quotas(levels: pd.DataFrame, sampling_data, strata: np.ndarray) -> list:
+    """
+    Check that every stratum gives every dataset of every level the floor of its share of the stratum rows in the
+    parent dataset, or one more.
+
+    Parameters:
+    - levels (pandas.DataFrame): The dataset columns of every level, see nested_assignment.
+    - sampling_data (SamplingData): The sampling configuration, with nested datasets.
+    - strata (numpy.ndarray): The stratum of every row, see reference_strata.
+
+    Returns:
+    - list: The failure messages.
+    """
+    plan = compile_sampling_plan(sampling_data)
+    num_strata = int(strata.max()) + 1
+    failures = []
+
+    def check(rows, node, depth):
+        column = plan.level_columns[depth]
+        codes = pd.Categorical(levels[column].to_numpy()[rows], categories=list(node.names)).codes
+        if (codes < 0).any():
+            failures.append(f"{(codes < 0).sum()} rows have no dataset in '{column}'")
+            return
+        counts = np.zeros((num_strata, len(node.names)), dtype=np.int64)
+        np.add.at(counts, (strata[rows], codes), 1)
+        shares = counts.sum(axis=1)[:, None] * np.asarray(node.weights)[None, :]
+        outside = (counts < np.floor(shares + 1e-9)) | (counts > np.ceil(shares - 1e-9))
+        if outside.any():
+            failures.append(f"{outside.any(axis=1).sum()} strata are outside their quotas in the split of "
+                            f"{node.names}")
+        for position, child in enumerate(node.children):
+            if child is not None:
+                check(rows[codes == position], child, depth + 1)
+
+    check(np.arange(len(levels)), plan.split, 0)
+    return failures
+
+
+def check_nested_swaps(*, num_cases: int = 4, num_seeds: int = 10, seed: int = 0) -> bool:
+    """
+    Check that the swap optimizer keeps the size of every dataset and the stratum quotas at every level of a
+    two-level split, in which the first dataset is split again into folds.
+
+    Parameters:
+    - num_cases (int): The number of synthetic tables.
+    - num_seeds (int): The number of seeds the split and the swaps run with on every table.
+    - seed (int): The seed of the synthetic tables.
+
+    Returns:
+    - bool: Whether every check passed.
+    """
+    rng = np.random.default_rng(seed)
+    failures = []
+    for case_index in range(num_cases):
+        df, sampling_data = synthetic_case(rng)
+        names = list(sampling_data.datasets)
+        folds = {f"Fold {j}": float(fraction) for j, fraction in enumerate(rng.integers(1, 10, size=3))}
+        datasets = {names[0]: {'fraction': sampling_data.datasets[names[0]], 'datasets': folds},
+                    **{name: sampling_data.datasets[name] for name in names[1:]}}
+        sampling_data = dataclasses.replace(sampling_data, datasets=datasets)
+        level_columns = list(compile_sampling_plan(sampling_data).level_columns)
+        strata = reference_strata(df, sampling_data)
+        for run_seed in range(num_seeds):
+            with contextlib.redirect_stdout(io.StringIO()):
+                result = df.join(nested_assignment(df, sampling_data, rng=run_seed))
+                swapped, _ = swap_optimize(result, sampling_data, rng=run_seed)
+            for column in level_columns:
+                if not result[column].value_counts().equals(swapped[column].value_counts()):
+                    failures.append(f"case {case_index}, seed {run_seed}: the dataset sizes of '{column}' changed")
+            failures += [f"case {case_index}, seed {run_seed}: {failure}"
+                         for failure in check_nested_quotas(swapped[level_columns], sampling_data, strata)]
+
+    print(f"swap_optimize (nested): invariants {'ok' if not failures else f'{len(failures)} failures'}")
+    for failure in failures[:10]:
+        print(f"    {failure}")
+    return not failures
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Check sampling engines against the frozen original engine.')
+    parser.add_argument('--cases', type=int, default=6, help='The number of synthetic tables.')
+    parser.add_argument('--seeds', type=int, default=50, help='The number of seeds per table and engine.')
+    parser.add_argument('--seed', type=int, default=0, help='The seed of the synthetic tables.')
+    parser.add_argument('--alpha', type=float, default=1e-3, help='The significance level.')
+    parser.add_argument('--engine', action='append', choices=sorted(CANDIDATES),
+                        help='The candidate engines to check (default: all).')
+    args = parser.parse_args()
+
+    selected = {name: CANDIDATES[name] for name in (args.engine or CANDIDATES)}
+    passed = run_harness(selected, num_cases=args.cases, num_seeds=args.seeds, seed=args.seed, alpha=args.alpha)
+    passed = check_nested_swaps(seed=args.seed) and passed
+    sys.exit(0 if passed else 1)
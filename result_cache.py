@@ -0,0 +1,84 @@
+import threading
+from collections import OrderedDict
+from typing import Callable
+
+import pandas as pd
+
+
+class ResultCache:
+    """
+    In-process LRU cache of sampling results with a memory budget.
+
+    Results are keyed by (data fingerprint, SamplingPlan, seed): the plan is the normalized, hashable form of the
+    configuration, so equivalent settings share an entry. Only seeded runs should be cached, since a run without a
+    seed is expected to give a new split every time. The least recently used results are evicted once their total
+    size exceeds max_bytes.
+
+    Attributes:
+        max_bytes (int): The memory budget of the cached results.
+        num_bytes (int): The current size of the cached results.
+    """
+
+    def __init__(self, max_bytes: int = 512 * 2**20):
+        self.max_bytes = max_bytes
+        self.num_bytes = 0
+        self._entries = OrderedDict()  # key -> (result, size)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key) -> pd.DataFrame:
+        """Return the cached result of key, or None, marking it as recently used."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def put(self, key, result: pd.DataFrame):
+        """
+        Cache a result, evicting the least recently used results beyond the memory budget.
+
+        A cached result keeps all of its columns alive, so its whole deep memory usage is counted, even for columns
+        shared with other results or the input. A result larger than the whole budget is not cached.
+        """
+        size = int(result.memory_usage(deep=True).sum())
+        with self._lock:
+            if key in self._entries:
+                self.num_bytes -= self._entries.pop(key)[1]
+            if size > self.max_bytes:
+                return
+            self._entries[key] = (result, size)
+            self.num_bytes += size
+            while self.num_bytes > self.max_bytes:
+                self.num_bytes -= self._entries.popitem(last=False)[1][1]
+
+    def get_or_compute(self, key, compute: Callable[[], pd.DataFrame]) -> pd.DataFrame:
+        """
+        Return the cached result of key, or compute and cache it.
+
+        Parameters:
+        - key (tuple): The (data fingerprint, SamplingPlan, seed) key. A key with a seed of None is never cached.
+        - compute (callable): Computes the result when it is not cached.
+
+        Returns:
+        - pandas.DataFrame: The result.
+        """
+        if key[-1] is None:
+            return compute()
+        result = self.get(key)
+        if result is None:
+            result = compute()
+            self.put(key, result)
+        return result
+
+    def clear(self):
+        """Drop all cached results."""
+        with self._lock:
+            self._entries.clear()
+            self.num_bytes = 0
@@ -0,0 +1,264 @@
+import os
+import re
+from dataclasses import dataclass
+
+import numpy as np
+import pandas as pd
+
+from data_preprocessing import (MIDRC_CLEANING_STEPS, data_fingerprint, midrc_clean, read_data_file,
+                                read_sampling_input, write_data_file)
+from sampling_plan import compile_sampling_plan
+from stratified_sampling import dataset_partitions, nested_assignment, stratified_sampling, write_dataset_files
+
+# The execution modes, from the fastest to the most frugal
+EXECUTION_MODES = ('in_memory', 'chunked')
+
+# Powers of 1024 of the memory size units
+_SIZE_UNITS = {'': 0, 'K': 1, 'M': 2, 'G': 3, 'T': 4}
+
+
+def parse_memory_size(size) -> int:
+    """
+    Parse a memory size such as 512000000, '500MB' or '4 GB' into bytes (binary units).
+
+    Parameters:
+    - size (int or str): The memory size.
+
+    Returns:
+    - int: The size in bytes.
+    """
+    if isinstance(size, (int, float)):
+        return int(size)
+    match = re.fullmatch(r'\s*([\d.]+)\s*([KMGT]?)B?\s*', str(size).upper())
+    if match is None:
+        raise ValueError(f"Invalid memory size: {size!r}")
+    return int(float(match.group(1)) * 1024 ** _SIZE_UNITS[match.group(2)])
+
+
+@dataclass(frozen=True)
+class WorkingSetEstimate:
+    """
+    Dataclass for the estimated memory use of sampling a file.
+
+    Attributes:
+        file_bytes (int): The size of the file on disk.
+        num_rows (int): The estimated number of rows.
+        row_bytes (int): The estimated in-memory size of a row with all columns.
+        narrow_row_bytes (int): The estimated in-memory size of a row with only the columns needed for sampling.
+        engine_row_bytes (int): The working memory of the sampling engine per row.
+        narrow_columns (tuple): The columns needed for sampling.
+        chunkable (bool): Whether the file can be read in chunks (CSV and TSV files).
+    """
+    file_bytes: int
+    num_rows: int
+    row_bytes: int
+    narrow_row_bytes: int
+    engine_row_bytes: int
+    narrow_columns: tuple
+    chunkable: bool
+
+    @property
+    def in_memory_bytes(self) -> int:
+        """Peak memory of the in-memory path: the data cleaned in place and shared by the result, plus the engine."""
+        return self.num_rows * (self.row_bytes + self.engine_row_bytes)
+
+    @property
+    def narrow_bytes(self) -> int:
+        """The peak memory of sampling the narrow columns only, before streaming the file."""
+        return self.num_rows * (self.narrow_row_bytes + self.engine_row_bytes)
+
+
+def sampling_columns(sampling_data, columns) -> tuple:
+    """Return the columns of a file needed to clean and sample it: the features, uid, group and cleaning inputs."""
+    plan = compile_sampling_plan(sampling_data)
+    needed = list(plan.features) + [plan.uid_col, plan.group_col]
+    for step in MIDRC_CLEANING_STEPS:
+        if step.resolve_columns(plan.sampling_data):
+            needed += list(step.reads)
+    return tuple(col for col in dict.fromkeys(needed) if col is not None and col in columns)
+
+
+def input_fingerprint(df: pd.DataFrame, sampling_data) -> str:
+    """
+    Fingerprint the cleaned sampling columns of the input, which every execution mode has.
+
+    Parameters:
+    - df (pandas.DataFrame): The cleaned data, or the sampled result.
+    - sampling_data (SamplingData or SamplingPlan): The sampling configuration.
+
+    Returns:
+    - str: The data_fingerprint of the sampling columns of df.
+    """
+    return data_fingerprint(df[list(sampling_columns(sampling_data, df.columns))])
+
+
+def estimate_working_set(filename: str, sampling_data, *, sample_rows: int = 1000,
+                         dtype_backend: str = None) -> WorkingSetEstimate:
+    """
+    Estimate the memory needed to sample a file from its size and a scan of its first rows.
+
+    Parameters:
+    - filename (str): The data file.
+    - sampling_data (SamplingData or SamplingPlan): The sampling configuration.
+    - sample_rows (int): The number of rows scanned.
+    - dtype_backend (str): The dtype backend the file will be read with.
+
+    Returns:
+    - WorkingSetEstimate: The estimate.
+    """
+    plan = compile_sampling_plan(sampling_data)
+    file_bytes = os.path.getsize(filename)
+    chunkable = os.path.splitext(filename)[1].lower() in ('.csv', '.tsv')
+    if chunkable:
+        sample = read_data_file(filename, dtype_backend=dtype_backend, nrows=sample_rows)
+        # Estimate the number of rows from the average size of the scanned lines
+        with open(filename, 'rb') as file:
+            head = file.read(1 << 20)
+        lines = head.count(b'\n') + (not head.endswith(b'\n'))
+        if len(head) == file_bytes:
+            num_rows = max(lines - 1, len(sample))
+        else:
+            num_rows = max(int(file_bytes / (len(head) / lines)) - 1, len(sample))
+    else:
+        sample = read_data_file(filename, dtype_backend=dtype_backend)
+        num_rows = len(sample)
+
+    narrow_columns = sampling_columns(plan, sample.columns)
+    sample_size = max(len(sample), 1)
+    return WorkingSetEstimate(
+        file_bytes=file_bytes,
+        num_rows=num_rows,
+        row_bytes=int(sample.memory_usage(deep=True, index=False).sum() / sample_size) + 1,
+        narrow_row_bytes=int(sample[list(narrow_columns)].memory_usage(deep=True, index=False).sum()
+                             / sample_size) + 1,
+        engine_row_bytes=8 * (len(plan.features) + 4) + 2 * len(plan.level_columns),
+        narrow_columns=narrow_columns,
+        chunkable=chunkable,
+    )
+
+
+def choose_execution_mode(estimate: WorkingSetEstimate, memory_budget) -> str:
+    """
+    Choose the fastest execution mode whose estimated peak memory fits the budget.
+
+    Parameters:
+    - estimate (WorkingSetEstimate): The estimated working set.
+    - memory_budget (int or str): The memory budget, see parse_memory_size. None means unlimited.
+
+    Returns:
+    - str: 'in_memory' or 'chunked'.
+    """
+    if memory_budget is None:
+        return 'in_memory'
+    budget = parse_memory_size(memory_budget)
+    if estimate.in_memory_bytes <= budget or not estimate.chunkable:
+        return 'in_memory'
+    return 'chunked'
+
+
+def sample_file(sampling_data, output_filename: str, *, memory_budget=None, rng=None, frozen=None,
+                dtype_backend: str = None, chunk_rows: int = None, partition_output: str = None):
+    """
+    Clean, sample and write a data file with the execution mode that fits a memory budget.
+
+    - in_memory: the file is read, cleaned in place and sampled as in the CLI, and the result, which shares its
+      columns with the data, is written.
+    - chunked: only the columns needed for sampling are read and sampled, then the file is streamed in chunks that
+      are cleaned, given their dataset columns and appended to the output. Only CSV and TSV files can be chunked.
+
+    Parameters:
+    - sampling_data (SamplingData or SamplingPlan): The sampling configuration. Its filename is read; batch files
+      are always merged and sampled in memory.
+    - output_filename (str): The output file, TSV unless it ends in .csv.
+    - memory_budget (int or str): The memory budget, e.g. '4GB'. None always runs in memory.
+    - rng (numpy.random.Generator or int): The random generator, or a seed for a new one.
+    - frozen (pandas.Series or pandas.DataFrame): Previous assignments, indexed by uid, that must be kept: the
+      dataset of every uid, or its datasets at every level, see AssignmentStore.frozen_assignments.
+    - dtype_backend (str): The dtype backend used to read the file.
+    - chunk_rows (int): The number of rows per chunk in chunked mode. Defaults to what fits the budget.
+    - partition_output (str): 'files' or 'directory' to write one file per dataset instead of output_filename,
+      see write_dataset_files.
+
+    Returns:
+    - tuple: (mode, result) where result is the sampled DataFrame (only the sampling columns and the dataset
+      columns in chunked mode), with the contingency table in its attrs.
+    """
+    plan = compile_sampling_plan(sampling_data)
+    sampling_data = plan.sampling_data
+    filename = sampling_data.filename
+    dtype_backend = dtype_backend or sampling_data.dtype_backend
+
+    if memory_budget is None:
+        mode = 'in_memory'
+        print(f"Execution mode for {filename}: {mode} (no memory budget)")
+    elif not isinstance(filename, str):
+        # Batch files are merged by uid, which needs all of their rows at once
+        mode = 'in_memory'
+        print(f"Execution mode for {len(filename)} batch files: {mode} (batches are merged in memory)")
+    else:
+        budget = parse_memory_size(memory_budget)
+        estimate = estimate_working_set(filename, plan, dtype_backend=dtype_backend)
+        mode = choose_execution_mode(estimate, budget)
+        print(f"Execution mode for {filename}: {mode} (about {estimate.num_rows} rows; estimated peak "
+              f"{estimate.in_memory_bytes / 2**20:.0f} MB in memory, {estimate.narrow_bytes / 2**20:.0f} MB "
+              f"chunked; budget {budget / 2**20:.0f} MB)")
+        if mode == 'in_memory' and estimate.in_memory_bytes > budget:
+            print(f"WARNING: {filename} cannot be read in chunks and may not fit the memory budget")
+
+    if mode == 'in_memory':
+        data = midrc_clean(read_sampling_input(sampling_data, dtype_backend=dtype_backend), sampling_data,
+                           inplace=True)
+        result = stratified_sampling(data, plan, rng=rng, frozen=frozen)
+        _write_output(result, plan, output_filename, partition_output)
+        return mode, result
+
+    # Chunked: sample the narrow columns, then stream the full rows through cleaning into the output
+    narrow = read_data_file(filename, dtype_backend=dtype_backend, usecols=list(estimate.narrow_columns))
+    narrow = midrc_clean(narrow, sampling_data, inplace=True)
+    levels = nested_assignment(narrow, plan, rng=rng, frozen=frozen)
+
+    if chunk_rows is None:
+        free_bytes = budget - estimate.narrow_bytes
+        chunk_rows = int(np.clip(free_bytes / (2 * estimate.row_bytes), 1_000, 1_000_000))
+    sep = ',' if output_filename.lower().endswith('.csv') else '\t'
+    if partition_output:
+        codes, filenames = dataset_partitions(levels, plan, output_filename, partition_output)
+        filenames = list(filenames.values())
+    else:
+        codes, filenames = np.zeros(len(levels), dtype=np.intp), [output_filename]
+    outputs = {}
+    start = 0
+    try:
+        for chunk in read_data_file(filename, dtype_backend=dtype_backend, chunksize=chunk_rows):
+            chunk = midrc_clean(chunk, sampling_data, inplace=True)
+            for column in plan.level_columns:
+                chunk[column] = levels[column].iloc[start:start + len(chunk)].to_numpy()
+            chunk_codes = codes[start:start + len(chunk)]
+            for code in np.unique(chunk_codes):
+                # The header is written with the first rows of every file
+                header = code not in outputs
+                if header:
+                    folder = os.path.dirname(filenames[code])
+                    if folder:
+                        os.makedirs(folder, exist_ok=True)
+                    outputs[code] = open(filenames[code], 'w', encoding='utf-8', newline='')
+                rows = chunk if len(filenames) == 1 else chunk[chunk_codes == code]
+                rows.to_csv(outputs[code], sep=sep, index=False, header=header)
+            start += len(chunk)
+    finally:
+        for output in outputs.values():
+            output.close()
+
+    for column in plan.level_columns:
+        narrow[column] = levels[column]
+    narrow.attrs['contingency'] = levels.attrs['contingency']
+    return mode, narrow
+
+
+def _write_output(df: pd.DataFrame, plan, output_filename: str, partition_output: str = None):
+    """Write the sampled data to output_filename, or one file per dataset with partition_output."""
+    if partition_output:
+        filenames = write_dataset_files(df, plan, output_filename, layout=partition_output)
+        print(f"Wrote {len(filenames)} dataset files: {', '.join(filenames.values())}")
+    else:
+        write_data_file(df, output_filename)
@@ -4,19 +4,20 @@
 #through the Advanced Research Projects Agency for Health (ARPA-H).
 
 from PySide6.QtWidgets import (
-    QApplication, QWidget, QVBoxLayout, QLabel, QLineEdit, QPushButton, QProgressDialog,
+    QApplication, QWidget, QVBoxLayout, QLabel, QLineEdit, QPushButton,
     QFileDialog, QTableView, QMessageBox, QFormLayout, QHBoxLayout, QDialog, QCheckBox, QDialogButtonBox,
     QVBoxLayout, QSpinBox, QDoubleSpinBox, QButtonGroup
 )
-from PySide6.QtCore import Qt
+from PySide6.QtCore import QThread, Signal
 from PySide6.QtGui import QStandardItemModel, QStandardItem, QColor
-import pandas as pd
 import sys
 import colorsys
 
-from stratified_sampling import stratified_sampling
-from data_preprocessing import midrc_clean
-from CONFIG import SamplingData
+from stratified_sampling import contingency_table
+from data_preprocessing import data_fingerprint, read_data_file, write_data_file
+from result_cache import ResultCache
+from sampling_pipeline import PREVIEW_ROWS, SamplingPipeline
+from sampling_plan import plan_from_text
 
 
 class NumericColumnSelectorDialog(QDialog):
@@ -121,6 +122,23 @@ class ColumnSelectorDialog(QDialog):
         return [col for col, checkbox in self.checkboxes.items() if checkbox.isChecked()]
 
 
+class SamplingWorker(QThread):
+    """Run a full sampling job off the GUI thread and report the result of the run it belongs to."""
+    result_ready = Signal(int, object)
+    failed = Signal(int, str)
+
+    def __init__(self, run_id, compute, parent=None):
+        super().__init__(parent)
+        self.run_id = run_id
+        self.compute = compute
+
+    def run(self):
+        try:
+            self.result_ready.emit(self.run_id, self.compute())
+        except Exception as e:
+            self.failed.emit(self.run_id, str(e))
+
+
 class SamplingApp(QWidget):
     def __init__(self):
         super().__init__()
@@ -190,6 +208,11 @@ class SamplingApp(QWidget):
         self.uid_col_input.setToolTip(
             "The name of the column in the data file that contains the unique identifier for each row.")
 
+        self.seed_input = QLineEdit("")
+        self.seed_input.setPlaceholderText("random")
+        self.seed_input.setToolTip("Random seed for reproducible sampling. Leave empty for a new split on every run.")
+        form_layout.addRow(QLabel("Random Seed:"), self.seed_input)
+
         self.layout.addLayout(form_layout)
 
         self.load_button = QPushButton("Perform Sampling")
@@ -200,6 +223,13 @@ class SamplingApp(QWidget):
         self.table_view = QTableView()
         self.layout.addWidget(self.table_view)
 
+        # Per-dataset summary and prevalence report of the last sampling run
+        self.summary_label = QLabel("")
+        self.layout.addWidget(self.summary_label)
+        self.summary_view = QTableView()
+        self.summary_view.setMaximumHeight(200)
+        self.layout.addWidget(self.summary_view)
+
         self.save_button = QPushButton("Save Output to CSV/TSV")
         self.save_button.setToolTip("Save the output to a CSV/TSV file.")
         self.save_button.clicked.connect(self.save_output)
@@ -208,8 +238,14 @@ class SamplingApp(QWidget):
         self.setLayout(self.layout)
 
         self.df = None
+        self.df_fingerprint = None
+        self.pipeline = None
         self.sampled_df = None
         self.columns = []  # Will hold the columns of the loaded file
+        self.result_cache = ResultCache()  # Seeded results, so unchanged settings are not sampled again
+        self.run_id = 0  # Only the latest run may replace the preview
+        self.workers = set()  # Running background jobs, kept alive until they finish
+        self.pending_plan = None  # The sampling plan of the latest background job
 
     def browse_file(self):
         file_path, _ = QFileDialog.getOpenFileName(self, "Open File", "", "Supported Files (*.csv *.tsv *.xlsx *.xls);;"
@@ -222,20 +258,13 @@ class SamplingApp(QWidget):
 
     def load_data(self, file_path):
         try:
-            # Map file extensions to corresponding pandas read functions
-            read_functions = {
-                '.xlsx': pd.read_excel,
-                '.xls': pd.read_excel,
-                '.csv': pd.read_csv,
-                '.tsv': lambda file: pd.read_csv(file, sep='\t')
-            }
-
-            # Get the file extension
-            file_ext = file_path[file_path.rfind('.'):]
-
-            # Check if the extension is supported and read the file
-            if file_ext in read_functions:
-                self.df = read_functions[file_ext](file_path)
+            # Read the file, with the dtype backend set by the SAMPLING_DTYPE_BACKEND environment variable
+            if file_path[file_path.rfind('.'):].lower() in ('.xlsx', '.xls', '.csv', '.tsv'):
+                self.df = read_data_file(file_path)
+                # Results of runs on the previous data no longer replace the preview
+                self.run_id += 1
+                self.df_fingerprint = data_fingerprint(self.df)
+                self.pipeline = SamplingPipeline(self.df)
                 self.columns = list(self.df.columns)  # Store the columns for column selector
                 self.display_dataframe(self.df)
             else:
@@ -268,63 +297,72 @@ class SamplingApp(QWidget):
         self.datasets_input.setText("{\"Train\": 0.8, \"Validation\": 0.2}")
 
     def perform_sampling(self):
+        if self.df is None:
+            QMessageBox.warning(self, "No Data", "No data has been loaded. Please load a file first.")
+            return
+
         try:
-            # Create a "Please wait..." dialog
-            wait_dialog = QProgressDialog("Please wait...", None, 0, 0, self)
-            wait_dialog.setWindowTitle("Processing")
-            wait_dialog.setWindowModality(Qt.WindowModal)
-            wait_dialog.setCancelButton(None)
-            wait_dialog.show()
-            QApplication.processEvents()
-
-            if self.df is None:
-                QMessageBox.warning(self, "No Data", "No data has been loaded. Please load a file first.")
-                wait_dialog.close()
+            # Get user input and compile it into a sampling plan (unchanged settings are parsed only once)
+            dataset_column = self.dataset_column_input.text()
+            sampling_plan = plan_from_text(self.filename_input.text(), dataset_column, self.features_input.text(),
+                                           self.datasets_input.text(), self.numeric_cols_input.text(),
+                                           self.uid_col_input.text())
+            seed = int(self.seed_input.text()) if self.seed_input.text().strip() else None
+            cache_key = (self.df_fingerprint, sampling_plan, seed)
+            self.run_id += 1
+
+            # Results of the same data, settings and seed are shown at once
+            cached = self.result_cache.get(cache_key) if seed is not None else None
+            if cached is not None:
+                self.show_result(cached, sampling_plan)
                 return
 
-            # Get user input to create SamplingData instance
-            filename = self.filename_input.text()
-            dataset_column = self.dataset_column_input.text()
-            features = tuple(self.features_input.text().split(',')) if self.features_input.text() else ()
-            title = ''
-            datasets = eval(self.datasets_input.text()) if self.datasets_input.text() else {}
-            numeric_cols = eval(self.numeric_cols_input.text()) if self.numeric_cols_input.text() else {}
-
-            # Ensure labels are set to None
-            for col in numeric_cols:
-                numeric_cols[col]['labels'] = None
-
-            uid_col = self.uid_col_input.text()
-
-            sampling_data = SamplingData(
-                filename=filename,
-                dataset_column=dataset_column,
-                features=features,
-                title=title,
-                datasets=datasets,
-                numeric_cols=numeric_cols,
-                uid_col=uid_col
-            )
-
-            # Clean the data
-            df_cleaned = midrc_clean(self.df, sampling_data)
-
-            # Run the stratified sampling function
-            self.sampled_df = stratified_sampling(df_cleaned, sampling_data)
-
-            # Close the "Please wait..." dialog
-            wait_dialog.close()
-
-            # Display the sampled DataFrame in the table view with rows highlighted
-            if self.sampled_df is not None:
-                self.display_dataframe(self.sampled_df, dataset_column)
-            else:
-                QMessageBox.warning(self, "Sampling Error", "No data to display after sampling.")
+            # Large files: show the expected summary of a subsample right away, then run the full split in the
+            # background. The pipeline only recomputes the stages whose settings changed.
+            if len(self.df) > PREVIEW_ROWS:
+                self.sampled_df = None  # Nothing to save until the full split is done
+                self.display_summary(self.pipeline.preview(sampling_plan, rng=seed),
+                                     title=f"Preview from {PREVIEW_ROWS:,} of {len(self.df):,} rows, "
+                                           f"sampling all rows...")
+                worker = SamplingWorker(self.run_id, lambda: self.result_cache.get_or_compute(
+                    cache_key, lambda: self.pipeline.run(sampling_plan, rng=seed)), self)
+                # Bound methods of the window are called on the GUI thread
+                worker.result_ready.connect(self.on_result)
+                worker.failed.connect(self.on_failure)
+                worker.finished.connect(self.on_worker_finished)
+                self.pending_plan = sampling_plan
+                self.workers.add(worker)
+                worker.start()
+                return
+
+            self.show_result(self.result_cache.get_or_compute(
+                cache_key, lambda: self.pipeline.run(sampling_plan, rng=seed)), sampling_plan)
 
         except Exception as e:
-            wait_dialog.close()
             QMessageBox.critical(self, "Error", f"An error occurred: {str(e)}")
 
+    def on_result(self, run_id, result):
+        """Replace the preview with the result of a background run, unless a newer run was started."""
+        if run_id == self.run_id:
+            self.show_result(result, self.pending_plan)
+
+    def on_failure(self, run_id, message):
+        if run_id == self.run_id:
+            self.summary_label.setText("")
+            QMessageBox.critical(self, "Error", f"An error occurred: {message}")
+
+    def on_worker_finished(self):
+        self.workers.discard(self.sender())
+
+    def show_result(self, result, sampling_plan):
+        """Display the sampled DataFrame with rows highlighted by dataset, and its summary."""
+        self.sampled_df = result
+        if self.sampled_df is not None:
+            self.display_dataframe(self.sampled_df, sampling_plan.dataset_column)
+            self.display_summary(contingency_table(self.sampled_df, sampling_plan))
+        else:
+            QMessageBox.warning(self, "Sampling Error", "No data to display after sampling.")
+
     def generate_color_map(self, unique_values):
         """Generate a color map for unique values using different hues."""
         num_values = len(unique_values)
@@ -334,7 +372,13 @@ class SamplingApp(QWidget):
         ]
         return dict(zip(unique_values, colors))
 
-    def display_dataframe(self, df, dataset_column=None):
+    def display_summary(self, table, title="Dataset Summary"):
+        """Show the per-dataset counts and the prevalence report of a contingency table."""
+        self.summary_label.setText(f"{title}: " + ", ".join(
+            f"{row.Dataset}: {row.Count} ({row.Percent}%)" for row in table.summary().itertuples()))
+        self.display_dataframe(table.quality_report(), table_view=self.summary_view)
+
+    def display_dataframe(self, df, dataset_column=None, table_view=None):
         model = QStandardItemModel(df.shape[0], df.shape[1])
         model.setHorizontalHeaderLabels(df.columns)
 
@@ -359,7 +403,7 @@ class SamplingApp(QWidget):
 
                 model.setItem(row, column, item)
 
-        self.table_view.setModel(model)
+        (table_view or self.table_view).setModel(model)
 
     def save_output(self):
         if self.sampled_df is not None:
@@ -370,8 +414,8 @@ class SamplingApp(QWidget):
             write_functions = {
                 '.xlsx': lambda file: self.sampled_df.to_excel(file, index=False),
                 '.xls': lambda file: self.sampled_df.to_excel(file, index=False),
-                '.csv': lambda file: self.sampled_df.to_csv(file, index=False),
-                '.tsv': lambda file: self.sampled_df.to_csv(file, index=False, sep='\t')
+                '.csv': lambda file: write_data_file(self.sampled_df, file),
+                '.tsv': lambda file: write_data_file(self.sampled_df, file)
             }
 
             # Get the file extension
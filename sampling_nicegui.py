@@ -1,36 +1,41 @@
 from nicegui import ui
-import pandas as pd
 import os
 import json
-from stratified_sampling import stratified_sampling
-from data_preprocessing import midrc_clean
-from CONFIG import SamplingData
+from stratified_sampling import contingency_table
+from data_preprocessing import data_fingerprint, read_data_file, write_data_file
+from result_cache import ResultCache
+from sampling_pipeline import PREVIEW_ROWS, SamplingPipeline
+from sampling_plan import plan_from_text
 import asyncio
+import functools
 import itertools
 from typing import Dict
 
 # Variables to store data
 uploaded_data = None
+uploaded_fingerprint = None
+pipeline = None  # Cached cleaning, binning and stratum keys of the uploaded data
 sampled_data = None
+result_cache = ResultCache()  # Seeded results, so unchanged settings are not sampled again
 columns = []
 table_container = None  # Container to hold the table element
+summary_container = None  # Container to hold the dataset summary
+latest_run = 0  # Only the latest run may replace the preview
 
 # Function to load file and extract columns
 def load_file(file_path):
-    global uploaded_data, columns
+    global uploaded_data, uploaded_fingerprint, pipeline, columns
     file_ext = os.path.splitext(file_path)[1].lower()
 
     try:
-        if file_ext == '.csv':
-            uploaded_data = pd.read_csv(file_path)
-        elif file_ext == '.tsv':
-            uploaded_data = pd.read_csv(file_path, sep='\t')
-        elif file_ext in ['.xlsx', '.xls']:
-            uploaded_data = pd.read_excel(file_path)
-        else:
+        if file_ext not in ['.csv', '.tsv', '.xlsx', '.xls']:
             ui.notify('Invalid file type', color='negative')
             return
 
+        # The dtype backend is set by the SAMPLING_DTYPE_BACKEND environment variable
+        uploaded_data = read_data_file(file_path)
+        uploaded_fingerprint = data_fingerprint(uploaded_data)
+        pipeline = SamplingPipeline(uploaded_data)
         columns = list(uploaded_data.columns)
         ui.notify('File loaded successfully', color='positive')
     except Exception as e:
@@ -71,9 +76,18 @@ def generate_colors(num_colors):
     ])
     return [next(colors) for _ in range(num_colors)]
 
+def show_summary(table_summary, title='Dataset Summary'):
+    """Show the per-dataset summary and prevalence report of a contingency table."""
+    with summary_container:
+        summary_container.clear()
+        ui.label(title).classes('text-xl')
+        ui.table.from_pandas(table_summary.summary()).classes('w-full')
+        ui.table.from_pandas(table_summary.quality_report(), pagination={'rowsPerPage': 10}).classes('w-full')
+
+
 # Asynchronous function to perform sampling
-async def perform_sampling(dataset_column, features, datasets, numeric_cols, uid_col):
-    global uploaded_data, sampled_data, table_container
+async def perform_sampling(dataset_column, features, datasets, numeric_cols, uid_col, seed=None):
+    global uploaded_data, sampled_data, table_container, latest_run
 
     if uploaded_data is None:
         ui.notify('Please upload a file first', color='negative')
@@ -86,33 +100,40 @@ async def perform_sampling(dataset_column, features, datasets, numeric_cols, uid
     await asyncio.sleep(0)  # Yield control to allow the dialog to render
 
     try:
-        # Parse features, datasets, and numeric columns from input
-        features_list = features.split(',') if features else []
-        datasets_dict = json.loads(datasets) if datasets else {}
-        numeric_cols_dict = json.loads(numeric_cols) if numeric_cols else {}
-
-        # Ensure labels are set to None
-        for col in numeric_cols_dict:
-            numeric_cols_dict[col]['labels'] = None
-
-        # Create SamplingData instance
-        sampling_data = SamplingData(
-            filename="",
-            dataset_column=dataset_column,
-            features=tuple(features_list),
-            title='',
-            datasets=datasets_dict,
-            numeric_cols=numeric_cols_dict,
-            uid_col=uid_col
-        )
+        # Parse the inputs and compile them into a sampling plan (unchanged settings are parsed only once)
+        sampling_plan = plan_from_text("", dataset_column, features, datasets, numeric_cols, uid_col)
 
-        loop = asyncio.get_event_loop()
+        # An empty seed gives a new split on every run
+        seed = int(seed) if seed not in (None, '') else None
 
-        # Clean the data (awaiting to allow UI to respond)
-        df_cleaned = await loop.run_in_executor(None, midrc_clean, uploaded_data, sampling_data)
-
-        # Run the stratified sampling function (awaiting to allow UI to respond)
-        sampled_data = await loop.run_in_executor(None, stratified_sampling, df_cleaned, sampling_data)
+        loop = asyncio.get_event_loop()
+        cache_key = (uploaded_fingerprint, sampling_plan, seed)
+        latest_run += 1
+        run_id = latest_run
+        result = result_cache.get(cache_key) if seed is not None else None
+
+        if result is None:
+            if len(uploaded_data) > PREVIEW_ROWS:
+                # Show the expected summary of a subsample right away while all the rows are sampled, unless a newer
+                # run has started meanwhile
+                preview = await loop.run_in_executor(None, functools.partial(pipeline.preview, sampling_plan,
+                                                                             rng=seed))
+                if run_id == latest_run:
+                    show_summary(preview, f"Preview from {PREVIEW_ROWS:,} of {len(uploaded_data):,} rows, "
+                                          "sampling all rows...")
+                processing_dialog.close()
+
+            # Clean and sample the data (awaiting to allow UI to respond). Only the stages whose settings changed are
+            # recomputed, and the shared uploaded data is never modified, so several jobs can run concurrently.
+            result = await loop.run_in_executor(None, functools.partial(pipeline.run, sampling_plan, rng=seed))
+            if seed is not None:
+                result_cache.put(cache_key, result)
+
+        # A newer run replaces this one
+        if run_id != latest_run:
+            processing_dialog.close()
+            return
+        sampled_data = result
 
         # Close the "Processing..." dialog
         processing_dialog.close()
@@ -128,7 +149,7 @@ async def perform_sampling(dataset_column, features, datasets, numeric_cols, uid
             table_container.clear()
 
             # Extract the unique values from the specified dataset column
-            unique_values = list(datasets_dict.keys())
+            unique_values = list(sampling_plan.dataset_names)
             colors = generate_colors(len(unique_values))
             color_map = dict(zip(unique_values, colors))
 
@@ -160,6 +181,9 @@ async def perform_sampling(dataset_column, features, datasets, numeric_cols, uid
             # print(slot_string)
             table.add_slot(f'body-cell', slot_string)
 
+        # Show the per-dataset summary and prevalence report derived from the contingency table
+        show_summary(contingency_table(sampled_data, sampling_plan))
+
         # Close the "Generating Table..." dialog
         table_dialog.close()
 
@@ -244,7 +268,7 @@ def show_numeric_selector():
 def download_sampled_data():
     if sampled_data is not None:
         file_path = './uploads/sampled_data.csv'
-        sampled_data.to_csv(file_path, index=False)
+        write_data_file(sampled_data, file_path)
         ui.download(file_path)
     else:
         ui.notify('No sampled data available', color='negative')
@@ -289,17 +313,25 @@ with ui.column().classes('items-center w-full'):
         ui.label('Unique Identifier Column').classes('text-right mr-2')
         uid_col_input = ui.input(value='submitter_id').props('outlined').classes('w-full col-span-3')
 
+        # Random Seed Input
+        ui.label('Random Seed').classes('text-right mr-2')
+        seed_input = ui.input(placeholder='random').props('outlined').classes('w-full col-span-3')
+
     # Perform Sampling Button
     ui.button('Perform Sampling', on_click=lambda: perform_sampling(
         dataset_column_input.value,
         features_input.value,
         datasets_input.value,
         numeric_cols_input.value,
-        uid_col_input.value)).classes('mb-4')
+        uid_col_input.value,
+        seed_input.value)).classes('mb-4')
 
     # Download Button
     ui.button('Download Sampled Data', on_click=download_sampled_data).classes('mb-4')
 
+    # Container for the dataset summary
+    summary_container = ui.column().classes('w-full')
+
     # Container for the table
     table_container = ui.column().classes('w-full')
 
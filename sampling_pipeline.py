@@ -0,0 +1,216 @@
+import threading
+from collections import Counter, OrderedDict
+from dataclasses import replace
+from typing import Callable
+
+import numpy as np
+import pandas as pd
+
+from data_preprocessing import MIDRC_CLEANING_STEPS, bin_column, column_cleaning_steps
+from quantile_sketch import resolve_data_bins
+from sampling_plan import compile_sampling_plan
+from stratified_sampling import (ContingencyTable, _levels_frame, allocate_levels, check_for_duplicates,
+                                 combine_stratum_codes, contingency_table, stratified_sampling, stratum_labels)
+
+# The number of rows stratified by SamplingPipeline.preview
+PREVIEW_ROWS = 20_000
+
+
+class SamplingPipeline:
+    """
+    Stratified sampling of one DataFrame, split into cached stages so that repeated runs only recompute what changed.
+
+    The stages and the inputs each one is keyed by are:
+
+    - clean: one cleaned column per (column, cleaning steps of that column).
+    - data bins: the edges of the bins configured as quantiles per (cleaning, binning) of the numeric features.
+    - bin: the codes of one feature per (cleaned column, binning of that column). Categorical features are
+      factorized.
+    - stratum keys: the stratum codes and labels per combination of binned features, in order.
+    - allocation: the dataset codes of every level per (stratum keys, dataset split, allocation, seed), for integer
+      seeds.
+
+    Parsing the settings is cached by plan_from_text. Changing only the dataset fractions therefore reruns only the
+    allocation, and changing the bins of one column re-bins only that column and recombines the stratum keys.
+    Results are identical to stratified_sampling(midrc_clean(data, sampling_data), sampling_data, rng=seed).
+
+    Plans with a group_col are cleaned through the cache and then sampled with stratified_sampling. Concurrent runs
+    from several threads are safe; a stage computed by two runs at once is simply computed twice.
+
+    Attributes:
+        data (pandas.DataFrame): The input data. It is never modified.
+        steps (list): The cleaning steps. Defaults to MIDRC_CLEANING_STEPS.
+        max_entries (int): The number of entries kept per stage, least recently used first out.
+        computed (collections.Counter): The number of times every stage was computed, for inspection.
+    """
+
+    def __init__(self, data: pd.DataFrame, *, steps=None, max_entries: int = 16):
+        self.data = data
+        self.steps = MIDRC_CLEANING_STEPS if steps is None else steps
+        self.max_entries = max_entries
+        self.computed = Counter()
+        self._caches = {}
+        self._checked_uid_cols = set()
+        self._previews = {}  # max_rows -> pipeline of a fixed random subsample
+        self._lock = threading.Lock()
+
+    def _cached(self, stage: str, key, compute: Callable):
+        """Return the cached value of key in a stage, or compute and cache it."""
+        with self._lock:
+            cache = self._caches.setdefault(stage, OrderedDict())
+            if key in cache:
+                cache.move_to_end(key)
+                return cache[key]
+        value = compute()
+        with self._lock:
+            self.computed[stage] += 1
+            cache[key] = value
+            if len(cache) > self.max_entries:
+                cache.popitem(last=False)
+        return value
+
+    def clean(self, sampling_data) -> pd.DataFrame:
+        """
+        Clean the data, reusing every column that was already cleaned with the same steps.
+
+        Parameters:
+        - sampling_data (SamplingData or SamplingPlan): The sampling configuration.
+
+        Returns:
+        - pandas.DataFrame: A shallow copy of the data with the cleaned columns.
+        """
+        plan = compile_sampling_plan(sampling_data)
+        sampling_data = plan.sampling_data
+        df_out = self.data.copy(deep=False)
+        for col_name, col_steps in column_cleaning_steps(self.data, sampling_data, self.steps).items():
+            df_out[col_name] = self._cached('clean', (col_name, tuple(col_steps)),
+                                            lambda: self._clean_column(col_name, col_steps, sampling_data))
+        return df_out
+
+    def _clean_column(self, col_name: str, col_steps, sampling_data) -> pd.Series:
+        """Run the cleaning steps of one column."""
+        column = self.data[col_name]
+        for step in col_steps:
+            column = step.func(column, self.data, sampling_data)
+        return column
+
+    def run(self, sampling_data, *, rng=None, view_stats=False) -> pd.DataFrame:
+        """
+        Clean and sample the data, recomputing only the stages whose inputs changed.
+
+        Parameters:
+        - sampling_data (SamplingData or SamplingPlan): The sampling configuration.
+        - rng (numpy.random.Generator or int): The random generator, or a seed for a new one. None uses fresh
+          entropy. Allocations are only cached for integer seeds.
+        - view_stats (bool): Whether to view the statistics of the sampling.
+
+        Returns:
+        - pandas.DataFrame: The sampled DataFrame, like stratified_sampling.
+        """
+        plan = compile_sampling_plan(sampling_data)
+        df_cleaned = self.clean(plan)
+        plan = self._resolve_data_bins(plan, df_cleaned)
+        if plan.group_col:
+            return stratified_sampling(df_cleaned, plan, view_stats=view_stats, rng=rng)
+
+        if plan.uid_col and plan.uid_col not in self._checked_uid_cols:
+            check_for_duplicates(df_cleaned, plan.uid_col)
+            self._checked_uid_cols.add(plan.uid_col)
+
+        # Bin every feature, keyed by the cleaning of its column and its binning
+        clean_keys = {col_name: tuple(col_steps) for col_name, col_steps
+                      in column_cleaning_steps(self.data, plan.sampling_data, self.steps).items()}
+        binnings = {binning.column: binning for binning in plan.numeric}
+        bin_keys = tuple((col_name, clean_keys.get(col_name, ()), binnings.get(col_name))
+                         for col_name in plan.features)
+        binned = {key[0]: self._cached('bin', key, lambda: self._bin_column(df_cleaned, *key)) for key in bin_keys}
+
+        stratum_codes, strata = self._cached('stratum keys', bin_keys,
+                                             lambda: self._stratum_keys(binned, len(df_cleaned)))
+
+        allocation_key = (bin_keys, plan.split, plan.allocation, rng) if isinstance(rng, (int, np.integer)) else None
+        def allocate():
+            return allocate_levels(stratum_codes, len(strata), plan.split, np.random.default_rng(rng),
+                                   allocation=plan.allocation)
+
+        if allocation_key is None:
+            level_codes = allocate()
+            self.computed['allocation'] += 1
+        else:
+            level_codes = self._cached('allocation', allocation_key, allocate)
+
+        levels = _levels_frame(plan, level_codes, stratum_codes, strata, df_cleaned.index, view_stats=view_stats)
+        for column in plan.level_columns:
+            df_cleaned[column] = levels[column]
+        df_cleaned.attrs['contingency'] = levels.attrs['contingency']
+        return df_cleaned
+
+    def preview(self, sampling_data, *, max_rows: int = PREVIEW_ROWS, rng=None) -> ContingencyTable:
+        """
+        Estimate the contingency table of a run from a bounded random subsample, in a fraction of the time.
+
+        The subsample is drawn once per max_rows (whole groups with a group_col) and has its own cached pipeline, so
+        previews while tuning the settings are consistent with each other and only recompute what changed. The
+        counts are scaled to the size of the data, so the summary shows the expected size of every dataset and the
+        prevalence report the expected prevalences.
+
+        Parameters:
+        - sampling_data (SamplingData or SamplingPlan): The sampling configuration.
+        - max_rows (int): The largest number of rows stratified.
+        - rng (numpy.random.Generator or int): The random generator of the split, as for run.
+
+        Returns:
+        - ContingencyTable: The expected contingency table.
+        """
+        plan = compile_sampling_plan(sampling_data)
+        if len(self.data) <= max_rows:
+            return contingency_table(self.run(plan, rng=rng), plan)
+
+        with self._lock:
+            preview = self._previews.get((max_rows, plan.group_col))
+        if preview is None:
+            sample_rng = np.random.default_rng(0)  # The same subsample for every preview
+            if plan.group_col:
+                group_codes, groups = pd.factorize(self.data[plan.group_col], use_na_sentinel=False)
+                num_groups = max(1, int(len(groups) * max_rows / len(self.data)))
+                chosen = np.zeros(len(groups), dtype=bool)
+                chosen[sample_rng.choice(len(groups), size=num_groups, replace=False)] = True
+                rows = np.flatnonzero(chosen[group_codes])
+            else:
+                rows = np.sort(sample_rng.choice(len(self.data), size=max_rows, replace=False))
+            preview = SamplingPipeline(self.data.iloc[rows], steps=self.steps, max_entries=self.max_entries)
+            with self._lock:
+                self._previews[(max_rows, plan.group_col)] = preview
+
+        # Bins computed from the data are computed from all of it, as in the full run
+        if plan.has_data_bins:
+            plan = self._resolve_data_bins(plan, self.clean(plan))
+        table = contingency_table(preview.run(plan, rng=rng), plan)
+        scale = len(self.data) / len(preview.data)
+        return ContingencyTable(strata=table.strata, counts=np.rint(table.counts * scale).astype(np.int64),
+                                datasets=table.datasets)
+
+    def _resolve_data_bins(self, plan, df_cleaned: pd.DataFrame):
+        """Compute the bins configured as quantiles, once per cleaning and binning of their columns."""
+        if not plan.has_data_bins:
+            return plan
+        clean_keys = column_cleaning_steps(self.data, plan.sampling_data, self.steps)
+        key = tuple((binning, tuple(clean_keys.get(binning.column, ()))) for binning in plan.numeric)
+        numeric = self._cached('data bins', key, lambda: resolve_data_bins(plan, df_cleaned).numeric)
+        return replace(plan, numeric=numeric)
+
+    @staticmethod
+    def _bin_column(df_cleaned: pd.DataFrame, col_name: str, clean_key, binning):
+        """Compute the codes and labels of one feature."""
+        if binning is not None:
+            return bin_column(df_cleaned[col_name], binning.edges, right=binning.right), binning.labels
+        col_codes, uniques = pd.factorize(df_cleaned[col_name], use_na_sentinel=False)
+        return col_codes, tuple(str(value) for value in uniques)
+
+    @staticmethod
+    def _stratum_keys(binned: dict, num_rows: int):
+        """Combine the binned features into stratum codes and labels."""
+        codes = {col_name: col_codes for col_name, (col_codes, _) in binned.items()}
+        label_table = {col_name: labels for col_name, (_, labels) in binned.items()}
+        stratum_codes, num_strata = combine_stratum_codes(codes, label_table, num_rows)
+        return stratum_codes, stratum_labels(codes, label_table, stratum_codes, num_strata)
@@ -0,0 +1,323 @@
+import ast
+import json
+from dataclasses import dataclass, field
+from functools import lru_cache
+from typing import Optional, Tuple
+
+import numpy as np
+
+from CONFIG import SamplingData
+from data_preprocessing import DUPLICATE_POLICIES, OUTLIER_LABELS, generate_bin_labels
+
+# How the rows of every stratum are apportioned between the datasets, see allocate_strata
+ALLOCATIONS = ('stratum', 'global')
+
+# The keys of a numeric_cols 'bins' dictionary computed from the data
+DATA_BINS_KEYS = ('quantiles', 'min_count')
+
+
+@dataclass(frozen=True)
+class NumericBinning:
+    """
+    Dataclass for the compiled binning of a numeric feature.
+
+    Attributes:
+        column (str): The name of the numeric column.
+        edges (Tuple[float, ...]): The bin edges, in increasing order.
+        labels (Tuple[str, ...]): The label of every bin code, including the trailing outlier labels.
+        right (bool): Whether the bins are right-inclusive.
+        data_bins (Tuple[Tuple[str, int], ...]): The ('quantiles', k) or ('min_count', n) specification of bins
+            computed from the data. Until they are resolved with resolve_data_bins, edges is empty and labels only
+            holds the outlier labels.
+    """
+    column: str
+    edges: Tuple[float, ...]
+    labels: Tuple[str, ...]
+    right: bool = False
+    data_bins: Tuple[Tuple[str, int], ...] = ()
+
+
+@dataclass(frozen=True)
+class DatasetSplit:
+    """
+    Dataclass for one level of a (possibly nested) dataset split.
+
+    Attributes:
+        names (Tuple[str, ...]): The dataset names of this level.
+        weights (Tuple[float, ...]): The normalized fraction of every dataset, summing to 1.
+        children (Tuple[DatasetSplit, ...]): The split of every dataset at the next level, or None.
+    """
+    names: Tuple[str, ...]
+    weights: Tuple[float, ...]
+    children: Tuple[Optional['DatasetSplit'], ...] = ()
+
+
+@dataclass(frozen=True)
+class SamplingPlan:
+    """
+    Dataclass for an immutable, validated sampling plan compiled from a SamplingData instance.
+
+    The plan is hashable, so it can be used as a cache key and reused across runs and replicates.
+
+    Attributes:
+        features (Tuple[str, ...]): The stratification features, in order.
+        numeric (Tuple[NumericBinning, ...]): The binning of the numeric features.
+        categorical (Tuple[str, ...]): The categorical features.
+        dataset_names (Tuple[str, ...]): The dataset names of the first level, in order.
+        weights (Tuple[float, ...]): The normalized fraction of every first-level dataset, summing to 1.
+        dataset_column (str): The name of the dataset column.
+        split (DatasetSplit): The tree of nested dataset splits, starting with the first level.
+        level_names (Tuple[Tuple[str, ...], ...]): The dataset names of every level.
+        level_columns (Tuple[str, ...]): The output column of every level: the dataset column for the first level,
+            then '<dataset column>_level2' and so on.
+        uid_col (str): The name of the unique identifier column.
+        group_col (str): The name of the column grouping rows of the same subject.
+        group_reduction (Tuple[Tuple[str, str], ...]): The reduction used for each feature in group mode.
+        allocation (str): The allocation of the strata, 'stratum' or 'global'.
+        sampling_data (SamplingData): The configuration the plan was compiled from. Not part of the hash.
+    """
+    features: Tuple[str, ...]
+    numeric: Tuple[NumericBinning, ...]
+    categorical: Tuple[str, ...]
+    dataset_names: Tuple[str, ...]
+    weights: Tuple[float, ...]
+    dataset_column: str
+    split: DatasetSplit = None
+    level_names: Tuple[Tuple[str, ...], ...] = ()
+    level_columns: Tuple[str, ...] = ()
+    uid_col: str = None
+    group_col: str = None
+    group_reduction: Tuple[Tuple[str, str], ...] = ()
+    allocation: str = 'stratum'
+    sampling_data: SamplingData = field(default=None, compare=False, repr=False)
+
+    @property
+    def numeric_columns(self) -> Tuple[str, ...]:
+        """The names of the numeric features."""
+        return tuple(binning.column for binning in self.numeric)
+
+    @property
+    def has_data_bins(self) -> bool:
+        """Whether the bins of a numeric feature still have to be computed from the data."""
+        return any(binning.data_bins for binning in self.numeric)
+
+    def for_groups(self) -> 'SamplingPlan':
+        """Return the plan used to stratify the representative rows of the groups."""
+        group_col = self.group_col
+        return SamplingPlan(
+            features=tuple(col for col in self.features if col != group_col),
+            numeric=tuple(binning for binning in self.numeric if binning.column != group_col),
+            categorical=tuple(col for col in self.categorical if col != group_col),
+            dataset_names=self.dataset_names,
+            weights=self.weights,
+            dataset_column=self.dataset_column,
+            split=self.split,
+            level_names=self.level_names,
+            level_columns=self.level_columns,
+            uid_col=group_col,
+            group_col=None,
+            group_reduction=(),
+            allocation=self.allocation,
+            sampling_data=self.sampling_data,
+        )
+
+
+def _compile_split(datasets: dict) -> DatasetSplit:
+    """
+    Compile a (possibly nested) datasets dictionary into a DatasetSplit.
+
+    Every value is either a fraction, or a dictionary with a 'fraction' and the nested 'datasets' of that dataset.
+    """
+    if not datasets:
+        raise ValueError("At least one dataset must be configured")
+
+    fractions = []
+    children = []
+    for name, value in datasets.items():
+        if isinstance(value, dict):
+            if 'fraction' not in value or 'datasets' not in value:
+                raise ValueError(f"Nested dataset '{name}' needs a 'fraction' and 'datasets': {value}")
+            fraction = value['fraction']
+            children.append(_compile_split(value['datasets']))
+        else:
+            fraction = value
+            children.append(None)
+        try:
+            fractions.append(float(fraction))
+        except (TypeError, ValueError):
+            raise ValueError(f"Dataset fractions must be numbers: {datasets}") from None
+
+    fractions = np.array(fractions)
+    if (fractions < 0).any() or not np.isfinite(fractions).all() or fractions.sum() <= 0:
+        raise ValueError(f"Dataset fractions must be non-negative with a positive sum: {datasets}")
+
+    return DatasetSplit(names=tuple(str(name) for name in datasets.keys()),
+                        weights=tuple(float(weight) for weight in fractions / fractions.sum()),
+                        children=tuple(children))
+
+
+def _level_names(split: DatasetSplit) -> Tuple[Tuple[str, ...], ...]:
+    """Return the dataset names of every level of a split, checking that they are unique within each level."""
+    levels = []
+    nodes = [split]
+    while nodes:
+        names = tuple(name for node in nodes for name in node.names)
+        if len(set(names)) != len(names):
+            raise ValueError(f"Dataset names must be unique within each level: {names}")
+        levels.append(names)
+        nodes = [child for node in nodes for child in node.children if child is not None]
+    return tuple(levels)
+
+
+def compile_sampling_plan(sampling_data) -> SamplingPlan:
+    """
+    Validate a sampling configuration and compile it into an immutable SamplingPlan.
+
+    Parameters:
+    - sampling_data (SamplingData or SamplingPlan): The sampling configuration. A plan is returned unchanged.
+
+    Returns:
+    - SamplingPlan: The compiled plan.
+
+    Raises:
+    - ValueError: If the configuration is invalid.
+    """
+    if isinstance(sampling_data, SamplingPlan):
+        return sampling_data
+
+    features = tuple(sampling_data.features)
+    if len(set(features)) != len(features):
+        raise ValueError(f"Duplicate features in {features}")
+    if not sampling_data.dataset_column:
+        raise ValueError("The dataset column must be set")
+    split = _compile_split(sampling_data.datasets)
+    level_names = _level_names(split)
+    level_columns = tuple(level_column(sampling_data.dataset_column, depth) for depth in range(1, len(level_names) + 1))
+
+    numeric = []
+    for col_name in features:
+        if col_name not in sampling_data.numeric_cols:
+            continue
+        bin_info = sampling_data.numeric_cols[col_name] or {}
+        bins = bin_info.get('bins')
+        labels = bin_info.get('labels')
+        if isinstance(bins, dict):
+            numeric.append(NumericBinning(column=col_name, edges=(), labels=OUTLIER_LABELS,
+                                          data_bins=_data_bins_spec(col_name, bins, labels)))
+            continue
+        if bins is None:
+            bins = np.arange(0, 100, 10)  # Default bins, identical to bin_dataframe_column
+        if len(bins) < 2:
+            raise ValueError(f"At least two bin edges are needed for '{col_name}'")
+        edges = tuple(float(edge) for edge in bins)
+        if any(low >= high for low, high in zip(edges, edges[1:])):
+            raise ValueError(f"Bin edges must be strictly increasing for '{col_name}': {list(bins)}")
+        if labels is None:
+            labels = generate_bin_labels(bins)
+        if len(labels) != len(edges) - 1:
+            raise ValueError(f"Bin labels must be one fewer than the number of bin edges for '{col_name}'")
+        numeric.append(NumericBinning(column=col_name, edges=edges,
+                                      labels=tuple(str(label) for label in labels) + OUTLIER_LABELS))
+
+    numeric_columns = {binning.column for binning in numeric}
+    categorical = tuple(col_name for col_name in features if col_name not in numeric_columns)
+
+    group_reduction = dict(sampling_data.group_reduction or {})
+    unknown_reductions = set(group_reduction) - set(features)
+    if unknown_reductions:
+        raise ValueError(f"group_reduction refers to columns that are not features: {sorted(unknown_reductions)}")
+    if group_reduction and not sampling_data.group_col:
+        raise ValueError("group_reduction is only used together with group_col")
+    if sampling_data.duplicate_policy not in DUPLICATE_POLICIES:
+        raise ValueError(f"Unknown duplicate_policy {sampling_data.duplicate_policy!r}, "
+                         f"expected one of {DUPLICATE_POLICIES}")
+    if sampling_data.allocation not in ALLOCATIONS:
+        raise ValueError(f"Unknown allocation {sampling_data.allocation!r}, expected one of {ALLOCATIONS}")
+
+    return SamplingPlan(
+        features=features,
+        numeric=tuple(numeric),
+        categorical=categorical,
+        dataset_names=split.names,
+        weights=split.weights,
+        dataset_column=sampling_data.dataset_column,
+        split=split,
+        level_names=level_names,
+        level_columns=level_columns,
+        uid_col=sampling_data.uid_col or None,
+        group_col=sampling_data.group_col or None,
+        group_reduction=tuple(sorted((col, str(reduction)) for col, reduction in group_reduction.items())),
+        allocation=sampling_data.allocation,
+        sampling_data=sampling_data,
+    )
+
+
+def level_column(dataset_column: str, depth: int) -> str:
+    """Return the name of the dataset column of a level of a nested split, counting the first level as 1."""
+    return dataset_column if depth == 1 else f"{dataset_column}_level{depth}"
+
+
+def _data_bins_spec(col_name: str, bins: dict, labels) -> Tuple[Tuple[str, int], ...]:
+    """Validate a {'quantiles': k} or {'min_count': n} bins specification."""
+    if len(bins) != 1 or not set(bins) <= set(DATA_BINS_KEYS):
+        raise ValueError(f"Bins computed from the data need one of {DATA_BINS_KEYS} for '{col_name}': {bins}")
+    (key, value), = bins.items()
+    if isinstance(value, bool) or not isinstance(value, (int, np.integer)) or value < 1:
+        raise ValueError(f"'{key}' must be a positive integer for '{col_name}': {bins}")
+    if labels is not None:
+        raise ValueError(f"Labels cannot be set for the bins of '{col_name}', which are computed from the data")
+    return ((key, int(value)),)
+
+
+def _parse_mapping(text: str) -> dict:
+    """Parse a dictionary typed in a GUI field, as JSON or as a Python literal."""
+    if not text:
+        return {}
+    try:
+        value = json.loads(text)
+    except json.JSONDecodeError:
+        try:
+            value = ast.literal_eval(text)
+        except (ValueError, SyntaxError):
+            raise ValueError(f"Could not parse {text!r} as a dictionary") from None
+    if not isinstance(value, dict):
+        raise ValueError(f"Expected a dictionary, got {text!r}")
+    return value
+
+
+@lru_cache(maxsize=32)
+def plan_from_text(filename: str, dataset_column: str, features: str, datasets: str, numeric_cols: str,
+                   uid_col: str) -> SamplingPlan:
+    """
+    Parse the text fields of the GUIs and compile them into a SamplingPlan.
+
+    Results are cached on the text values, so unchanged settings are only parsed and validated once.
+
+    Parameters:
+    - filename (str): The name of the file.
+    - dataset_column (str): The name of the dataset column.
+    - features (str): Comma-separated feature names.
+    - datasets (str): Dictionary of dataset names and fractions, as JSON or a Python literal.
+    - numeric_cols (str): Dictionary of numeric columns and their bins, as JSON or a Python literal.
+      Labels are always generated.
+    - uid_col (str): The name of the unique identifier column.
+
+    Returns:
+    - SamplingPlan: The compiled plan.
+    """
+    numeric_cols_dict = _parse_mapping(numeric_cols)
+
+    # Ensure labels are set to None
+    for col in numeric_cols_dict:
+        numeric_cols_dict[col] = {**numeric_cols_dict[col], 'labels': None}
+
+    sampling_data = SamplingData(
+        filename=filename,
+        dataset_column=dataset_column,
+        features=tuple(feature.strip() for feature in features.split(',')) if features else (),
+        title='',
+        datasets=_parse_mapping(datasets),
+        numeric_cols=numeric_cols_dict,
+        uid_col=uid_col or None,
+    )
+    return compile_sampling_plan(sampling_data)
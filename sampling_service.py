@@ -0,0 +1,273 @@
+import argparse
+import base64
+import io
+import json
+import threading
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pandas as pd
+
+from CONFIG import SamplingData
+from data_preprocessing import data_fingerprint, midrc_clean, read_data_file, read_sampling_input
+from sampling_plan import compile_sampling_plan
+from stratified_sampling import contingency_table, stratified_sampling
+
+
+@dataclass
+class SamplingJob:
+    """
+    Dataclass for the state of a sampling job.
+
+    Attributes:
+        job_id (str): The id of the job.
+        sampling_data (SamplingData): The sampling configuration.
+        seed (int): The random seed, or None for fresh entropy.
+        status (str): 'queued', 'running', 'done' or 'failed'.
+        stage (str): The current stage of a running job: 'reading', 'cleaning' or 'sampling'.
+        created (str): The submission time.
+        cache_key (tuple): The (input fingerprint, configuration, seed) key of the job, once known.
+        error (str): The error message of a failed job.
+        result (pandas.DataFrame): The sampled data of a finished job.
+    """
+    job_id: str
+    sampling_data: SamplingData
+    seed: int = None
+    status: str = 'queued'
+    stage: str = None
+    created: str = field(default_factory=lambda: datetime.now().isoformat(timespec='seconds'))
+    cache_key: tuple = None
+    error: str = None
+    result: pd.DataFrame = field(default=None, repr=False)
+
+    def describe(self) -> dict:
+        """Return the JSON-serializable status of the job."""
+        description = {'job_id': self.job_id, 'status': self.status, 'stage': self.stage, 'created': self.created,
+                       'title': self.sampling_data.title, 'seed': self.seed}
+        if self.error is not None:
+            description['error'] = self.error
+        if self.result is not None:
+            summary = contingency_table(self.result, self.sampling_data).summary()
+            description['rows'] = len(self.result)
+            description['summary'] = summary.to_dict(orient='records')
+        return description
+
+
+class SamplingService:
+    """
+    Queue of sampling jobs run on a bounded worker pool.
+
+    Jobs with the same input fingerprint, configuration and seed are answered with the result of the earlier job.
+    Only the most recent max_jobs jobs are kept; older finished jobs and their results are dropped.
+
+    Attributes:
+        max_workers (int): The number of jobs run concurrently.
+        max_queued (int): The number of jobs that may wait for a worker before submissions are refused.
+        max_jobs (int): The number of jobs (and results) kept.
+    """
+
+    def __init__(self, *, max_workers: int = 2, max_queued: int = 16, max_jobs: int = 64):
+        self.max_workers = max_workers
+        self.max_queued = max_queued
+        self.max_jobs = max_jobs
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='sampling')
+        self.jobs = OrderedDict()
+        self.results = {}  # cache_key -> job_id of a finished job
+        self._lock = threading.Lock()
+
+    def submit(self, config: dict, *, path: str = None, content: bytes = None, file_ext: str = None,
+               seed: int = None) -> SamplingJob:
+        """
+        Queue a sampling job.
+
+        Parameters:
+        - config (dict): The sampling configuration, with the keys of one entry of CONFIG.yaml.
+        - path (str): The path of the data file on this machine. Defaults to the filename of the configuration,
+          which may also be a list of batch files merged by uid.
+        - content (bytes): The uploaded contents of the data file, used instead of path.
+        - file_ext (str): The file extension of the uploaded contents, e.g. '.csv'.
+        - seed (int): The random seed. None uses fresh entropy, and the result is then never reused.
+
+        Returns:
+        - SamplingJob: The new job.
+
+        Raises:
+        - ValueError: If the configuration is invalid.
+        - RuntimeError: If too many jobs are queued.
+        """
+        config = {'filename': '', 'title': '', **config}
+        if path:
+            config['filename'] = path
+        sampling_data = SamplingData.from_dict(config)
+        compile_sampling_plan(sampling_data)  # Refuse invalid configurations before queueing
+
+        with self._lock:
+            queued = sum(job.status == 'queued' for job in self.jobs.values())
+            if queued >= self.max_queued:
+                raise RuntimeError(f"Too many queued jobs ({queued}), try again later")
+            job = SamplingJob(job_id=uuid.uuid4().hex, sampling_data=sampling_data, seed=seed)
+            self.jobs[job.job_id] = job
+            self._evict()
+
+        source = io.BytesIO(content) if content is not None else None
+        self.executor.submit(self._run, job, source, file_ext)
+        return job
+
+    def get(self, job_id: str) -> SamplingJob:
+        """Return a job by id, or None if it is unknown or was dropped."""
+        with self._lock:
+            return self.jobs.get(job_id)
+
+    def shutdown(self):
+        """Stop the worker pool after the running jobs have finished."""
+        self.executor.shutdown(wait=True, cancel_futures=True)
+
+    def _evict(self):
+        """Drop the oldest finished jobs beyond max_jobs. The lock must be held."""
+        finished = [job_id for job_id, job in self.jobs.items() if job.status in ('done', 'failed')]
+        for job_id in finished[:max(0, len(self.jobs) - self.max_jobs)]:
+            job = self.jobs.pop(job_id)
+            if job.cache_key is not None and self.results.get(job.cache_key) == job_id:
+                del self.results[job.cache_key]
+
+    def _run(self, job: SamplingJob, source, file_ext: str):
+        """Run a job on a worker thread, reading the uploaded source or else the file(s) of the configuration."""
+        try:
+            job.status = 'running'
+            job.stage = 'reading'
+            if source is None:
+                data = read_sampling_input(job.sampling_data)
+            else:
+                data = read_data_file(source, file_ext, dtype_backend=job.sampling_data.dtype_backend)
+
+            if job.seed is not None:
+                job.cache_key = (data_fingerprint(data), json.dumps(
+                    {key: value for key, value in vars(job.sampling_data).items() if key not in ('filename', 'title')},
+                    sort_keys=True, default=str), job.seed)
+                with self._lock:
+                    cached = self.jobs.get(self.results.get(job.cache_key))
+                if cached is not None:
+                    job.result = cached.result
+                    job.stage = None
+                    job.status = 'done'
+                    return
+
+            job.stage = 'cleaning'
+            data = midrc_clean(data, job.sampling_data, inplace=True)
+            job.stage = 'sampling'
+            job.result = stratified_sampling(data, job.sampling_data, rng=job.seed)
+            job.stage = None
+            job.status = 'done'
+            if job.cache_key is not None:
+                with self._lock:
+                    self.results[job.cache_key] = job.job_id
+        except Exception as e:
+            job.error = f"{type(e).__name__}: {e}"
+            job.stage = None
+            job.status = 'failed'
+
+
+class SamplingRequestHandler(BaseHTTPRequestHandler):
+    """
+    HTTP interface of a SamplingService.
+
+    - POST /jobs with a JSON body {"config": {...}, "path": "...", "seed": 0} or, to upload the data,
+      {"config": {...}, "filename": "data.csv", "content": "<base64>", "seed": 0} queues a job.
+    - GET /jobs/<job id> returns the status and stage of the job, and the dataset summary once it is done.
+    - GET /jobs/<job id>/result returns the sampled data as TSV (or CSV with ?format=csv).
+    """
+    service: SamplingService = None
+
+    def _send_json(self, status: int, body: dict):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):
+        if self.path.rstrip('/') != '/jobs':
+            self._send_json(404, {'error': f"Unknown path {self.path}"})
+            return
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            content = base64.b64decode(request['content']) if 'content' in request else None
+            file_ext = None
+            if content is not None:
+                file_ext = '.' + request.get('filename', 'upload.csv').rsplit('.', 1)[-1]
+            seed = request.get('seed')
+            job = self.service.submit(request['config'], path=request.get('path'), content=content,
+                                      file_ext=file_ext, seed=None if seed is None else int(seed))
+        except RuntimeError as e:
+            self._send_json(503, {'error': str(e)})
+            return
+        except (KeyError, TypeError, ValueError) as e:
+            self._send_json(400, {'error': f"{type(e).__name__}: {e}"})
+            return
+        self._send_json(202, job.describe())
+
+    def do_GET(self):
+        path, _, query = self.path.partition('?')
+        parts = path.strip('/').split('/')
+        if len(parts) not in (2, 3) or parts[0] != 'jobs' or (len(parts) == 3 and parts[2] != 'result'):
+            self._send_json(404, {'error': f"Unknown path {self.path}"})
+            return
+        job = self.service.get(parts[1])
+        if job is None:
+            self._send_json(404, {'error': f"Unknown job {parts[1]}"})
+            return
+        if len(parts) == 2:
+            self._send_json(200, job.describe())
+            return
+        if job.status != 'done':
+            self._send_json(409, job.describe())
+            return
+
+        sep, content_type = ('\t', 'text/tab-separated-values')
+        if 'format=csv' in query:
+            sep, content_type = (',', 'text/csv')
+        data = job.result.to_csv(sep=sep, index=False).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', f'{content_type}; charset=utf-8')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+def serve(port: int = 8765, *, max_workers: int = 2, max_queued: int = 16, max_jobs: int = 64):
+    """
+    Run the sampling service on localhost until interrupted.
+
+    Parameters:
+    - port (int): The port to listen on. The service only listens on 127.0.0.1.
+    - max_workers (int): The number of jobs run concurrently.
+    - max_queued (int): The number of jobs that may wait for a worker.
+    - max_jobs (int): The number of jobs (and results) kept.
+    """
+    service = SamplingService(max_workers=max_workers, max_queued=max_queued, max_jobs=max_jobs)
+    handler = type('Handler', (SamplingRequestHandler,), {'service': service})
+    server = ThreadingHTTPServer(('127.0.0.1', port), handler)
+    print(f"Sampling service listening on http://127.0.0.1:{server.server_port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.shutdown()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run the local sampling job service.')
+    parser.add_argument('--port', type=int, default=8765, help='The port to listen on (localhost only).')
+    parser.add_argument('--workers', type=int, default=2, help='The number of jobs run concurrently.')
+    parser.add_argument('--max-queued', type=int, default=16, help='The number of jobs that may wait for a worker.')
+    parser.add_argument('--max-jobs', type=int, default=64, help='The number of jobs and results kept in memory.')
+    args = parser.parse_args()
+
+    serve(args.port, max_workers=args.workers, max_queued=args.max_queued, max_jobs=args.max_jobs)
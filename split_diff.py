@@ -0,0 +1,224 @@
+from dataclasses import dataclass, replace
+
+import numpy as np
+import pandas as pd
+
+from CONFIG import SamplingData
+from data_preprocessing import read_data_file
+from quantile_sketch import resolve_data_bins
+from sampling_plan import compile_sampling_plan
+from stratified_sampling import _stratify_rows
+
+ADDED = '(added)'
+REMOVED = '(removed)'
+
+
+@dataclass(frozen=True, eq=False)
+class SplitDiff:
+    """
+    Dataclass for the differences between two splits of the same cases.
+
+    Attributes:
+        datasets (tuple): The dataset names of both splits.
+        transitions (pandas.DataFrame): The number of uids moving from every dataset of the old split (rows) to
+            every dataset of the new split (columns), with an '(added)' row for the new uids and a '(removed)'
+            column for the uids that are no longer present.
+        moved (pandas.DataFrame): The uids found in both splits whose dataset changed, with 'From' and 'To'.
+        added (pandas.DataFrame): The uids only found in the new split, with 'To'.
+        removed (pandas.DataFrame): The uids only found in the old split, with 'From'.
+        stratum_transitions (pandas.DataFrame): For the uids found in both splits, one row per stratum (of the new
+            split) and pair of datasets with the feature labels, 'From', 'To' and 'Count'. None without features.
+    """
+    datasets: tuple
+    transitions: pd.DataFrame
+    moved: pd.DataFrame
+    added: pd.DataFrame
+    removed: pd.DataFrame
+    stratum_transitions: pd.DataFrame = None
+
+    def summary(self) -> str:
+        """Return a short text report of the differences."""
+        matched = int(self.transitions.iloc[:-1, :-1].to_numpy().sum())
+        lines = [f"{matched} uids in both splits, {len(self.moved)} moved, {len(self.added)} added, "
+                 f"{len(self.removed)} removed",
+                 "Transitions (rows: old dataset, columns: new dataset):",
+                 self.transitions.to_string()]
+        if self.stratum_transitions is not None:
+            changed = self.stratum_transitions[self.stratum_transitions['From'] != self.stratum_transitions['To']]
+            lines.append(f"{changed.iloc[:, :-3].drop_duplicates().shape[0]} strata have moved uids")
+        return '\n'.join(lines)
+
+
+def read_assignments(filename: str, uid_col: str, dataset_column: str, *, features=(),
+                     dtype_backend: str = None) -> pd.DataFrame:
+    """
+    Read only the uid, dataset and (optionally) feature columns of a COMPLETED_ output file.
+
+    Parameters:
+    - filename (str): The output file.
+    - uid_col (str): The unique identifier column.
+    - dataset_column (str): The dataset column.
+    - features (tuple): The feature columns to read, for the transitions per stratum.
+    - dtype_backend (str): The dtype backend, see read_data_file.
+
+    Returns:
+    - pandas.DataFrame: The columns read, with the uids as text and the dataset as a categorical.
+    """
+    columns = list(dict.fromkeys([uid_col, dataset_column, *features]))
+    return read_data_file(filename, dtype_backend=dtype_backend, usecols=columns,
+                          dtype={uid_col: str, dataset_column: 'category'})
+
+
+def _dataset_codes(values: pd.Series, names: list) -> np.ndarray:
+    """Number the datasets of a column by their position in names, without converting every row to text."""
+    if not isinstance(values.dtype, pd.CategoricalDtype):
+        values = values.astype('category')
+    if values.isna().any():
+        raise ValueError(f"Column '{values.name}' has rows without a dataset")
+    mapping = pd.Index(names).get_indexer(values.cat.categories.astype(str))
+    return mapping[values.cat.codes.to_numpy()].astype(np.int64)
+
+
+def diff_splits(old, new, sampling_data=None, *, uid_col: str = None, dataset_column: str = None,
+                features=None) -> SplitDiff:
+    """
+    Compare two splits of the same cases, e.g. the outputs of runs with different seeds, batches or bins.
+
+    The uids of the new split are looked up in a hash index of the old uids in one pass, and every count is a
+    single bincount of dataset codes, so the cost is linear in the number of rows and only the uid, dataset and
+    feature columns are held in memory.
+
+    Parameters:
+    - old (str or pandas.DataFrame): The old split, as a file or a DataFrame.
+    - new (str or pandas.DataFrame): The new split.
+    - sampling_data (SamplingData or SamplingPlan): The configuration of the new split. It sets the uid column,
+      the dataset column and the features and bins of the strata, unless these are given.
+    - uid_col (str): The unique identifier column.
+    - dataset_column (str): The dataset column compared.
+    - features (tuple): The stratification features. Numeric features are binned as in sampling_data.
+
+    Returns:
+    - SplitDiff: The differences.
+
+    Raises:
+    - ValueError: If a uid is found more than once in a split, or the uid or dataset column is missing.
+    """
+    plan = compile_sampling_plan(sampling_data) if sampling_data is not None else None
+    uid_col = uid_col or (plan.uid_col if plan is not None else None)
+    dataset_column = dataset_column or (plan.dataset_column if plan is not None else None)
+    if features is None:
+        features = plan.features if plan is not None else ()
+    if not uid_col or not dataset_column:
+        raise ValueError("The uid column and the dataset column are needed to compare splits")
+
+    if isinstance(old, str):
+        old = read_assignments(old, uid_col, dataset_column)
+    if isinstance(new, str):
+        new = read_assignments(new, uid_col, dataset_column, features=features)
+
+    # One hash pass over the uids of both splits numbers them together; a uid of the new split is matched when
+    # its number was also seen in the old split
+    uid_codes, uids = pd.factorize(np.concatenate([old[uid_col].to_numpy(), new[uid_col].to_numpy()]))
+    old_uids, new_uids = uid_codes[:len(old)], uid_codes[len(old):]
+    for name, codes in (('old', old_uids), ('new', new_uids)):
+        if np.bincount(codes, minlength=len(uids)).max(initial=0) > 1:
+            raise ValueError(f"The {name} split has duplicate values in '{uid_col}'")
+    old_position = np.full(len(uids), -1, dtype=np.int64)
+    old_position[old_uids] = np.arange(len(old_uids))
+    positions = old_position[new_uids]
+
+    # Number the datasets of both splits together, in the order of the configuration when known
+    names = []
+    if plan is not None and dataset_column in plan.level_columns:
+        names = list(plan.level_names[plan.level_columns.index(dataset_column)])
+    for values in (old[dataset_column], new[dataset_column]):
+        uniques = values.cat.categories if isinstance(values.dtype, pd.CategoricalDtype) else values.dropna().unique()
+        names += [str(name) for name in uniques if str(name) not in names]
+    num_datasets = len(names)
+    old_codes = _dataset_codes(old[dataset_column], names)
+    new_codes = _dataset_codes(new[dataset_column], names)
+
+    matched = positions >= 0
+    was_removed = np.ones(len(old), dtype=bool)
+    was_removed[positions[matched]] = False
+    from_codes = old_codes[positions[matched]]
+    to_codes = new_codes[matched]
+
+    counts = np.zeros((num_datasets + 1, num_datasets + 1), dtype=np.int64)
+    counts[:num_datasets, :num_datasets] = np.bincount(from_codes * num_datasets + to_codes,
+                                                       minlength=num_datasets ** 2).reshape(num_datasets, -1)
+    counts[num_datasets, :num_datasets] = np.bincount(new_codes[~matched], minlength=num_datasets)
+    counts[:num_datasets, num_datasets] = np.bincount(old_codes[was_removed], minlength=num_datasets)
+    transitions = pd.DataFrame(counts, index=pd.Index(names + [ADDED], name='From'),
+                               columns=pd.Index(names + [REMOVED], name='To'))
+
+    labels = np.array(names, dtype=object)
+    is_moved = from_codes != to_codes
+    new_uid_values = new[uid_col].to_numpy()
+    moved = pd.DataFrame({uid_col: new_uid_values[matched][is_moved],
+                          'From': labels[from_codes[is_moved]], 'To': labels[to_codes[is_moved]]})
+    added = pd.DataFrame({uid_col: new_uid_values[~matched], 'To': labels[new_codes[~matched]]})
+    removed = pd.DataFrame({uid_col: old[uid_col].to_numpy()[was_removed], 'From': labels[old_codes[was_removed]]})
+
+    stratum_transitions = None
+    if features:
+        if plan is not None and tuple(features) == plan.features:
+            feature_plan = plan
+        elif plan is not None and plan.sampling_data is not None:
+            feature_plan = compile_sampling_plan(replace(plan.sampling_data, features=tuple(features),
+                                                         group_col=None, group_reduction={}))
+        else:
+            feature_plan = compile_sampling_plan(SamplingData(filename='', dataset_column=dataset_column,
+                                                              features=tuple(features), title='diff',
+                                                              datasets={name: 1 for name in names}))
+        # Bins computed from the data are computed from all rows of the new split
+        feature_plan = resolve_data_bins(feature_plan, new)
+        stratum_codes, strata = _stratify_rows(new.loc[matched], feature_plan)
+        cells = (stratum_codes.astype(np.int64) * num_datasets + from_codes) * num_datasets + to_codes
+        cell_counts = np.bincount(cells, minlength=len(strata) * num_datasets ** 2)
+        present = np.flatnonzero(cell_counts)
+        stratum, pair = np.divmod(present, num_datasets ** 2)
+        stratum_transitions = strata.iloc[stratum].reset_index(drop=True)
+        stratum_transitions['From'] = labels[pair // num_datasets]
+        stratum_transitions['To'] = labels[pair % num_datasets]
+        stratum_transitions['Count'] = cell_counts[present]
+
+    return SplitDiff(datasets=tuple(names), transitions=transitions, moved=moved, added=added, removed=removed,
+                     stratum_transitions=stratum_transitions)
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Compare the dataset assignments of two COMPLETED_ output files.')
+    parser.add_argument('old', help='The old output file.')
+    parser.add_argument('new', help='The new output file.')
+    parser.add_argument('--config', default=None, help='A YAML configuration of the new split.')
+    parser.add_argument('--key', default=None,
+                        help='The entry of --config to use (default: the first one).')
+    parser.add_argument('--uid-col', default=None, help='The unique identifier column.')
+    parser.add_argument('--dataset-column', default=None, help='The dataset column.')
+    parser.add_argument('--features', default=None,
+                        help='Comma-separated features for the transitions per stratum (default: those of --config).')
+    parser.add_argument('--output', default=None,
+                        help="A prefix for the reports: <prefix>_moved.tsv, _added.tsv, _removed.tsv, "
+                             "_transitions.tsv and _strata.tsv.")
+    args = parser.parse_args()
+
+    sampling_data = None
+    if args.config:
+        from CONFIG import CONFIG
+        sampling_dict = CONFIG(args.config).sampling_dict
+        sampling_data = sampling_dict[args.key] if args.key else next(iter(sampling_dict.values()))
+    features = tuple(feature.strip() for feature in args.features.split(',')) if args.features else None
+
+    diff = diff_splits(args.old, args.new, sampling_data, uid_col=args.uid_col, dataset_column=args.dataset_column,
+                       features=features)
+    print(diff.summary())
+    if args.output:
+        diff.moved.to_csv(f"{args.output}_moved.tsv", sep='\t', index=False)
+        diff.added.to_csv(f"{args.output}_added.tsv", sep='\t', index=False)
+        diff.removed.to_csv(f"{args.output}_removed.tsv", sep='\t', index=False)
+        diff.transitions.to_csv(f"{args.output}_transitions.tsv", sep='\t')
+        if diff.stratum_transitions is not None:
+            diff.stratum_transitions.to_csv(f"{args.output}_strata.tsv", sep='\t', index=False)
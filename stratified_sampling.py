@@ -1,40 +1,19 @@
 import pandas as pd
 import numpy as np
-import math
-import copy
-import itertools
+import dataclasses
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
 from datetime import datetime
+from typing import Tuple
 import os
+import re
 
-from CONFIG import CONFIG, SamplingData
-from data_preprocessing import bin_dataframe_column, midrc_clean
+from CONFIG import CONFIG
+from data_preprocessing import bin_column, midrc_clean, read_sampling_input, write_data_file
+from quantile_sketch import apply_data_bins, resolve_data_bins
+from sampling_plan import ALLOCATIONS, SamplingPlan, compile_sampling_plan
 
 
-def group_counts(df_in, col_name):
-    """
-    Calculate the value counts and normalize to get percentages for a given column.
-
-    Parameters:
-    - df (pandas.DataFrame): The DataFrame containing the column to be counted.
-    - col_name (str): The name of the column to be counted.
-
-    Returns:
-    - pandas.DataFrame: A DataFrame containing the counts of the column.
-    """
-    # Calculate the value counts and normalize to get percentages
-    counts = df_in[col_name].value_counts()
-
-    # Create the output DataFrame
-    df_out = pd.DataFrame({
-        col_name: counts.index,
-        'GroupCount': counts.values,
-    })
-
-    # Sort the DataFrame by the original column values
-    df_out = df_out.sort_values(by=col_name).reset_index(drop=True)
-
-    return df_out
-
 def check_for_duplicates(df_in: pd.DataFrame, uid_col: str) -> bool:
     """
     Check for duplicates in the 'uid_col' column.
@@ -72,128 +51,663 @@ def check_for_duplicates(df_in: pd.DataFrame, uid_col: str) -> bool:
     return dupes.any()
 
 
-def stratified_sampling(data_in: pd.DataFrame, sampling_data: SamplingData, view_stats=False) -> pd.DataFrame:
+def collapse_groups(df_in: pd.DataFrame, group_col: str, features, group_reduction=None) -> pd.DataFrame:
     """
-    Perform stratified sampling on a DataFrame.
+    Collapse the rows of each group to one representative row.
 
     Parameters:
-    - data (pandas.DataFrame): The DataFrame to be sampled.
-    - sampling_data (SamplingData): The sampling configuration.
-    - view_stats (bool): Whether to view the statistics of the sampling.
+    - df_in (pandas.DataFrame): The DataFrame to be collapsed.
+    - group_col (str): The name of the column identifying the groups.
+    - features (tuple): The feature columns to keep in the representative rows.
+    - group_reduction (dict): Dictionary of feature names and their reduction. Any pandas aggregation name can be
+      used, as well as 'mode' for the most frequent value. Features default to 'first'.
 
     Returns:
-    - pandas.DataFrame: The sampled DataFrame.
+    - pandas.DataFrame: A DataFrame with one row per group, in order of first appearance, containing group_col and
+      the features.
     """
-    numeric_cols = sampling_data.numeric_cols
-    """ 
-    # I don't think this is necessary anymore
-    if len(sampling_data.numeric_cols) == 0:
-        numeric_cols = {'age_at_index':
-                            {'bins': None,
-                             'labels': None}}
+    group_codes, group_keys = pd.factorize(df_in[group_col], use_na_sentinel=False)
+    group_reduction = group_reduction or {}
+    aggregations = {}
+    for col_name in features:
+        reduction = group_reduction.get(col_name, 'first')
+        if reduction == 'mode':
+            reduction = lambda values: values.mode(dropna=False).iloc[0]
+        aggregations[col_name] = reduction
+
+    representatives = df_in[list(features)].groupby(group_codes, sort=True).agg(aggregations)
+    representatives.insert(0, group_col, group_keys)
+    return representatives.reset_index(drop=True)
+
+
+def feature_codes(data_in: pd.DataFrame, sampling_data):
     """
+    Compute integer codes for every stratification feature without modifying or copying the data.
 
-    uid_col = sampling_data.uid_col
-    cols = sampling_data.features
+    Numeric features are binned with the precomputed edges of the plan and categorical features are factorized,
+    with missing values kept as their own category. Bins configured as quantiles must already be resolved, from all
+    of the data, with resolve_data_bins: computing them here would make the edges depend on the rows passed in.
 
-    data_in[uid_col] = data_in[uid_col].astype(str)
+    Parameters:
+    - data_in (pandas.DataFrame): The DataFrame containing the features.
+    - sampling_data (SamplingData or SamplingPlan): The sampling configuration.
 
-    # Check for duplicates - If warning presents, go to merge batch
-    check_for_duplicates(data_in, uid_col)
+    Returns:
+    - tuple: (codes, label_table) where codes maps each feature to a numpy array of integer codes and label_table
+      maps each feature to the tuple of labels indexed by those codes
 
-    # Convert numeric columns to numeric type and non-numeric columns to string type
-    for col_name in cols:
-        if col_name in numeric_cols:
-            data_in[col_name] = pd.to_numeric(data_in[col_name], errors='coerce')
-        else:
-            data_in[col_name] = data_in[col_name].astype(str)
-
-    # Copy the original data to a new dataframe
-    final_table = copy.copy(data_in)
-
-    # Separate numeric groups into categories based on bin cutoff values
-    cut_suffix = "_CUT" if len(numeric_cols) > 0 else ""
-    for col_name, bin_info in numeric_cols.items():
-        data_in = bin_dataframe_column(data_in,
-                                       column_name=col_name,
-                                       cut_column_name=col_name + cut_suffix,
-                                       bins=bin_info['bins'],
-                                       labels=bin_info['labels'])
-        # We can use this to check the distribution of the binned column
-        # print(data[col_name + cut_suffix].value_counts(dropna=False))
-
-    ## Stratified sampling process
-
-    # Gather stats using a dictionary comprehension
-    stats_dict = {
-        (f"{col_name}{cut_suffix}" if col_name in numeric_cols else col_name): group_counts(data_in,
-         f"{col_name}{cut_suffix}" if col_name in numeric_cols else col_name)
-        for col_name in cols
-    }
+    Raises:
+    - ValueError: If the bins of a numeric feature still have to be computed from the data.
+    """
+    plan = compile_sampling_plan(sampling_data)
+    if plan.has_data_bins:
+        unresolved = [binning.column for binning in plan.numeric if binning.data_bins]
+        raise ValueError(f"The bins of {unresolved} are computed from the data and must be resolved first, "
+                         f"see resolve_data_bins")
+    codes = {}
+    label_table = {}
+    for binning in plan.numeric:
+        codes[binning.column] = bin_column(data_in[binning.column], binning.edges, right=binning.right)
+        label_table[binning.column] = binning.labels
+
+    for col_name in plan.categorical:
+        codes[col_name], uniques = pd.factorize(data_in[col_name], use_na_sentinel=False)
+        label_table[col_name] = tuple(str(value) for value in uniques)
+
+    return ({col_name: codes[col_name] for col_name in plan.features},
+            {col_name: label_table[col_name] for col_name in plan.features})
+
+
+def combine_stratum_codes(codes, label_table, num_rows: int):
+    """
+    Combine per-feature codes into one stratum code per row.
 
-    if view_stats:
-        for val in stats_dict.values():
-            print(val)
+    Parameters:
+    - codes (dict): Dictionary of feature names and their integer codes, as returned by feature_codes.
+    - label_table (dict): Dictionary of feature names and their labels, as returned by feature_codes.
+    - num_rows (int): The number of rows. Without any feature, every row is in the same stratum.
+
+    Returns:
+    - tuple: (stratum_codes, num_strata) where stratum_codes numbers the distinct feature combinations present in the
+      data from 0 to num_strata - 1
+    """
+    keys = np.zeros(num_rows, dtype=np.int64)
+    key_span = 1
+    for col_name, col_codes in codes.items():
+        num_levels = max(len(label_table[col_name]), 1)
+        if key_span * num_levels >= 2 ** 62:
+            # Renumber the combinations seen so far to keep the mixed-radix key within int64
+            keys = pd.factorize(keys)[0].astype(np.int64)
+            key_span = int(keys.max()) + 1
+        keys = keys * num_levels + col_codes
+        key_span *= num_levels
+
+    stratum_codes, unique_keys = pd.factorize(keys)
+    return stratum_codes, len(unique_keys)
+
+
+def global_quotas(stratum_sizes, fractions, rng=None) -> np.ndarray:
+    """
+    Apportion the rows of all strata between the datasets at once, keeping every dataset total on target.
+
+    Every (stratum, dataset) cell receives the floor of its share, and the rows left in every stratum go to cells of
+    that stratum with a fractional remainder, so every cell still gets the floor of its share or one more. Unlike
+    the per-stratum rounding of allocate_strata, every dataset can only receive as many of these extra rows as its
+    largest-remainder rounding of its fraction of all rows allows. Cells are ranked by random priorities weighted
+    by their remainders (Efraimidis-Spirakis keys), and every round gives each stratum its best ranked open cells
+    and each dataset its best ranked proposals within its capacity, as whole-matrix operations. A stratum left
+    only with full datasets takes a row from another stratum that can move it to a dataset with room; the rare
+    rows that still cannot be placed go to their stratum's best ranked cells, one over the dataset total.
+
+    Parameters:
+    - stratum_sizes (numpy.ndarray): The number of rows of every stratum.
+    - fractions (list): The fraction of the data for each dataset.
+    - rng (numpy.random.Generator or int): The random generator, or a seed for a new one.
+
+    Returns:
+    - numpy.ndarray: The (strata, datasets) number of rows of every stratum in every dataset.
+    """
+    rng = np.random.default_rng(rng)
+    weights = np.asarray(fractions, dtype=float)
+    weights = weights / weights.sum()
+    stratum_sizes = np.asarray(stratum_sizes, dtype=np.int64)
+    num_strata, num_datasets = len(stratum_sizes), len(weights)
+
+    shares = stratum_sizes[:, None] * weights[None, :]
+    # Shares that are whole numbers up to rounding errors count as whole numbers
+    quotas = np.floor(shares + 1e-9).astype(np.int64)
+    remainders = np.clip(shares - quotas, 0, None)
+    need = stratum_sizes - quotas.sum(axis=1)
+
+    # The dataset totals: the largest-remainder rounding of the fractions of all rows
+    totals = stratum_sizes.sum() * weights
+    targets = np.floor(totals).astype(np.int64)
+    targets[np.argsort(targets - totals, kind='stable')[:stratum_sizes.sum() - targets.sum()]] += 1
+    capacity = np.maximum(targets - quotas.sum(axis=0), 0)
+
+    # Efraimidis-Spirakis keys: ordering by log(u) / w draws without replacement with probabilities following w
+    candidate = remainders > 1e-12
+    keys = np.full(remainders.shape, -np.inf)
+    keys[candidate] = np.log(rng.random(int(candidate.sum()))) / remainders[candidate]
+    extra = np.zeros(remainders.shape, dtype=bool)
+
+    def best_ranked(group, rows, columns, limit):
+        """Keep the best ranked limit[group] cells of every group, where group is the row or column of every cell."""
+        order = np.lexsort((-keys[rows, columns], group))
+        group, rows, columns = group[order], rows[order], columns[order]
+        keep = np.arange(len(group)) - np.searchsorted(group, group) < limit[group]
+        return rows[keep], columns[keep]
+
+    while need.any():
+        rows, columns = np.nonzero(candidate & ~extra & (need > 0)[:, None] & (capacity > 0)[None, :])
+        if not len(rows):
+            break
+        rows, columns = best_ranked(rows, rows, columns, need)
+        rows, columns = best_ranked(columns, rows, columns, capacity)
+        extra[rows, columns] = True
+        need -= np.bincount(rows, minlength=num_strata)
+        capacity -= np.bincount(columns, minlength=num_datasets)
+
+    # Strata left only with full datasets: move the extra row of another stratum to a dataset with room
+    for stratum in np.flatnonzero(need):
+        for _ in range(need[stratum]):
+            moved = False
+            for column in np.argsort(-keys[stratum]):
+                if not candidate[stratum, column] or extra[stratum, column]:
+                    continue
+                room = np.flatnonzero(capacity > 0)
+                donors = np.flatnonzero(extra[:, column])
+                movable = candidate[donors][:, room] & ~extra[donors][:, room]
+                if movable.any():
+                    donor, target = np.argwhere(movable)[0]
+                    extra[donors[donor], column] = False
+                    extra[donors[donor], room[target]] = True
+                    extra[stratum, column] = True
+                    capacity[room[target]] -= 1
+                    moved = True
+                    break
+            if not moved:
+                column = next(column for column in np.argsort(-keys[stratum])
+                              if candidate[stratum, column] and not extra[stratum, column])
+                extra[stratum, column] = True
+            need[stratum] -= 1
+
+    return quotas + extra
+
+
+def allocate_strata(stratum_codes, num_strata: int, fractions, rng=None, *, allocation: str = 'stratum'):
+    """
+    Split the rows of every stratum between the datasets.
+
+    Each stratum receives the floor of its share for every dataset. With the 'stratum' allocation, the remaining
+    rows go to datasets drawn at random, without replacement, with probabilities proportional to the fractional
+    remainders, independently for every stratum. With the 'global' allocation, they are apportioned for all strata
+    at once so that the dataset totals also match the fractions, see global_quotas. Rows are shuffled within their
+    stratum before being split.
+
+    Parameters:
+    - stratum_codes (numpy.ndarray): The stratum code of every row.
+    - num_strata (int): The number of strata.
+    - fractions (list): The fraction of the data for each dataset.
+    - rng (numpy.random.Generator or int): The random generator, or a seed for a new one.
+    - allocation (str): 'stratum' or 'global'.
+
+    Returns:
+    - numpy.ndarray: The dataset code of every row, indexing into fractions.
+    """
+    if allocation not in ALLOCATIONS:
+        raise ValueError(f"Unknown allocation {allocation!r}, expected one of {ALLOCATIONS}")
+    rng = np.random.default_rng(rng)
+    weights = np.asarray(fractions, dtype=float)
+    weights = weights / weights.sum()
+    num_datasets = len(weights)
+
+    stratum_sizes = np.bincount(stratum_codes, minlength=num_strata)
+    if allocation == 'global':
+        quotas = global_quotas(stratum_sizes, weights, rng)
+    else:
+        shares = stratum_sizes[:, None] * weights[None, :]
+        quotas = np.floor(shares).astype(np.int64)
+        remainders = shares - quotas
+
+        # Handle the remainder of each stratum if any items are left
+        leftovers = stratum_sizes - quotas.sum(axis=1)
+        for stratum in np.flatnonzero(leftovers):
+            stratum_remainders = remainders[stratum]
+            extra = rng.choice(num_datasets, size=leftovers[stratum], replace=False,
+                               p=stratum_remainders / stratum_remainders.sum())
+            quotas[stratum, extra] += 1
+
+    # Shuffle the rows, group them by stratum, and split every stratum in dataset order
+    order = rng.permutation(len(stratum_codes))
+    order = order[np.argsort(stratum_codes[order], kind='stable')]
+    assignment = np.empty(len(stratum_codes), dtype=np.int16)
+    assignment[order] = np.repeat(np.tile(np.arange(num_datasets, dtype=np.int16), num_strata), quotas.ravel())
+
+    return assignment
+
+
+def allocate_levels(stratum_codes, num_strata: int, split, rng=None, *, allocation: str = 'stratum'):
+    """
+    Split the rows between the datasets of every level of a nested split.
+
+    The first level is split with allocate_strata. The rows of every dataset with a nested split are then split
+    between its children with the same stratum codes, so every level is balanced within its parent.
+
+    Parameters:
+    - stratum_codes (numpy.ndarray): The stratum code of every row.
+    - num_strata (int): The number of strata.
+    - split (DatasetSplit): The compiled split, see SamplingPlan.split.
+    - rng (numpy.random.Generator or int): The random generator, or a seed for a new one.
+    - allocation (str): The allocation of every split, see allocate_strata.
+
+    Returns:
+    - list: The dataset code of every row for every level, indexing into the names of that level
+      (see SamplingPlan.level_names). Rows whose dataset is not split further are -1 in the deeper levels.
+    """
+    rng = np.random.default_rng(rng)
+    level_codes = []
+    offsets = []  # The code of the first dataset of every node, per level
+
+    def allocate(rows, node, depth):
+        if depth == len(level_codes):
+            level_codes.append(np.full(len(stratum_codes), -1, dtype=np.int16))
+            offsets.append(0)
+        node_offset = offsets[depth]
+        offsets[depth] += len(node.names)
+
+        codes = allocate_strata(stratum_codes[rows], num_strata, node.weights, rng, allocation=allocation)
+        level_codes[depth][rows] = codes + node_offset
+        for position, child in enumerate(node.children):
+            if child is not None:
+                allocate(rows[codes == position], child, depth + 1)
+
+    allocate(np.arange(len(stratum_codes)), split, 0)
+    return level_codes
+
+
+@dataclass(frozen=True, eq=False)
+class ContingencyTable:
+    """
+    Dataclass for the joint contingency table of a sampling result: the number of rows of every stratum (feature
+    combination) in every dataset. Marginal tables, statistics and reports are all derived from it without
+    rescanning the data.
+
+    Attributes:
+        strata (pandas.DataFrame): One row per stratum with the label of each feature.
+        counts (numpy.ndarray): Array of shape (number of strata, number of datasets) with the row counts.
+        datasets (Tuple[str, ...]): The dataset names, in the column order of counts.
+    """
+    strata: pd.DataFrame
+    counts: np.ndarray
+    datasets: Tuple[str, ...]
+
+    @classmethod
+    def from_codes(cls, strata: pd.DataFrame, stratum_codes, assignment_codes, datasets) -> 'ContingencyTable':
+        """Count the rows of every (stratum, dataset) pair with a single bincount."""
+        num_strata, num_datasets = len(strata), len(datasets)
+        counts = np.bincount(stratum_codes.astype(np.int64) * num_datasets + assignment_codes,
+                             minlength=num_strata * num_datasets).reshape(num_strata, num_datasets)
+        return cls(strata=strata, counts=counts, datasets=tuple(datasets))
+
+    @property
+    def features(self) -> Tuple[str, ...]:
+        """The stratification features."""
+        return tuple(self.strata.columns)
+
+    def joint(self) -> pd.DataFrame:
+        """Return one row per stratum with its feature labels and its count in every dataset."""
+        return pd.concat([self.strata, pd.DataFrame(self.counts, columns=list(self.datasets))], axis=1)
+
+    def dataset_totals(self) -> pd.Series:
+        """Return the number of rows in every dataset."""
+        return pd.Series(self.counts.sum(axis=0), index=list(self.datasets), name='Total')
+
+    def marginal(self, feature: str) -> pd.DataFrame:
+        """Return the counts of every value of a feature in every dataset, with a 'Total' column."""
+        table = pd.DataFrame(self.counts, columns=list(self.datasets)).groupby(
+            self.strata[feature].to_numpy(), sort=True).sum()
+        table.index.name = feature
+        table['Total'] = table.sum(axis=1)
+        return table
+
+    def group_counts(self, feature: str) -> pd.DataFrame:
+        """Return the overall counts of every value of a feature, as a value column and a GroupCount column."""
+        return self.marginal(feature)['Total'].rename('GroupCount').reset_index()
+
+    def prevalence(self, feature: str) -> pd.DataFrame:
+        """Return the percentage of every value of a feature within each dataset and overall ('Total')."""
+        table = self.marginal(feature)
+        return 100 * table / table.sum(axis=0).replace(0, np.nan)
+
+    def summary(self) -> pd.DataFrame:
+        """Return the number of rows and the percentage of the data in every dataset."""
+        totals = self.dataset_totals()
+        return pd.DataFrame({'Dataset': totals.index, 'Count': totals.to_numpy(),
+                             'Percent': (100 * totals / max(totals.sum(), 1)).round(2).to_numpy()})
+
+    def quality_report(self) -> pd.DataFrame:
+        """
+        Return the prevalence of every feature value in every dataset and overall, with the largest absolute
+        deviation of any dataset from the overall prevalence, in percentage points.
+        """
+        reports = []
+        for feature in self.features:
+            prevalence = self.prevalence(feature)
+            report = prevalence.rename(columns={'Total': 'All'}).round(2)
+            report['Max Deviation'] = prevalence[list(self.datasets)].sub(prevalence['Total'], axis=0).abs().max(
+                axis=1).round(2)
+            report.insert(0, 'Value', report.index.astype(str))
+            report.insert(0, 'Feature', feature)
+            reports.append(report.reset_index(drop=True))
+        return pd.concat(reports, ignore_index=True) if reports else pd.DataFrame()
+
+    def print_stats(self):
+        """Print the marginal table of every feature, as shown by view_stats."""
+        for feature in self.features:
+            print(self.marginal(feature))
             print('\n')
 
-    # Generate all possible combinations of variables in the dataset
-    possible_combos = list(itertools.product(*(stats_dict[stat].iloc[:, 0].to_list() for stat in stats_dict)))
-
-    # print(f'There are a total of {len(possible_combos)} combinations of variables in this dataset.')
-    # print('Beginning stratified sampling.')
-
-    for var_selections in possible_combos:
-        # Filter the data based on the current combination of variable selections
-        temp_df = data_in
-        for j, col_name in enumerate(cols):
-            filter_col = col_name + cut_suffix if col_name in numeric_cols else col_name
-            temp_df = temp_df.loc[temp_df[filter_col] == var_selections[j]]
-
-        if not temp_df.empty:
-            total_fraction = sum(sampling_data.datasets.values())
-            dataset_split_dict = {}
-            for dataset, fraction in sampling_data.datasets.items():
-                item_split = fraction * len(temp_df) / total_fraction
-                dataset_split_dict[dataset] = {'num_items': math.floor(item_split),
-                                               'remainder': item_split - math.floor(item_split),
-                                               }
-
-            # Shuffle the DataFrame
-            temp_df_shuffled = temp_df.sample(frac=1).reset_index(drop=True)
-            start_index = 0
-            for dataset, split_dict in dataset_split_dict.items():
-                split_index = start_index + split_dict['num_items']
-                dataset_ids = temp_df_shuffled.iloc[start_index:split_index][uid_col]
-
-                # Vectorized assignment to final_table based on dataset_ids
-                final_table.loc[final_table[uid_col].isin(dataset_ids), sampling_data.dataset_column] = dataset
-                start_index = split_index
-
-            # Handle the remainder of the dataset if any items are left
-            while start_index < len(temp_df_shuffled):
-                total_remainder = sum([v['remainder'] for v in dataset_split_dict.values()])
-                single_choice = np.random.choice(
-                                     list(dataset_split_dict.keys()),
-                                     p=[v['remainder']/total_remainder for v in dataset_split_dict.values()]
-                                     )
-                final_table.loc[final_table[uid_col] == temp_df_shuffled.iloc[start_index][uid_col], sampling_data.dataset_column] = single_choice
-                dataset_split_dict.pop(single_choice)
-                start_index += 1
-
-
-    # print('Sampling complete. Saving Results...')
-    # print(FinalTable[sampling_data.dataset_column].value_counts(dropna=False))
+
+@dataclass(frozen=True, eq=False)
+class _CachedContingency:
+    """
+    The contingency table cached in the attrs of a result, with a copy of the dataset codes it was counted from, so
+    contingency_table can check that the dataset column was not reassigned or edited since.
+
+    pandas deep-copies the attrs into every DataFrame derived from the result; the entry is never modified, so it is
+    shared instead of copied.
+    """
+    table: ContingencyTable
+    assignment_codes: np.ndarray
+
+    def __deepcopy__(self, memo):
+        return self
+
+
+def _cache_contingency(result, table: ContingencyTable, assignment_codes: np.ndarray):
+    """Cache the contingency table of a result, counted from the first-level dataset codes of its rows."""
+    result.attrs['contingency'] = _CachedContingency(table, np.array(assignment_codes, dtype=np.int16))
+
+
+def _cached_contingency(result, assignment_codes: np.ndarray):
+    """Return the cached contingency table of a result, or None if it is missing or its dataset codes changed."""
+    cached = result.attrs.get('contingency')
+    if not isinstance(cached, _CachedContingency) or not np.array_equal(cached.assignment_codes, assignment_codes):
+        return None
+    return cached.table
+
+
+def stratum_labels(codes, label_table, stratum_codes, num_strata: int) -> pd.DataFrame:
+    """
+    Build the table of feature labels of every stratum.
+
+    Parameters:
+    - codes (dict): Dictionary of feature names and their integer codes, as returned by feature_codes.
+    - label_table (dict): Dictionary of feature names and their labels, as returned by feature_codes.
+    - stratum_codes (numpy.ndarray): The stratum code of every row, as returned by combine_stratum_codes.
+    - num_strata (int): The number of strata.
+
+    Returns:
+    - pandas.DataFrame: One row per stratum with the label of each feature.
+    """
+    # Find the first row of every stratum
+    first_rows = np.empty(num_strata, dtype=np.intp)
+    first_rows[stratum_codes[::-1]] = np.arange(len(stratum_codes) - 1, -1, -1)
+
+    return pd.DataFrame({col_name: np.asarray(label_table[col_name], dtype=object)[col_codes[first_rows]]
+                         for col_name, col_codes in codes.items()}, index=pd.RangeIndex(num_strata))
+
+
+def _stratify_rows(data_in: pd.DataFrame, plan: SamplingPlan):
+    """
+    Compute the stratum code of every row and the labels of the strata.
+
+    Parameters:
+    - data_in (pandas.DataFrame): The DataFrame containing the features.
+    - plan (SamplingPlan): The compiled sampling plan.
+
+    Returns:
+    - tuple: (stratum_codes, strata)
+    """
+    codes, label_table = feature_codes(data_in, plan)
+    stratum_codes, num_strata = combine_stratum_codes(codes, label_table, len(data_in))
+    return stratum_codes, stratum_labels(codes, label_table, stratum_codes, num_strata)
+
+
+def _assign_codes(data_in: pd.DataFrame, plan: SamplingPlan, rng: np.random.Generator):
+    """
+    Compute the dataset codes of every level and the stratum code of every row, and the labels of the strata.
+
+    Parameters:
+    - data_in (pandas.DataFrame): The DataFrame to be sampled.
+    - plan (SamplingPlan): The compiled sampling plan.
+    - rng (numpy.random.Generator): The random generator.
+
+    Returns:
+    - tuple: (level_codes, stratum_codes, strata)
+    """
+    if plan.group_col:
+        # Stratify one representative row per group, then broadcast the result to every row of the group
+        group_col = plan.group_col
+        group_plan = plan.for_groups()
+        group_codes = pd.factorize(data_in[group_col], use_na_sentinel=False)[0]
+        representatives = collapse_groups(data_in, group_col, group_plan.features, dict(plan.group_reduction))
+        print(f"Stratifying {len(representatives)} groups of '{group_col}' ({len(data_in)} rows)")
+        level_codes, stratum_codes, strata = _assign_codes(representatives, group_plan, rng)
+        return [codes[group_codes] for codes in level_codes], stratum_codes[group_codes], strata
+
+    # Check for duplicates - If warning presents, merge the batches with merge_batches (data_preprocessing.py)
+    if plan.uid_col:
+        check_for_duplicates(data_in, plan.uid_col)
+
+    stratum_codes, strata = _stratify_rows(data_in, plan)
+    level_codes = allocate_levels(stratum_codes, len(strata), plan.split, rng, allocation=plan.allocation)
+    return level_codes, stratum_codes, strata
+
+
+def _levels_frame(plan: SamplingPlan, level_codes, stratum_codes, strata: pd.DataFrame, index,
+                  view_stats=False) -> pd.DataFrame:
+    """Build the categorical column of every level, and cache the contingency table of the first level."""
+    table = ContingencyTable.from_codes(strata, stratum_codes, level_codes[0], plan.dataset_names)
+    if view_stats:
+        table.print_stats()
+
+    levels = pd.DataFrame({column: pd.Categorical.from_codes(codes, categories=list(names))
+                           for column, codes, names in zip(plan.level_columns, level_codes, plan.level_names)},
+                          index=index)
+    _cache_contingency(levels, table, level_codes[0])
+    return levels
+
+
+def _frozen_group_codes(groups: pd.Series, assignment_codes: np.ndarray, group_col: str) -> np.ndarray:
+    """
+    Give every row of a group the frozen dataset of the group, so that new rows join their group's dataset.
+
+    Parameters:
+    - groups (pandas.Series): The group of every row.
+    - assignment_codes (numpy.ndarray): The frozen dataset code of every row, -1 for rows without one.
+    - group_col (str): The name of the group column, for the error message.
+
+    Returns:
+    - numpy.ndarray: The frozen dataset code of every row, -1 for the rows of groups without any frozen row.
+
+    Raises:
+    - ValueError: If the frozen rows of a group are in different datasets.
+    """
+    group_codes, group_keys = pd.factorize(groups, use_na_sentinel=False)
+    is_frozen = assignment_codes >= 0
+    low = np.full(len(group_keys), np.iinfo(np.int16).max, dtype=np.int16)
+    high = np.full(len(group_keys), -1, dtype=np.int16)
+    np.minimum.at(low, group_codes[is_frozen], assignment_codes[is_frozen])
+    np.maximum.at(high, group_codes[is_frozen], assignment_codes[is_frozen])
+    conflicts = np.flatnonzero((high >= 0) & (low != high))
+    if len(conflicts):
+        raise ValueError(f"The frozen rows of {len(conflicts)} groups of '{group_col}' are in different datasets, "
+                         f"e.g. {list(group_keys[conflicts[:5]])}")
+    return high[group_codes]
+
+
+def nested_assignment(data_in: pd.DataFrame, sampling_data, *, rng=None, frozen=None, inplace=False,
+                      view_stats=False) -> pd.DataFrame:
+    """
+    Compute the stratified dataset assignment of every row at every level of a nested split.
+
+    The stratum keys are computed once; every level is then split off the same keys within its parent dataset.
+    There is one column per level, see SamplingPlan.level_columns. Rows whose dataset is not split further are
+    missing in the deeper columns. Rows that keep their frozen dataset also keep their frozen datasets at the deeper
+    levels the frozen assignments hold, and are missing in the others. With a group_col, the frozen datasets of a
+    group apply to all of its rows, and only groups without any frozen row are stratified. Bins configured as
+    quantiles are computed once from all rows of data_in, before the frozen rows are set apart or the groups are
+    collapsed.
+
+    Parameters and memory use are the same as for stratified_assignment.
+
+    Returns:
+    - pandas.DataFrame: One categorical column per level, indexed like data_in.
+    """
+    plan = resolve_data_bins(sampling_data, data_in)
+    dataset_names = list(plan.dataset_names)
+    rng = np.random.default_rng(rng)
+
+    if frozen is None:
+        level_codes, stratum_codes, strata = _assign_codes(data_in, plan, rng)
+    else:
+        if not plan.uid_col:
+            raise ValueError("A uid column is needed to apply frozen assignments")
+        if isinstance(frozen, pd.Series):
+            frozen = frozen.to_frame(plan.dataset_column)
+        positions = frozen.index.astype(str).get_indexer(data_in[plan.uid_col].astype(str))
+        level_codes = []
+        for column, names in zip(plan.level_columns, plan.level_names):
+            # Frozen assignments to datasets that are not part of this plan are ignored
+            codes = np.full(len(data_in), -1, dtype=np.int16)
+            if column in frozen.columns:
+                frozen_codes = pd.Index(names).get_indexer(frozen[column].to_numpy())
+                codes[positions >= 0] = frozen_codes[positions[positions >= 0]]
+            if plan.group_col:
+                codes = _frozen_group_codes(data_in[plan.group_col], codes, plan.group_col)
+            level_codes.append(codes)
+        is_new = level_codes[0] < 0
+        print(f"{(~is_new).sum()} cases keep their frozen assignment, {is_new.sum()} new cases are stratified")
+        if is_new.any():
+            for codes, new_codes in zip(level_codes, _assign_codes(data_in[is_new], plan, rng)[0]):
+                codes[is_new] = new_codes
+        stratum_codes, strata = _stratify_rows(data_in, plan)
 
     # Check for unassigned cases
-    idx = final_table.index[final_table[sampling_data.dataset_column] == ""].tolist()
-    if len(idx) > 0:
-        first_dataset = list(sampling_data.datasets.keys())[0]
-        print("Warning: " + str(len(idx)) + " cases did not fall in sequestration criteria \n")
+    assignment_codes = level_codes[0]
+    unassigned = assignment_codes < 0
+    if unassigned.any():
+        first_dataset = dataset_names[0]
+        print("Warning: " + str(unassigned.sum()) + " cases did not fall in sequestration criteria \n")
         print("Assigning to " + first_dataset + " dataset \n")
-        final_table.loc[idx, sampling_data.dataset_column] = first_dataset
+        assignment_codes[unassigned] = 0
+
+        print('Total number of cases in this category after assignment: ', str((assignment_codes == 0).sum()))
+
+    levels = _levels_frame(plan, level_codes, stratum_codes, strata, data_in.index, view_stats=view_stats)
+    if inplace:
+        for column in plan.level_columns:
+            data_in[column] = levels[column]
+        data_in.attrs['contingency'] = levels.attrs['contingency']
+
+    return levels
+
+
+def stratified_assignment(data_in: pd.DataFrame, sampling_data, *, rng=None, frozen=None, inplace=False,
+                          view_stats=False) -> pd.Series:
+    """
+    Compute the stratified dataset assignment of every row without copying the data.
+
+    Stratum keys are computed into side arrays of integer codes; the user's columns are never converted, copied or
+    modified. Peak memory is roughly the input plus O(N) integers: one code array per feature, the stratum codes,
+    a shuffled row order and the int16 assignment (about 8 * (number of features + 4) bytes per row).
+
+    The joint ContingencyTable built while grouping is cached in the attrs of the result, see contingency_table.
+
+    All randomness comes from rng and no global state is used, so independent calls can safely run concurrently
+    on threads, and a fixed seed gives reproducible results.
+
+    With frozen assignments (e.g. AssignmentStore.frozen_assignments), rows whose uid was already assigned keep
+    their dataset, and only the new rows are stratified, with the same fractions.
+
+    For nested splits, only the first level is returned; see nested_assignment for every level.
+
+    Parameters:
+    - data_in (pandas.DataFrame): The DataFrame to be sampled.
+    - sampling_data (SamplingData or SamplingPlan): The sampling configuration.
+    - rng (numpy.random.Generator or int): The random generator, or a seed for a new one. None uses fresh entropy.
+    - frozen (pandas.Series or pandas.DataFrame): Previous assignments, indexed by uid, that must be kept: the
+      dataset of every uid, or its datasets at every level, see AssignmentStore.frozen_assignments.
+    - inplace (bool): Whether to also attach the assignment to data_in as the dataset column (and the columns of
+      the deeper levels of a nested split).
+    - view_stats (bool): Whether to view the statistics of the sampling.
+
+    Returns:
+    - pandas.Series: The categorical dataset assignment, indexed like data_in.
+    """
+    plan = compile_sampling_plan(sampling_data)
+    levels = nested_assignment(data_in, plan, rng=rng, frozen=frozen, inplace=inplace, view_stats=view_stats)
+
+    return levels[plan.dataset_column]
 
-        print('Total number of cases in this category after assignment: ',
-              str(len(final_table[final_table[sampling_data.dataset_column] == first_dataset])))
+
+def contingency_table(result, sampling_data) -> ContingencyTable:
+    """
+    Return the contingency table of a sampling result.
+
+    The table cached by stratified_assignment or stratified_sampling is returned when the dataset column still holds
+    the datasets it was counted from. Otherwise, e.g. for a COMPLETED_ file read back from disk, a subset of the rows
+    or a dataset column that was edited since, it is built from the dataset column in one pass.
+
+    Parameters:
+    - result (pandas.DataFrame or pandas.Series): The result of stratified_sampling or stratified_assignment.
+    - sampling_data (SamplingData or SamplingPlan): The sampling configuration.
+
+    Returns:
+    - ContingencyTable: The joint contingency table.
+    """
+    plan = compile_sampling_plan(sampling_data)
+    dataset_names = list(plan.dataset_names)
+    assignment = result if isinstance(result, pd.Series) else result[plan.dataset_column]
+    assignment_codes = pd.Categorical(assignment, categories=dataset_names).codes
+    table = _cached_contingency(result, assignment_codes)
+    if table is None:
+        if (assignment_codes < 0).any():
+            raise ValueError(f"The '{plan.dataset_column}' column contains unknown or missing datasets")
+        plan = resolve_data_bins(plan, result)
+        codes, label_table = feature_codes(result, plan)
+        stratum_codes, num_strata = combine_stratum_codes(codes, label_table, len(result))
+        table = ContingencyTable.from_codes(stratum_labels(codes, label_table, stratum_codes, num_strata),
+                                            stratum_codes, assignment_codes, dataset_names)
+    return table
+
+
+def stratified_sampling(data_in: pd.DataFrame, sampling_data, view_stats=False, *, rng=None,
+                        frozen=None) -> pd.DataFrame:
+    """
+    Perform stratified sampling on a DataFrame.
+
+    Parameters:
+    - data (pandas.DataFrame): The DataFrame to be sampled.
+    - sampling_data (SamplingData or SamplingPlan): The sampling configuration.
+    - view_stats (bool): Whether to view the statistics of the sampling.
+    - rng (numpy.random.Generator or int): The random generator, or a seed for a new one. None uses fresh entropy.
+    - frozen (pandas.Series or pandas.DataFrame): Previous assignments, indexed by uid, that must be kept: the
+      dataset of every uid, or its datasets at every level, see AssignmentStore.frozen_assignments.
+
+    Returns:
+    - pandas.DataFrame: The sampled DataFrame, a shallow copy of data_in with the dataset column (and one column per
+      deeper level of a nested split) set. data_in itself is never modified.
+    """
+    plan = compile_sampling_plan(sampling_data)
+    levels = nested_assignment(data_in, plan, rng=rng, frozen=frozen, view_stats=view_stats)
+
+    final_table = data_in.copy(deep=False)
+    for column in plan.level_columns:
+        final_table[column] = levels[column]
+    final_table.attrs['contingency'] = levels.attrs['contingency']
 
     return final_table
 
@@ -231,44 +745,244 @@ def generate_output_filename(input_filename, *, extension: str = 'tsv', use_time
 
     return output_filename
 
+
+def innermost_datasets(levels: pd.DataFrame, sampling_data):
+    """
+    Number the innermost dataset of every row, e.g. its fold when the Open dataset is split into folds.
+
+    Parameters:
+    - levels (pandas.DataFrame): The dataset columns of the rows, see nested_assignment.
+    - sampling_data (SamplingData or SamplingPlan): The sampling configuration.
+
+    Returns:
+    - tuple: (codes, paths) where codes numbers the innermost dataset of every row, and paths lists every dataset
+      found as the tuple of its names at every level, in the order of the configuration.
+
+    Raises:
+    - ValueError: If a row has a dataset that is not in the configuration, or no dataset at the first level.
+    """
+    plan = compile_sampling_plan(sampling_data)
+    for column, names in zip(plan.level_columns, plan.level_names):
+        unknown = levels[column].notna() & ~levels[column].isin(names)
+        if unknown.any():
+            raise ValueError(f"Unknown dataset {levels[column][unknown].iloc[0]!r} in column '{column}', "
+                             f"expected one of {list(names)}")
+    missing = levels[plan.level_columns[0]].isna()
+    if missing.any():
+        raise ValueError(f"{missing.sum()} rows have no dataset in column '{plan.level_columns[0]}'")
+    # Columns read back from a file are text; number them in the order of the configuration
+    levels = pd.DataFrame({column: levels[column] if isinstance(levels[column].dtype, pd.CategoricalDtype)
+                           else pd.Categorical(levels[column], categories=list(names))
+                           for column, names in zip(plan.level_columns, plan.level_names)}, copy=False)
+    # A single level is grouped by its column, not by a list of one column, whose keys would be 1-tuples
+    keys = list(plan.level_columns) if len(plan.level_columns) > 1 else plan.level_columns[0]
+    grouped = levels.groupby(keys, sort=True, observed=True, dropna=False)
+    codes = grouped.ngroup().to_numpy()
+    paths = [tuple(name for name in (key if isinstance(key, tuple) else (key,)) if not pd.isna(name))
+             for key in grouped.size().index]
+    return codes, paths
+
+
+# The layouts of partitioned output: one file per dataset next to the output file, or a directory per dataset
+PARTITION_LAYOUTS = ('files', 'directory')
+
+
+def dataset_partitions(levels: pd.DataFrame, sampling_data, output_filename: str, layout: str = 'files'):
+    """
+    Number the dataset of every row and name the output file of every dataset.
+
+    With nested splits, a dataset that is split further is partitioned into its children, so that every file holds
+    the rows of one innermost dataset, e.g. one file per fold and one for the test set.
+
+    - files: '<output name>_<dataset>.<ext>' next to the output file, e.g. COMPLETED_data_Fold_1.tsv.
+    - directory: '<output name>/<column>=<dataset>/part-0.<ext>', one directory level per split level.
+
+    Parameters:
+    - levels (pandas.DataFrame): The dataset columns of the rows, see nested_assignment.
+    - sampling_data (SamplingData or SamplingPlan): The sampling configuration.
+    - output_filename (str): The output file that the partitions replace. Its extension sets the file format.
+    - layout (str): 'files' or 'directory'.
+
+    Returns:
+    - tuple: (codes, filenames) where codes numbers the partition of every row and filenames maps every dataset
+      (the tuple of its names at every level) to its file, in partition order.
+    """
+    if layout not in PARTITION_LAYOUTS:
+        raise ValueError(f"Unknown partition layout {layout!r}, expected one of {PARTITION_LAYOUTS}")
+    plan = compile_sampling_plan(sampling_data)
+    level_columns = list(plan.level_columns)
+    codes, paths = innermost_datasets(levels, plan)
+
+    base_name, extension = os.path.splitext(output_filename)
+    leaves = [path[-1] for path in paths]
+    filenames = {}
+    for path in paths:
+        if layout == 'directory':
+            parts = [f"{column}={_safe_filename(name)}" for column, name in zip(level_columns, path)]
+            filenames[path] = os.path.join(base_name, *parts, f"part-0{extension}")
+        else:
+            # Name the file after the innermost dataset, unless another level uses the same name
+            label = path[-1] if leaves.count(path[-1]) == 1 else '_'.join(path)
+            filenames[path] = f"{base_name}_{_safe_filename(label)}{extension}"
+    return codes, filenames
+
+
+def _safe_filename(name) -> str:
+    """Replace the characters of a dataset name that do not belong in a filename, e.g. 'Fold 1' -> 'Fold_1'."""
+    return re.sub(r'[^\w.-]+', '_', str(name)).strip('_') or 'dataset'
+
+
+def write_dataset_files(df: pd.DataFrame, sampling_data, output_filename: str, *, layout: str = 'files',
+                        max_workers: int = 4) -> dict:
+    """
+    Write the rows of every dataset to their own file, concurrently.
+
+    The rows are reordered by dataset with a single stable sort and take, and every file is written from a slice of
+    the reordered rows, so the data is copied once whatever the number of datasets. Rows keep their order within a
+    file.
+
+    Parameters:
+    - df (pandas.DataFrame): The sampled DataFrame, with the dataset columns of every level.
+    - sampling_data (SamplingData or SamplingPlan): The sampling configuration.
+    - output_filename (str): The output file that the partitions replace, see dataset_partitions.
+    - layout (str): 'files' or 'directory', see dataset_partitions.
+    - max_workers (int): The number of files written at once.
+
+    Returns:
+    - dict: The file of every dataset, keyed by the tuple of its names at every level.
+    """
+    plan = compile_sampling_plan(sampling_data)
+    codes, filenames = dataset_partitions(df[list(plan.level_columns)], plan, output_filename, layout)
+    order = np.argsort(codes, kind='stable')
+    bounds = np.searchsorted(codes[order], np.arange(len(filenames) + 1))
+    reordered = df.take(order)
+
+    def write(i: int, filename: str):
+        folder = os.path.dirname(filename)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        write_data_file(reordered.iloc[bounds[i]:bounds[i + 1]], filename)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        # Consume the results so that the first error of a writer is raised here
+        list(executor.map(write, range(len(filenames)), filenames.values()))
+    return filenames
+
+
 if __name__ == '__main__':
     """
     Run stratified sampling on the data and save the results.
     """
-    config = CONFIG()
-    # config.set_filename('CONFIG_stratified_sampling.yaml')  # Uncomment to use a different config file
+    import argparse  # Only the command line needs it; keeps importing the engine fast
+
+    parser = argparse.ArgumentParser(description='Run stratified sampling on the data and save the results.')
+    parser.add_argument('--config', default='CONFIG.yaml', help='The YAML configuration file.')
+    parser.add_argument('--seed', type=int, default=0, help='The random seed.')
+    parser.add_argument('--store', default=None, help='An SQLite file to record the assignments of every run in.')
+    parser.add_argument('--dtype-backend', default=None, choices=['numpy_nullable', 'pyarrow'],
+                        help="Read the files with this dtype backend, overriding the dtype_backend of the config.")
+    parser.add_argument('--memory-budget', default=None,
+                        help="A memory budget such as '4GB'. The execution mode (in memory or chunked) "
+                             "is chosen to fit it, overriding the memory_budget of the config.")
+    parser.add_argument('--partition-output', default=None, choices=list(PARTITION_LAYOUTS),
+                        help="Write one file per dataset ('files') or a directory per dataset ('directory') instead "
+                             "of a single output file, overriding the partition_output of the config.")
+    parser.add_argument('--swap-seconds', type=float, default=0,
+                        help='Refine every split for up to this many seconds by swapping rows between datasets to '
+                             'reduce the imbalance of every feature (see swap_optimizer.py).')
+    parser.add_argument('--allocation', default=None, choices=list(ALLOCATIONS),
+                        help="How the rows of every stratum are apportioned, overriding the allocation of the config: "
+                             "'stratum' rounds every stratum on its own, 'global' also keeps the dataset totals on "
+                             "their fractions.")
+    parser.add_argument('--frozen-run', default=None,
+                        help="A run id in --store (or 'latest') whose assignments are kept for known uids.")
+    args = parser.parse_args()
+
+    config = CONFIG(args.config)
     sampling_dict = config.sampling_dict
-
-    seed = 0  # Set random seed at user preference
-    np.random.seed(seed)
+    if args.allocation:
+        sampling_dict = {key: dataclasses.replace(sampling_data, allocation=args.allocation)
+                         for key, sampling_data in sampling_dict.items()}
+
+    # Validate and compile every configuration before any file is loaded
+    sampling_plans = {key: compile_sampling_plan(sampling_data) for key, sampling_data in sampling_dict.items()}
+
+    seed = args.seed  # Set random seed at user preference
+    rng = np.random.default_rng(seed)
+
+    store = None
+    frozen = None
+    if args.store:
+        from assignment_store import AssignmentStore
+        store = AssignmentStore(args.store)
+        if args.frozen_run:
+            frozen_run_id = None if args.frozen_run == 'latest' else int(args.frozen_run)
+            frozen = store.frozen_assignments(frozen_run_id)
+            # New cases are binned like the frozen ones, not by the quantiles of the new data
+            data_bins = store.data_bins(frozen_run_id)
+            sampling_plans = {key: apply_data_bins(plan, data_bins) for key, plan in sampling_plans.items()}
 
     last_filename = None
     df = None
     # Iterate over the sampling configurations
     for key, sampling_data in sampling_dict.items():
+        prefix = 'COMPLETED_'
+        # Add the key to the filename if there are multiple sampling configurations
+        suffix = f'_{key}' if len(sampling_dict) > 1 else ''
+        use_timestamp = False  # Set to True to add a timestamp to the filename
+
+        # Generate the output filename with the prefix, suffix, and timestamp as specified above
+        # Batch files are named after the first batch
+        input_filename = sampling_data.filename
+        if not isinstance(input_filename, str):
+            input_filename = input_filename[0]
+        file_name = generate_output_filename(input_filename,
+                                             extension='tsv',
+                                             use_timestamp=use_timestamp,
+                                             prefix=prefix,
+                                             suffix=suffix,
+                                             )
+
+        partition_output = args.partition_output or sampling_data.partition_output
+
+        # With a memory budget, the execution mode (in memory or chunked) is chosen to fit it
+        memory_budget = args.memory_budget or sampling_data.memory_budget
+        if memory_budget is not None:
+            from sampling_execution import input_fingerprint, sample_file
+            if args.swap_seconds:
+                print("WARNING: --swap-seconds is ignored with a memory budget")
+            try:
+                mode, result = sample_file(sampling_plans[key], file_name, memory_budget=memory_budget, rng=rng,
+                                           frozen=frozen, dtype_backend=args.dtype_backend,
+                                           partition_output=partition_output)
+            except FileNotFoundError as e:
+                print(f"Error reading file: {sampling_data.filename}. {e}")
+                continue
+            except ValueError as e:
+                print(f"ValueError: {e}")
+                continue
+            if store is not None:
+                fingerprint = input_fingerprint(result, sampling_plans[key])
+                # The bins computed from the data are computed again from the same rows, to be recorded
+                run_id = store.record_run(result, resolve_data_bins(sampling_plans[key], result), seed=seed,
+                                          fingerprint=fingerprint)
+                print(f"Recorded assignments of '{key}' as run {run_id} in {args.store}")
+            continue
+
         # Check if the DataFrame needs to be read from a file
         if df is None or sampling_data.filename != last_filename:
             try:
-                # Map file extensions to corresponding pandas read functions
-                read_functions = {
-                    '.xlsx': pd.read_excel,
-                    '.xls': pd.read_excel,
-                    '.csv': pd.read_csv,
-                    '.tsv': lambda file: pd.read_csv(file, sep='\t'),
-                }
-
-                # Get the file extension
-                file_ext = sampling_data.filename[sampling_data.filename.rfind('.'):]
-
-                # Check if the extension is supported and read the file
-                if file_ext in read_functions:
-                    data = read_functions[file_ext](sampling_data.filename)
-                else:
-                    raise ValueError(f"Unsupported file format: {sampling_data.filename}")
+                data = read_sampling_input(sampling_data, dtype_backend=args.dtype_backend)
 
                 # Process the data
-                df = midrc_clean(data, sampling_data)
+                df = midrc_clean(data, sampling_data, inplace=True)
                 last_filename = sampling_data.filename
+                if store is not None:
+                    # The input is fingerprinted from its sampling columns, as with a memory budget
+                    from sampling_execution import input_fingerprint
+                    fingerprint = input_fingerprint(df, sampling_data)
+                else:
+                    fingerprint = None
 
             except FileNotFoundError as e:
                 print(f"Error reading file: {sampling_data.filename}. {e}")
@@ -277,24 +991,24 @@ if __name__ == '__main__':
                 print(f"ValueError: {e}")
                 continue
 
-        # Perform stratified sampling
-        df = stratified_sampling(df, sampling_data)
+        # Perform stratified sampling, with the bins computed from the data computed once from all of it
+        plan = resolve_data_bins(sampling_plans[key], df)
+        df = stratified_sampling(df, plan, rng=rng, frozen=frozen)
+        if args.swap_seconds:
+            from swap_optimizer import swap_optimize
+            df, _ = swap_optimize(df, plan, rng=rng, max_seconds=args.swap_seconds, inplace=True, frozen=frozen)
+
+        # Record the assignments of this run
+        if store is not None:
+            run_id = store.record_run(df, plan, seed=seed, fingerprint=fingerprint)
+            print(f"Recorded assignments of '{key}' as run {run_id} in {args.store}")
 
         # We can use this to check the distribution of the dataset column
         # print(df[sampling_data.dataset_column].value_counts(dropna=False))
 
-        prefix = 'COMPLETED_'
-        # Add the key to the filename if there are multiple sampling configurations
-        suffix = f'_{key}' if len(sampling_dict) > 1 else ''
-        use_timestamp = False  # Set to True to add a timestamp to the filename
-
-        # Generate the output filename with the prefix, suffix, and timestamp as specified above
-        file_name = generate_output_filename(sampling_data.filename,
-                                             extension='tsv',
-                                             use_timestamp=use_timestamp,
-                                             prefix=prefix,
-                                             suffix=suffix,
-                                             )
-
-        # Save the DataFrame to a TSV file
-        df.to_csv(file_name, sep='\t', encoding='utf-8', index=False)
+        # Save the DataFrame to a TSV file, or one file per dataset
+        if partition_output:
+            filenames = write_dataset_files(df, sampling_plans[key], file_name, layout=partition_output)
+            print(f"Wrote {len(filenames)} dataset files: {', '.join(filenames.values())}")
+        else:
+            write_data_file(df, file_name)
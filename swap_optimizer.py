@@ -0,0 +1,351 @@
+import time
+from dataclasses import dataclass
+
+import numpy as np
+import pandas as pd
+
+from quantile_sketch import resolve_data_bins
+from stratified_sampling import ContingencyTable, _cache_contingency, _stratify_rows, collapse_groups, feature_codes
+
+
+@dataclass
+class SwapReport:
+    """
+    Dataclass for the outcome of a swap optimization.
+
+    Attributes:
+        swaps (int): The number of swaps made.
+        iterations (int): The number of batches of candidate swaps evaluated.
+        seconds (float): The time spent.
+        imbalance_before (float): The sum of squared prevalence deviations before the swaps.
+        imbalance_after (float): The same after the swaps.
+        max_deviation_before (float): The largest deviation of a feature value's prevalence in a dataset from its
+            prevalence in all the data, before the swaps.
+        max_deviation_after (float): The same after the swaps.
+    """
+    swaps: int
+    iterations: int
+    seconds: float
+    imbalance_before: float
+    imbalance_after: float
+    max_deviation_before: float
+    max_deviation_after: float
+
+    def __str__(self):
+        return (f"{self.swaps} swaps in {self.iterations} iterations ({self.seconds:.2f} s): imbalance "
+                f"{self.imbalance_before:.3g} -> {self.imbalance_after:.3g}, largest prevalence deviation "
+                f"{100 * self.max_deviation_before:.2f} -> {100 * self.max_deviation_after:.2f} points")
+
+
+def optimize_counts(counts: np.ndarray, levels: np.ndarray, weights, *, rng=None, keep_strata: bool = True,
+                    max_seconds: float = 5.0, max_iterations: int = 10_000, batch_size: int = 1024,
+                    patience: int = 50, fixed: np.ndarray = None, accept=None):
+    """
+    Reduce the marginal imbalance of a stratified split by swapping rows of different strata between datasets.
+
+    Rows of the same stratum are interchangeable, so the search works on the contingency counts: a swap moves one
+    row of stratum s from dataset a to b and one row of stratum t from b to a, which keeps every dataset size. The
+    objective is the sum over the values of every feature and every dataset of the squared difference between the
+    prevalence of the value in the dataset and in all the data. A swap only changes four marginal counts per feature,
+    so its effect is computed in O(features). Every iteration screens a batch of random candidate swaps at once, then
+    applies the best ones, checking each against the updated counts.
+
+    Parameters:
+    - counts (numpy.ndarray): The (strata, datasets) row counts.
+    - levels (numpy.ndarray): The (strata, features) marginal cell of every stratum for every feature: the code of
+      its value, offset so that the values of all features are numbered together.
+    - weights (list): The fraction of every dataset, used for the stratum quotas.
+    - rng (numpy.random.Generator or int): The random generator, or a seed for a new one.
+    - keep_strata (bool): Whether every stratum must keep the floor of its share, or one more, in every dataset (as
+      after allocate_strata). Otherwise any swap is allowed.
+    - max_seconds (float): The time budget.
+    - max_iterations (int): The largest number of batches evaluated.
+    - batch_size (int): The number of candidate swaps per batch.
+    - patience (int): The number of batches without an improvement after which the search stops.
+    - fixed (numpy.ndarray): The (strata, datasets) counts of rows that must not move, e.g. frozen rows. They count
+      towards the prevalences, the dataset sizes and the stratum quotas, but are never swapped.
+    - accept (callable): Called as accept(s, a, t, b) before every swap, which is skipped if it returns False, e.g.
+      because it would break a constraint that the counts do not show.
+
+    Returns:
+    - tuple: (counts, swaps, report) with the new counts of the rows that may move, the (s, a, t, b) swaps in the
+      order they were made and a SwapReport
+    """
+    start = time.monotonic()
+    rng = np.random.default_rng(rng)
+    counts = np.array(counts, dtype=np.int64)
+    num_strata, num_datasets = counts.shape
+    fixed = np.zeros_like(counts) if fixed is None else np.asarray(fixed, dtype=np.int64)
+    totals = counts + fixed
+    levels = np.asarray(levels, dtype=np.int64).reshape(num_strata, -1)
+    sizes = totals.sum(axis=0).astype(float)
+    sizes[sizes == 0] = 1.0
+
+    # Marginal counts of every feature value in every dataset, and the prevalence of every value
+    num_cells = int(levels.max()) + 1 if levels.size else 0
+    marginals = np.zeros((num_cells, num_datasets))
+    for feature_levels in levels.T:
+        np.add.at(marginals, feature_levels, totals)
+    prevalence = marginals.sum(axis=1) / max(totals.sum(), 1)
+    deviation = marginals / sizes - prevalence[:, None]
+    imbalance_before = float((deviation ** 2).sum())
+    max_deviation_before = float(np.abs(deviation).max(initial=0.0))
+
+    if keep_strata:
+        weights = np.asarray(weights, dtype=float)
+        shares = totals.sum(axis=1)[:, None] * (weights / weights.sum())[None, :]
+        # The bounds of the whole stratum, less its fixed rows, bound the rows that may move
+        lower = np.floor(shares + 1e-9) - fixed
+        upper = np.ceil(shares - 1e-9) - fixed
+    else:
+        lower = np.zeros(counts.shape)
+        upper = np.full(counts.shape, np.inf)
+
+    def change(cells, datasets, delta):
+        """The change of the objective when the marginal counts of the cells change by delta (+1 or -1)."""
+        dataset_sizes = sizes[datasets]
+        return (2 * delta * deviation[cells, datasets] + 1 / dataset_sizes) / dataset_sizes
+
+    swaps = []
+    iterations = 0
+    idle = 0
+    while iterations < max_iterations and idle < patience and time.monotonic() - start < max_seconds:
+        iterations += 1
+        # Candidate pairs of a row that may leave (s, a) and a row that may leave (t, b)
+        movable = np.flatnonzero(((counts > lower) & (counts > 0)).ravel())
+        if len(movable) < 2:
+            break
+        first, second = rng.choice(movable, size=(2, batch_size))
+        s, a = np.divmod(first, num_datasets)
+        t, b = np.divmod(second, num_datasets)
+        valid = (s != t) & (a != b) & (counts[s, b] < upper[s, b]) & (counts[t, a] < upper[t, a])
+        s, a, t, b = s[valid], a[valid], t[valid], b[valid]
+        if not len(s):
+            idle += 1
+            continue
+
+        ls, lt = levels[s], levels[t]
+        moved = ls != lt
+        a_, b_ = a[:, None], b[:, None]
+        gain = np.where(moved, change(ls, a_, -1) + change(ls, b_, 1) + change(lt, b_, -1) + change(lt, a_, 1),
+                        0.0).sum(axis=1)
+
+        accepted = 0
+        for k in np.argsort(gain)[:64]:
+            if gain[k] >= -1e-15:
+                break
+            sk, ak, tk, bk = int(s[k]), int(a[k]), int(t[k]), int(b[k])
+            # Earlier swaps of this batch may have changed the counts: check the swap again
+            if not (counts[sk, ak] > max(lower[sk, ak], 0) and counts[tk, bk] > max(lower[tk, bk], 0)
+                    and counts[sk, bk] < upper[sk, bk] and counts[tk, ak] < upper[tk, ak]):
+                continue
+            cells_s, cells_t = levels[sk][moved[k]], levels[tk][moved[k]]
+            exact = (change(cells_s, ak, -1) + change(cells_s, bk, 1) + change(cells_t, bk, -1)
+                     + change(cells_t, ak, 1)).sum()
+            if exact >= -1e-15 or (accept is not None and not accept(sk, ak, tk, bk)):
+                continue
+            counts[sk, ak] -= 1
+            counts[sk, bk] += 1
+            counts[tk, bk] -= 1
+            counts[tk, ak] += 1
+            for cells, source, target in ((cells_s, ak, bk), (cells_t, bk, ak)):
+                marginals[cells, source] -= 1
+                marginals[cells, target] += 1
+                deviation[cells, source] = marginals[cells, source] / sizes[source] - prevalence[cells]
+                deviation[cells, target] = marginals[cells, target] / sizes[target] - prevalence[cells]
+            swaps.append((sk, ak, tk, bk))
+            accepted += 1
+        idle = 0 if accepted else idle + 1
+
+    report = SwapReport(swaps=len(swaps), iterations=iterations, seconds=time.monotonic() - start,
+                        imbalance_before=imbalance_before, imbalance_after=float((deviation ** 2).sum()),
+                        max_deviation_before=max_deviation_before,
+                        max_deviation_after=float(np.abs(deviation).max(initial=0.0)))
+    return counts, swaps, report
+
+
+def _nested_splits(split) -> list:
+    """
+    Map every dataset that is split further to its children, level by level.
+
+    Parameters:
+    - split (DatasetSplit): The compiled split, see SamplingPlan.split.
+
+    Returns:
+    - list: For every level below the first, a dict from the code of a dataset at the level above (see
+      SamplingPlan.level_names) to the (codes, weights) arrays of its children.
+    """
+    children = []
+    nodes = [split]
+    while True:
+        parents, next_nodes, code, offset = {}, [], 0, 0
+        for node in nodes:
+            for position in range(len(node.names)):
+                child = node.children[position] if node.children else None
+                if child is not None:
+                    parents[code] = (np.arange(offset, offset + len(child.names)), np.asarray(child.weights))
+                    offset += len(child.names)
+                    next_nodes.append(child)
+                code += 1
+        if not next_nodes:
+            return children
+        children.append(parents)
+        nodes = next_nodes
+
+
+def swap_optimize(result: pd.DataFrame, sampling_data, *, rng=None, keep_strata: bool = True,
+                  max_seconds: float = 5.0, max_iterations: int = 10_000, inplace: bool = False, frozen=None):
+    """
+    Refine a sampling result by swapping rows between datasets to reduce the imbalance of every feature.
+
+    Every dataset keeps its size, and with keep_strata every stratum keeps the floor of its share, or one more, in
+    every dataset, so only the rows that the allocation placed at random are moved. See optimize_counts.
+
+    With a group_col, whole groups are swapped, so every dataset keeps its number of groups. With nested splits,
+    the first level is optimized, and the two rows of a swap also exchange their deeper datasets, so every dataset
+    keeps its size at every level. The rows of a swap are chosen among the deeper datasets of their strata so that,
+    with keep_strata, every stratum also stays within its quotas at the deeper levels (or no further outside them
+    than before); a swap without such rows is not made.
+
+    Rows whose uid has a frozen assignment (and, with a group_col, every row of a group with such a row) are never
+    swapped, but they count towards the prevalences and quotas the other rows are balanced against.
+
+    Parameters:
+    - result (pandas.DataFrame): The result of stratified_sampling.
+    - sampling_data (SamplingData or SamplingPlan): The sampling configuration of the result.
+    - rng (numpy.random.Generator or int): The random generator, or a seed for a new one.
+    - keep_strata (bool): Whether every stratum must stay within its quotas.
+    - max_seconds (float): The time budget of the search.
+    - max_iterations (int): The largest number of batches of candidate swaps evaluated.
+    - inplace (bool): Whether to update the dataset columns of result instead of a copy.
+    - frozen (pandas.Series or pandas.DataFrame): Previous assignments, indexed by uid, that must be kept (see
+      stratified_sampling).
+
+    Returns:
+    - tuple: (result, report) with the refined result and a SwapReport.
+    """
+    # Bins computed from the data are computed from all rows, as in stratified_sampling, not from the units
+    plan = resolve_data_bins(sampling_data, result)
+    rng = np.random.default_rng(rng)
+    level_columns = list(plan.level_columns)
+    num_datasets = len(plan.dataset_names)
+
+    # Swap units: the rows, or one representative row per group
+    if plan.group_col:
+        group_codes = pd.factorize(result[plan.group_col], use_na_sentinel=False)[0]
+        first_rows = np.full(group_codes.max() + 1, len(group_codes))
+        np.minimum.at(first_rows, group_codes, np.arange(len(group_codes)))
+        units = collapse_groups(result, plan.group_col, plan.for_groups().features, dict(plan.group_reduction))
+        unit_plan = plan.for_groups()
+    else:
+        group_codes, first_rows, units, unit_plan = None, None, result, plan
+
+    stratum_codes, strata = _stratify_rows(units, unit_plan)
+    codes, _ = feature_codes(units, unit_plan)
+    unit_levels = np.stack([result[column].cat.codes.to_numpy() if first_rows is None
+                            else result[column].cat.codes.to_numpy()[first_rows] for column in level_columns])
+
+    # The marginal cell of every stratum for every feature, from the first row of the stratum
+    first_of_stratum = np.full(len(strata), len(stratum_codes))
+    np.minimum.at(first_of_stratum, stratum_codes, np.arange(len(stratum_codes)))
+    offsets = np.cumsum([0] + [int(feature.max(initial=-1)) + 1 for feature in codes.values()])[:-1]
+    levels = np.stack([feature[first_of_stratum] + offset for feature, offset in zip(codes.values(), offsets)],
+                      axis=1) if codes else np.zeros((len(strata), 0), dtype=np.int64)
+
+    # Units with a frozen row stay where they are: they are counted apart and left out of the pools below
+    is_fixed = np.zeros(len(stratum_codes), dtype=bool)
+    if frozen is not None and len(frozen):
+        if not plan.uid_col:
+            raise ValueError("A uid column is needed to keep frozen assignments")
+        fixed_rows = result[plan.uid_col].astype(str).isin(frozen.index.astype(str)).to_numpy()
+        is_fixed = fixed_rows if group_codes is None else np.bincount(group_codes, weights=fixed_rows,
+                                                                      minlength=len(is_fixed)) > 0
+
+    num_cells = len(strata) * num_datasets
+    cells = stratum_codes.astype(np.int64) * num_datasets + unit_levels[0]
+    counts = np.bincount(cells[~is_fixed], minlength=num_cells).reshape(len(strata), num_datasets)
+    fixed = np.bincount(cells[is_fixed], minlength=num_cells).reshape(len(strata), num_datasets)
+
+    # The units are pooled by stratum and by their datasets at every level (their path), and a swap exchanges the
+    # paths of its two units. Fixed units are put past the last pool, so no pool holds them
+    paths, path_codes = np.unique(unit_levels.T, axis=0, return_inverse=True)
+    path_codes = path_codes.reshape(-1)
+    paths_of_dataset = [np.flatnonzero(paths[:, 0] == dataset) for dataset in range(num_datasets)]
+    num_pools = len(strata) * len(paths)
+    pool_codes = np.where(is_fixed, num_pools, stratum_codes.astype(np.int64) * len(paths) + path_codes)
+    order = np.argsort(pool_codes, kind='stable')
+    bounds = np.searchsorted(pool_codes[order], np.arange(num_pools + 1))
+    pools = {}
+
+    def pool(stratum: int, path: int) -> list:
+        """The movable units of a stratum with a path."""
+        key = stratum * len(paths) + path
+        if key not in pools:
+            pools[key] = list(order[bounds[key]:bounds[key + 1]])
+        return pools[key]
+
+    # The units of every stratum in every dataset of every level, fixed units included, and the children of every
+    # dataset that is split further, so the deeper quotas can be checked
+    level_counts = []
+    for depth, names in enumerate(plan.level_names):
+        known = unit_levels[depth] >= 0
+        level_counts.append(np.zeros((len(strata), len(names)), dtype=np.int64))
+        np.add.at(level_counts[-1], (stratum_codes[known], unit_levels[depth][known]), 1)
+    children = _nested_splits(plan.split)
+
+    def quota_excess(stratum: int, depth: int, parent: int) -> float:
+        """How far the units of a stratum in the children of a dataset are outside the quotas of the stratum."""
+        child_codes, child_weights = children[depth - 1][parent]
+        shares = level_counts[depth - 1][stratum, parent] * child_weights
+        child_counts = level_counts[depth][stratum, child_codes]
+        return float((np.maximum(np.floor(shares + 1e-9) - child_counts, 0)
+                      + np.maximum(child_counts - np.ceil(shares - 1e-9), 0)).sum())
+
+    def move(stratum: int, source: int, target: int):
+        """Update the level counts for a unit of a stratum moving from one path to another."""
+        for depth in range(len(level_counts)):
+            if paths[source, depth] >= 0:
+                level_counts[depth][stratum, paths[source, depth]] -= 1
+            if paths[target, depth] >= 0:
+                level_counts[depth][stratum, paths[target, depth]] += 1
+
+    def accept(s: int, a: int, t: int, b: int) -> bool:
+        """Swap a unit of stratum s in dataset a with one of stratum t in dataset b, if their paths allow it."""
+        candidates = [(p, q) for p in paths_of_dataset[a] for q in paths_of_dataset[b] if pool(s, p) and pool(t, q)]
+        for k in rng.permutation(len(candidates)):
+            p, q = candidates[k]
+            # The strata whose quotas in the children of a dataset on either path can change
+            checks = {(stratum, depth, int(path[depth - 1])) for stratum in (s, t) for path in (paths[p], paths[q])
+                      for depth in range(1, len(level_counts)) if int(path[depth - 1]) in children[depth - 1]}
+            before = {check: quota_excess(*check) for check in checks}
+            move(s, p, q)
+            move(t, q, p)
+            if not keep_strata or all(quota_excess(*check) <= before[check] for check in checks):
+                i, j = pool(s, p), pool(t, q)
+                for units in (i, j):
+                    pick = int(rng.integers(len(units)))
+                    units[pick], units[-1] = units[-1], units[pick]
+                i, j = i.pop(), j.pop()
+                path_codes[i], path_codes[j] = q, p
+                pool(s, q).append(i)
+                pool(t, p).append(j)
+                return True
+            move(s, q, p)
+            move(t, p, q)
+        return False
+
+    _, _, report = optimize_counts(counts, levels, plan.weights, rng=rng, keep_strata=keep_strata,
+                                   max_seconds=max_seconds, max_iterations=max_iterations, fixed=fixed,
+                                   accept=accept)
+    unit_levels = paths[path_codes].T
+
+    row_levels = unit_levels if group_codes is None else unit_levels[:, group_codes]
+    if not inplace:
+        result = result.copy()
+    for column, column_codes, names in zip(level_columns, row_levels, plan.level_names):
+        result[column] = pd.Categorical.from_codes(column_codes, categories=list(names))
+    row_strata = stratum_codes if group_codes is None else stratum_codes[group_codes]
+    _cache_contingency(result, ContingencyTable.from_codes(strata, row_strata, row_levels[0], plan.dataset_names),
+                       row_levels[0])
+    print(f"Swap optimizer: {report}")
+    return result, report